@@ -9,7 +9,7 @@ function cams = loadCamsData(tStr, experimentType, DATA_FOLDER, loadBgndMask)
 	multicam = readHDF5([EXP_PREFIX 'multicam_' tStr '.h5']);
     t = (parseStrDatetime(multicam.t_start):seconds(1/double(multicam.fps)):parseStrDatetime(multicam.t_end))';
     aux = {cell(size(multicam.frame_nums))};  % Every field in cams will have a cell entry per frame (row) and cam (col)
-    cams = struct('t',t, 'frameNums',multicam.frame_nums, 'hands',aux, 'products',aux, 'bgndMask',aux);
+    cams = struct('t',t, 'frameNums',multicam.frame_nums, 'hands',aux, 'products',aux, 'bgndMask',aux, 'skipped',false(size(multicam.frame_nums)));  % skipped(frame,cam): pose/products weren't computed for that frame (see frame_selection.py)
     
     % Fill in info for each cam
     for iCam = 1:size(multicam.frame_nums,2)
@@ -17,27 +17,48 @@ function cams = loadCamsData(tStr, experimentType, DATA_FOLDER, loadBgndMask)
         CAM_SUFFIX = ['cam' num2str(iCam) '_' tStr];
         camInfo = readHDF5([EXP_PREFIX CAM_SUFFIX '.h5']);
         prodInfo = readHDF5([EXP_PREFIX CAM_SUFFIX '_mask_objdet' '.h5']);
+        maskH5FileName = [EXP_PREFIX CAM_SUFFIX '_mask.h5'];  % If it exists, masks were bit-packed into a single h5 instead of one png per frame
+        hasMaskH5 = exist(maskH5FileName, 'file') == 2;
         framesWithProds = fieldnames(prodInfo);
         for iFrame = 1:length(multicam.frame_nums)
             frameNum = multicam.frame_nums(iFrame, iCam)+1;  % Add 1 since indexing is 0-based
             frameStr = sprintf('frame%05d', frameNum);
             
+            % Frames that vision preprocessing skipped (not selected) have no hands nor products, but that doesn't mean there weren't any
+            cams.skipped(iFrame,iCam) = (isfield(camInfo, 'pose') && isfield(camInfo.pose, 'selected') && ~camInfo.pose.selected(frameNum)) || (isfield(prodInfo, 'selected') && ~prodInfo.selected(frameNum));
+            
             % Hands position: 4x(# hands found), where rows indicate:
             % xHand, yHand, personId, jointType (=4 for RHand, 7 for LHand)
-            cams.hands{iFrame,iCam} = double(camInfo.hands.(frameStr));
+            if isfield(camInfo.hands, 'version') && camInfo.hands.version >= 2  % v2 (columnar) layout: every frame's hands concatenated, frame n is columns offsets(n)+1:offsets(n+1)
+                cams.hands{iFrame,iCam} = double(camInfo.hands.data(:, camInfo.hands.frame_offsets(frameNum)+1:camInfo.hands.frame_offsets(frameNum+1)));
+            else
+                cams.hands{iFrame,iCam} = double(camInfo.hands.(frameStr));
+            end
             
             % Products found: (4+Nproducts)x(# of products found in that frame) matrix
-            if ismember(frameStr, framesWithProds)
+            if isfield(prodInfo, 'version') && prodInfo.version >= 2  % v2 (ragged) layout: every frame's boxes and scores concatenated, frame n is columns offsets(n)+1:offsets(n+1)
+                iProds = prodInfo.frame_offsets(frameNum)+1:prodInfo.frame_offsets(frameNum+1);
+                cams.products{iFrame,iCam} = [double(prodInfo.boxes(:,iProds)); double(prodInfo.scores(:,iProds))];
+            elseif ismember(frameStr, framesWithProds)
                 cams.products{iFrame,iCam} = double(prodInfo.(frameStr));
             end
             
             % Background mask (since it uses 1280x720 = ~1MB per frame,
-            % don't load it unless we really need it -> Save filename only)
-            bgndMaskFileName = [EXP_PREFIX 'background_masks/' CAM_SUFFIX '_mask_' frameStr '.png'];
-            if loadBgndMask
-                cams.bgndMask{iFrame,iCam} = imread(bgndMaskFileName) > 127;
+            % don't load it unless we really need it -> Save filename only
+            % [or filename and frame number if stored in a single h5, see readBgndMask])
+            if hasMaskH5
+                if loadBgndMask
+                    cams.bgndMask{iFrame,iCam} = readBgndMask(maskH5FileName, frameNum);
+                else
+                    cams.bgndMask{iFrame,iCam} = struct('fileName',maskH5FileName, 'frameNum',frameNum);
+                end
             else
-                cams.bgndMask{iFrame,iCam} = bgndMaskFileName;
+                bgndMaskFileName = [EXP_PREFIX 'background_masks/' CAM_SUFFIX '_mask_' frameStr '.png'];
+                if loadBgndMask
+                    cams.bgndMask{iFrame,iCam} = imread(bgndMaskFileName) > 127;
+                else
+                    cams.bgndMask{iFrame,iCam} = bgndMaskFileName;
+                end
             end
         end
     end	
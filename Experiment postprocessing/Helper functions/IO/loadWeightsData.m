@@ -11,8 +11,14 @@ function [weights, experimentInfo] = loadWeightsData(tStr, experimentType, DATA_
 	data = readHDF5([DATA_FOLDER '/' experimentType '/' tStr '/weights_' tStr '.h5']);
     
     % Fill in time and weights info
-    weights.t = seconds(data.t) + parseStrDatetime(data.t_str{1}) - seconds(gt.weight_to_cam_t_offset_float);
     weights.w = double(permute(data.w, [1 3 2]));
+    if isfield(data, 'version') && data.version >= 2  % v2 layout: no timestamps stored, sample n was taken at t0 + n/F_samp
+        t0 = datetime(data.t0, 'ConvertFrom','posixtime', 'TimeZone','America/Los_Angeles');
+        t0.TimeZone = '';  % Same (local, unzoned) time reference as parseStrDatetime
+        weights.t = t0 + seconds((0:size(weights.w,1)-1)'/double(data.F_samp)) - seconds(gt.weight_to_cam_t_offset_float);
+    else
+        weights.t = seconds(data.t) + parseStrDatetime(data.t_str{1}) - seconds(gt.weight_to_cam_t_offset_float);
+    end
     weights = computeWeightMeanAndVar(weights, systemParams);
 	
 	% Fill in experimentInfo
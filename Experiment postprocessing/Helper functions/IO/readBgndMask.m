@@ -0,0 +1,8 @@
+function mask = readBgndMask(fileName, frameNum)
+    % Reads the background mask of frame frameNum (1-based) from a <video>_mask.h5 file (see mask_h5.py) as a height x width logical matrix
+    width = double(h5readatt(fileName, '/', 'width'));
+    packed = h5read(fileName, '/masks', [1 1 frameNum], [Inf Inf 1]);  % ceil(width/8) x height (dims are reversed wrt Python)
+    bits = bitget(repmat(packed, [1 1 8]), repmat(reshape(8:-1:1, 1,1,8), size(packed)));  % Each byte packs 8 consecutive pixels, MSB first
+    mask = logical(reshape(permute(bits, [3 1 2]), [], size(packed,2))');
+    mask = mask(:, 1:width);
+end
@@ -0,0 +1,252 @@
+from aux_tools import ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
+from contextlib import contextmanager
+from datetime import datetime
+import argparse
+import hashlib
+import fcntl
+import shutil
+import json
+import time
+import os
+
+
+# Every experiment folder has a manifest of the derived files (artifacts) preprocessing wrote: which stage made each of them, from which inputs (content hashes)
+# and with which parameters. An artifact is only reused if all of that still matches (instead of just because it exists). Regenerable artifacts (overlay
+# videos, mosaics, masks...) can be evicted least-recently-used first to keep the dataset under a size budget (see evict_lru)
+ARTIFACTS_MANIFEST_NAME = "artifacts_manifest.json"
+ARTIFACTS_MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20  # Bytes read at a time when hashing inputs
+
+
+def _walk_files(path):
+    """path itself if it's a file, otherwise every file under it (sorted)"""
+    if not os.path.isdir(path):
+        return [path]
+    filenames = []
+    for root, folders, files in os.walk(path):
+        folders.sort()
+        filenames.extend(os.path.join(root, f) for f in sorted(files))
+    return filenames
+
+
+def _fingerprint(path):
+    """Cheap stand-in for path's contents (size and mtime of every file), to know whether its content hash needs to be recomputed"""
+    stats = [(os.path.relpath(f, path), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in _walk_files(path)]
+    return hashlib.sha1(json.dumps(stats).encode('utf8')).hexdigest()
+
+
+def _content_hash(path):
+    h = hashlib.sha1()
+    for filename in _walk_files(path):
+        h.update(os.path.relpath(filename, path).encode('utf8') + b"\0")
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _disk_size(path):
+    return sum(os.path.getsize(f) for f in _walk_files(path)) if os.path.exists(path) else 0
+
+
+class ArtifactCache:
+    """Artifacts manifest of an experiment folder. Artifacts and inputs can be files or folders (e.g. <video>_pose/), anywhere (they're stored relative to
+    experiment_folder). Safe to use from several processes at once (e.g. ExperimentPreProcessor's pools): the manifest is locked while it's read or updated"""
+
+    def __init__(self, experiment_folder):
+        self.experiment_folder = experiment_folder
+        self.manifest_filename = os.path.join(experiment_folder, ARTIFACTS_MANIFEST_NAME)
+
+    @contextmanager
+    def _manifest(self, write=False):
+        with open(self.manifest_filename + ".lock", 'a') as f_lock:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+            try:
+                manifest = {"version": ARTIFACTS_MANIFEST_VERSION, "artifacts": {}, "hashes": {}}
+                if os.path.exists(self.manifest_filename):
+                    with open(self.manifest_filename) as f:
+                        manifest = json.load(f)
+                yield manifest
+                if write:  # (Write a new file and swap it in, so the manifest is never left half-written)
+                    with open(self.manifest_filename + ".tmp", 'w') as f:
+                        json.dump(manifest, f, indent=1, sort_keys=True)
+                    os.replace(self.manifest_filename + ".tmp", self.manifest_filename)
+            finally:
+                fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.experiment_folder)
+
+    def _abspath(self, relpath):
+        return os.path.normpath(os.path.join(self.experiment_folder, relpath))
+
+    def hash_inputs(self, inputs):
+        """{relpath: content hash (None if it doesn't exist)} of every input. Hashes are kept in the manifest, so files are only read again once they change"""
+        with self._manifest() as manifest:
+            known = dict(manifest["hashes"])
+        hashes, new_hashes = {}, {}
+        for path in inputs:
+            relpath = self._relpath(path)
+            if not os.path.exists(path):
+                hashes[relpath] = None
+                continue
+            fingerprint = _fingerprint(path)
+            if relpath in known and known[relpath][0] == fingerprint:
+                hashes[relpath] = known[relpath][1]
+            else:  # (Hash without holding the lock, big videos take a while)
+                hashes[relpath] = _content_hash(path)
+                new_hashes[relpath] = [fingerprint, hashes[relpath]]
+        if len(new_hashes) > 0:
+            with self._manifest(write=True) as manifest:
+                manifest["hashes"].update(new_hashes)
+        return hashes
+
+    def compute_key(self, stage, inputs, params, hashes=None):
+        """Hash of everything an artifact depends on: the stage that generates it, the contents of its inputs (hashes: hash_inputs(inputs), if already known)
+        and its parameters (must be json-serializable, anything that isn't, e.g. numpy dtypes, is converted with str)"""
+        description = {"stage": stage, "inputs": sorted((hashes if hashes is not None else self.hash_inputs(inputs)).items()), "params": params}
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+    def is_fresh(self, artifact, stage, inputs=(), params=None, adopt_untracked=True):
+        """Whether artifact exists and was generated by stage from the current contents of inputs with the same params (if so, marks it as just used).
+        Artifacts that exist but aren't in the manifest (e.g. generated before there was one) can't be checked against params: if adopt_untracked, they're
+        recorded as adopted (params=None) and trusted for as long as their inputs don't change. Cheap, regenerable artifacts whose params are easy to get
+        wrong (e.g. a multi-cam video's fps) should pass adopt_untracked=False instead, to regenerate them.
+        Artifacts whose inputs are gone (e.g. raw sensor data deleted after preprocessing) are kept too: they couldn't be regenerated anyway"""
+        if not os.path.exists(artifact):
+            return False
+        hashes = self.hash_inputs(inputs)  # (Before locking the manifest: hash_inputs needs the lock too)
+        key = self.compute_key(stage, inputs, params, hashes)
+        with self._manifest(write=True) as manifest:
+            entry = manifest["artifacts"].get(self._relpath(artifact))
+            if entry is None:
+                if not adopt_untracked:
+                    print("'{}' isn't in the artifacts manifest, regenerating it".format(artifact))
+                    return False
+                print("'{}' isn't in the artifacts manifest, assuming it's up to date".format(artifact))
+                entry = self._create_entry(artifact, stage, hashes, None, self.compute_key(stage, inputs, None, hashes))
+                entry["adopted"] = True
+                manifest["artifacts"][self._relpath(artifact)] = entry
+                return True
+            adopted_key = self.compute_key(stage, inputs, None, hashes) if entry.get("adopted") and adopt_untracked else None
+            if entry["key"] not in (key, adopted_key):
+                gone_inputs = self._gone_inputs(entry)
+                if len(gone_inputs) > 0:
+                    print("'{}' can't be regenerated ({} no longer exist), keeping it".format(artifact, ", ".join(gone_inputs)))
+                else:
+                    print("'{}' is stale ({} since it was generated)".format(artifact, self._describe_changes(entry, stage, hashes, params)))
+                    return False
+            entry["t_used"] = time.time()
+            return True
+
+    def _gone_inputs(self, entry):
+        return sorted(f for f, h in entry["inputs"].items() if h is not None and not os.path.exists(self._abspath(f)))
+
+    def _describe_changes(self, entry, stage, hashes, params):
+        changes = []
+        if entry["stage"] != stage:
+            changes.append("generated by '{}'".format(entry["stage"]))
+        old_params, new_params = json.loads(json.dumps(entry["params"], default=str)), json.loads(json.dumps(params, default=str))
+        if old_params != new_params:
+            if isinstance(old_params, dict) and isinstance(new_params, dict):
+                changes.append("parameters changed: {}".format(", ".join("{}={}->{}".format(k, old_params.get(k), new_params.get(k)) for k in sorted(set(old_params) | set(new_params)) if old_params.get(k) != new_params.get(k))))
+            else:
+                changes.append("parameters changed: {} -> {}".format(old_params, new_params))
+        changed_inputs = sorted(f for f in set(hashes) | set(entry["inputs"]) if hashes.get(f) != entry["inputs"].get(f))
+        if len(changed_inputs) > 0:
+            changes.append("inputs changed: {}{}".format(", ".join(changed_inputs[:5]), " (+{} more)".format(len(changed_inputs)-5) if len(changed_inputs) > 5 else ""))
+        return "; ".join(changes) or "unknown changes"
+
+    def _create_entry(self, artifact, stage, hashes, params, key, regenerable=False):
+        t = time.time()
+        return {"stage": stage, "key": key, "params": json.loads(json.dumps(params, default=str)), "inputs": hashes, "regenerable": regenerable,
+                "size": _disk_size(artifact), "t_created": t, "t_used": t}
+
+    def record(self, artifact, stage, inputs=(), params=None, regenerable=False):
+        """Adds artifact (just generated by stage from inputs with params) to the manifest. regenerable: whether evict_lru can delete it"""
+        hashes = self.hash_inputs(inputs)
+        entry = self._create_entry(artifact, stage, hashes, params, self.compute_key(stage, inputs, params, hashes), regenerable)
+        with self._manifest(write=True) as manifest:
+            manifest["artifacts"][self._relpath(artifact)] = entry
+
+    def invalidate(self, artifact):
+        """Deletes artifact (file or folder) and its manifest entry, e.g. before regenerating a stale one"""
+        if os.path.isdir(artifact):
+            shutil.rmtree(artifact)
+        elif os.path.exists(artifact):
+            os.remove(artifact)
+        with self._manifest(write=True) as manifest:
+            manifest["artifacts"].pop(self._relpath(artifact), None)
+
+    def status(self):
+        """Returns (artifact, entry, state) for every artifact in the manifest, where state is "fresh", "stale" (its inputs changed), "orphan" (some of its
+        inputs were deleted, so it can't be regenerated) or "missing" (deleted)"""
+        with self._manifest() as manifest:
+            artifacts = sorted(manifest["artifacts"].items())
+        result = []
+        for relpath, entry in artifacts:
+            artifact = self._abspath(relpath)
+            if not os.path.exists(artifact):
+                state = "missing"
+            elif len(self._gone_inputs(entry)) > 0:
+                state = "orphan"
+            else:
+                state = "fresh" if self.compute_key(entry["stage"], [self._abspath(f) for f in entry["inputs"]], entry["params"]) == entry["key"] else "stale"
+            result.append((artifact, entry, state))
+        return result
+
+
+def evict_lru(caches, max_size):
+    """Deletes regenerable artifacts of all caches, least recently used first, until they add up to at most max_size bytes. Returns the bytes freed"""
+    candidates = []
+    for cache in caches:
+        with cache._manifest() as manifest:
+            candidates.extend((entry["t_used"], cache._abspath(relpath), entry["size"], cache) for relpath, entry in manifest["artifacts"].items() if entry["regenerable"])
+    total_size = sum(size for _, _, size, _ in candidates)
+    freed = 0
+    for _, artifact, size, cache in sorted(candidates, key=lambda c: c[0]):
+        if total_size - freed <= max_size: break
+        print("Evicting '{}' ({:.1f}MB)".format(artifact, size/1e6))
+        cache.invalidate(artifact)
+        freed += size
+    print("Evicted {:.1f}MB of regenerable artifacts, {:.1f}MB left (budget: {:.1f}MB)".format(freed/1e6, (total_size-freed)/1e6, max_size/1e6))
+    return freed
+
+
+class ArtifactCacheInspector(ExperimentTraverser):
+    def __init__(self, main_folder, start_datetime=datetime.min, end_datetime=datetime.max, max_size=None, forget_stale=False):
+        super(ArtifactCacheInspector, self).__init__(main_folder, start_datetime, end_datetime)
+        self.max_size = max_size
+        self.forget_stale = forget_stale
+        self.caches = []
+
+    def process_subfolder(self, f):
+        cache = ArtifactCache(os.path.join(self.main_folder, f))
+        self.caches.append(cache)
+        print("Experiment {}:".format(f))
+        for artifact, entry, state in cache.status():
+            print("\t[{:7s}] {} ({}, {:.1f}MB{}, last used {})".format(state, os.path.relpath(artifact, cache.experiment_folder), entry["stage"], entry["size"]/1e6, ", regenerable" if entry["regenerable"] else "",
+                                                                       datetime.fromtimestamp(entry["t_used"]).strftime("%Y-%m-%d %H:%M:%S")))
+            if self.forget_stale and state in ("stale", "missing"):
+                cache.invalidate(artifact)
+
+    def on_done(self):
+        if self.max_size is not None:
+            evict_lru(self.caches, self.max_size)
+
+
+if __name__ == "__main__":
+    from aux_tools import str2bool
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", default="Dataset/Evaluation", help="Folder containing the experiment(s) whose artifacts to list (and evict)")
+    parser.add_argument("-s", "--start-datetime", default="", help="Only consider experiments collected later than this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument("-e", "--end-datetime", default="", help="Only consider experiments collected before this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument('-m', "--max-gb", default=None, type=float, help="If set, evict regenerable artifacts (least recently used first) until they take up at most this many GB")
+    parser.add_argument('-f', "--forget-stale", default=False, type=str2bool, help="Whether or not to delete stale (and forget missing) artifacts")
+    args = parser.parse_args()
+
+    t_start = datetime.strptime(args.start_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.start_datetime) > 0 else datetime.min
+    t_end = datetime.strptime(args.end_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.end_datetime) > 0 else datetime.max
+
+    ArtifactCacheInspector(args.folder, t_start, t_end, args.max_gb*1e9 if args.max_gb is not None else None, args.forget_stale).run()
@@ -4,7 +4,7 @@ import argparse
 import pytz
 import os
 from enum import Enum
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil import parser as dateparser
 
 # Python 2-3 compatibility
@@ -80,6 +80,20 @@ def format_axis_as_timedelta(axis):  # E.g. axis=ax.xaxis
 
     axis.set_major_formatter(plt.FuncFormatter(lambda x, pos: timedelta2str(timedelta(seconds=x))))
 
+def create_pool(num_workers, use_threads=False):
+    from multiprocessing import Pool, current_process
+    from multiprocessing.pool import ThreadPool
+
+    # Daemonic processes (e.g. workers of another Pool) aren't allowed to have children -> Fall back to threads
+    if use_threads or current_process().daemon:
+        return ThreadPool(processes=num_workers)
+    return Pool(processes=num_workers)
+
+def split_worker_budget(num_workers, threads_per_task, num_tasks=None):
+    """How many tasks (each keeping threads_per_task threads busy) to run at once so they share num_workers cores instead of oversubscribing them (at least 1)"""
+    num_concurrent = max(num_workers // threads_per_task, 1)
+    return num_concurrent if num_tasks is None else max(min(num_concurrent, num_tasks), 1)
+
 def get_nonempty_input(msg):
     out = ""
     while len(out) < 1:
@@ -87,6 +101,16 @@ def get_nonempty_input(msg):
     return out
 
 def date_range(t_start, t_end, t_delta):
+    if isinstance(t_start, datetime):  # Datetime objects -> Python generator (slow, only meant for a handful of values)
+        return _datetime_range(t_start, t_end, t_delta)
+
+    # Numeric epoch timestamps (float seconds) -> Fully vectorized
+    dt = t_delta.total_seconds() if isinstance(t_delta, timedelta) else float(t_delta)
+    if dt == 0:
+        raise Exception("Infinite loop!! t_delta can't be 0 (are you dividing two ints?)")
+    return t_start + dt*np.arange(max(int(np.ceil((t_end-t_start)/dt)), 0))
+
+def _datetime_range(t_start, t_end, t_delta):
     if t_delta.total_seconds() == 0:
         raise Exception("Infinite loop!! t_delta can't be 0 (are you dividing two ints?)")
 
@@ -95,14 +119,67 @@ def date_range(t_start, t_end, t_delta):
         yield t
         t += t_delta
 
+def is_epoch_array(t_arr):
+    return isinstance(t_arr, np.ndarray) and np.issubdtype(t_arr.dtype, np.number)
+
+def epoch_to_datetime(t, tz=DEFAULT_TIMEZONE):
+    return datetime.fromtimestamp(t, tz=tz)
+
+def datetime_to_epoch(t, tz=DEFAULT_TIMEZONE):
+    return (tz.localize(t) if tz is not None and t.tzinfo is None else t).timestamp()
+
+def epoch_to_str(t_arr, tz=DEFAULT_TIMEZONE):
+    t_arr = np.asarray(t_arr, dtype=np.float64)
+    if len(t_arr) == 0:
+        return np.array([], dtype='S1')
+    t_first, t_last = epoch_to_datetime(t_arr[0], tz), epoch_to_datetime(t_arr[-1], tz)
+    if t_first.utcoffset() != t_last.utcoffset():  # Crossed a DST change -> Fall back to one datetime per sample
+        return np.array([str(epoch_to_datetime(t, tz)).encode('utf8') for t in t_arr])
+
+    # Same UTC offset for the whole array -> Shift to local time and let numpy format everything at once
+    offset = t_first.utcoffset().total_seconds() if t_first.utcoffset() is not None else 0
+    t_local = np.round((t_arr+offset)*1e6).astype(np.int64).astype('datetime64[us]')
+    t_str = np.char.replace(np.datetime_as_string(t_local, unit='us'), 'T', ' ')
+    if t_first.tzinfo is not None:
+        t_str = np.char.add(t_str, t_first.isoformat()[-6:])  # E.g. "-07:00"
+    return np.char.encode(t_str, 'utf8')
+
 def time_to_float(t_arr, t_ref=None):
     if t_ref is None: t_ref = t_arr[0]
+    if is_epoch_array(t_arr):
+        return t_arr - (datetime_to_epoch(t_ref) if isinstance(t_ref, datetime) else t_ref)
     return [(t-t_ref).total_seconds() for t in t_arr]
 
 def save_datetime_to_h5(t_arr, h5_handle, field_name):
+    if is_epoch_array(t_arr):  # Numeric epoch timestamps -> Avoid creating a datetime per sample
+        h5_handle.create_dataset(field_name, data=t_arr-t_arr[0])
+        h5_handle.create_dataset(field_name + "_str", data=epoch_to_str(t_arr))
+        return
     h5_handle.create_dataset(field_name, data=[(t-t_arr[0]).total_seconds() for t in t_arr])
     h5_handle.create_dataset(field_name + "_str", data=[str(t).encode('utf8') for t in t_arr])
 
+def append_to_h5(h5_handle, field_name, data, axis=-1):
+    """Appends data along axis to a resizable dataset (creates it first if it doesn't exist)"""
+    data = np.asarray(data)
+    axis = axis % data.ndim
+    if field_name not in h5_handle:
+        h5_handle.create_dataset(field_name, shape=data.shape[:axis] + (0,) + data.shape[axis+1:], maxshape=data.shape[:axis] + (None,) + data.shape[axis+1:], dtype=data.dtype, chunks=True)
+    dataset = h5_handle[field_name]
+    n = dataset.shape[axis]
+    dataset.resize(n + data.shape[axis], axis=axis)
+    dataset[(slice(None),)*axis + (slice(n, None),)] = data
+
+def append_datetime_to_h5(t_arr, h5_handle, field_name):
+    """Same as save_datetime_to_h5 (t_arr must be float epochs), but creates resizable datasets and appends to them if they already exist"""
+    if len(t_arr) == 0:
+        return
+    if field_name not in h5_handle:
+        append_to_h5(h5_handle, field_name, np.zeros(0))
+        h5_handle[field_name].attrs['t0'] = t_arr[0]  # Keep the epoch of the first sample so t can always be stored relative to it
+
+    append_to_h5(h5_handle, field_name, t_arr-h5_handle[field_name].attrs['t0'])
+    append_to_h5(h5_handle, field_name + "_str", epoch_to_str(t_arr))
+
 def str_to_datetime(str_dt, tz=DEFAULT_TIMEZONE):
     t = dateparser.parse(str_dt.decode('utf8'))
     return tz.localize(t) if tz is not None and t.tzinfo is None else t
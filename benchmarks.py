@@ -0,0 +1,418 @@
+import numpy as np
+from aux_tools import datetime_to_epoch, EXPERIMENT_DATETIME_STR_FORMAT
+from synthetic_experiment import write_synthetic_weight_segments, SYNTHETIC_T_START
+from multiprocessing import cpu_count
+from contextlib import contextmanager
+import argparse
+import tempfile
+import shutil
+import time
+import os
+
+
+BENCHMARK_T_START = SYNTHETIC_T_START
+
+
+@contextmanager
+def temp_experiment_folder(keep=False):
+    main_folder = tempfile.mkdtemp(prefix="aim3s_benchmark_")
+    experiment_folder = os.path.join(main_folder, BENCHMARK_T_START.strftime(EXPERIMENT_DATETIME_STR_FORMAT))
+    os.makedirs(experiment_folder)
+    try:
+        yield experiment_folder
+    finally:
+        if keep:
+            print("Benchmark data kept at '{}'".format(experiment_folder))
+        else:
+            shutil.rmtree(main_folder)
+
+
+def _time_it(f, *args, **kwargs):
+    t = time.time()
+    out = f(*args, **kwargs)
+    return time.time()-t, out
+
+
+def benchmark_parallel_ingest(duration=600, num_workers=cpu_count(), keep=False):
+    from read_dataset import read_weights_data
+
+    with temp_experiment_folder(keep) as experiment_folder:
+        print("Writing {}s of synthetic weight segments (8 shelves x 12 plates)...".format(duration))
+        write_synthetic_weight_segments(experiment_folder, duration=duration)
+
+        t_serial, (t, w, _) = _time_it(read_weights_data, experiment_folder)
+        print("Serial: {:.2f}s".format(t_serial))
+        for use_threads in (False, True):
+            t_parallel, (t_p, w_p, _) = _time_it(read_weights_data, experiment_folder, num_workers=num_workers, use_threads=use_threads)
+            assert np.array_equal(t, t_p) and np.array_equal(w, w_p), "Parallel ingest doesn't match serial ingest!"
+            print("Parallel ({} {}): {:.2f}s -> {:.2f}X speedup".format(num_workers, "threads" if use_threads else "processes", t_parallel, t_serial/t_parallel))
+
+
+def benchmark_chunked_ingest(duration=300, chunk_duration=20, overlap=2, gap=5, num_workers=cpu_count(), keep=False):
+    from read_dataset import read_weights_data, iter_resampled_weights, list_weight_segments
+    import glob
+
+    with temp_experiment_folder(keep) as experiment_folder:
+        print("Writing {}s of synthetic weight segments (8 shelves x 12 plates), with a {}s gap in every other plate...".format(duration, gap))
+        write_synthetic_weight_segments(experiment_folder, duration=duration)
+        for sensor_folder in sorted(glob.glob(os.path.join(experiment_folder, "sensors_*")))[::2]:  # Gap right where a window starts, longer than overlap
+            segments = list_weight_segments(sensor_folder)
+            t_gap = float(os.path.basename(segments[0])) + chunk_duration - gap/2.0
+            for filename in segments:
+                if t_gap <= float(os.path.basename(filename)) < t_gap + gap:
+                    os.remove(filename)
+
+        t_full, (t, w, _) = _time_it(read_weights_data, experiment_folder)
+        print("In memory: {:.2f}s".format(t_full))
+        for workers in (1, num_workers):
+            t_chunked, windows = _time_it(lambda: list(iter_resampled_weights(experiment_folder, chunk_duration=chunk_duration, overlap=overlap, num_workers=workers)))
+            t_c, w_c = np.hstack([t_k for t_k, _, _ in windows]), np.concatenate([w_k for _, w_k, _ in windows], axis=-1)
+            assert np.array_equal(t, t_c), "Chunked ingest doesn't return the same timestamps as in-memory ingest!"
+            max_diff = np.abs(w - w_c).max()
+            assert max_diff < 1.0, "Chunked ingest deviates {:.3f}g from in-memory ingest!".format(max_diff)
+            print("Chunked ({} workers, {}s windows): {:.2f}s, max deviation from in-memory: {:.4f}g".format(workers, chunk_duration, t_chunked, max_diff))
+
+
+def benchmark_resampling(duration=600, F_src=60, F_dst=(60, 30, 10), num_repeats=3, seed=0):
+    from read_dataset import resample_weight, RESAMPLE_MODES
+
+    # Synthetic load cell signal: a few smoothed steps (items picked up/put back) plus slow drift, sampled with jittered timestamps
+    rng = np.random.RandomState(seed)
+    t_events = np.sort(rng.uniform(0, duration, int(duration/10)))
+    w_events = rng.choice((-1, 1), len(t_events)) * rng.uniform(50, 500, len(t_events))
+    signal = lambda t: np.sum(w_events[:, None] * 0.5*(1 + np.tanh((t[None, :]-t_events[:, None])/0.4)), axis=0) + 5*np.sin(2*np.pi*0.05*t)
+    t_src = np.arange(0, duration, 1.0/F_src) + rng.normal(0, 0.1/F_src, int(np.ceil(duration*F_src)))
+    t_src.sort()
+    w_src = (signal(t_src) + rng.normal(0, 0.5, len(t_src))).astype(np.float32)
+
+    print("{:>10s} {:>6s} {:>12s} {:>10s}".format("Mode", "F_dst", "Msamples/s", "RMSE (g)"))
+    for f_dst in F_dst:
+        t_dst = np.arange(1, duration-1, 1.0/f_dst)  # Stay away from the edges so every mode has data on both sides
+        w_true = signal(t_dst)
+        for mode in RESAMPLE_MODES:
+            t_elapsed = min(_time_it(resample_weight, t_src, w_src, t_dst, mode)[0] for _ in range(num_repeats))
+            w_dst = resample_weight(t_src, w_src, t_dst, mode)
+            print("{:>10s} {:>6d} {:>12.2f} {:>10.3f}".format(mode, f_dst, len(t_src)/t_elapsed/1e6, np.sqrt(np.mean((w_dst-w_true)**2))))
+
+
+def synthetic_shelf_weights(duration=600, F_samp=60, num_shelves=8, num_plates=12, events_per_minute=5, seed=0):
+    """Returns (t, w) like read_weights_data: steps (items picked up/put back) on random plates, with bursts of noise while the shelf is being touched"""
+    rng = np.random.RandomState(seed)
+    N = int(duration*F_samp)
+    t = datetime_to_epoch(BENCHMARK_T_START) + np.arange(N)/float(F_samp)
+    w = np.tile(rng.uniform(0, 2000, (num_shelves, num_plates, 1)), (1, 1, N))
+    for shelf in range(num_shelves):
+        for _ in range(int(events_per_minute*duration/60)):
+            plate, n = rng.randint(num_plates), rng.randint(N)
+            n_touch = rng.randint(F_samp//2, 5*F_samp)
+            w[shelf, plate, n:] += rng.choice((-1, 1)) * rng.uniform(20, 600)
+            w[shelf, plate, n:n+n_touch] += rng.normal(0, 300, len(w[shelf, plate, n:n+n_touch]))
+    w += rng.normal(0, 1, w.shape)
+    return t, w.astype(np.float32)
+
+
+def benchmark_weight_events(duration=3600, chunk_durations=(0.1, 1, 60), F_samp=60):
+    from weight_events import detect_weight_events, WeightEventDetector
+
+    t, w = synthetic_shelf_weights(duration, F_samp)
+    num_samples = w.size
+    t_batch, events = _time_it(detect_weight_events, t, w)
+    print("Batch: {} events, {:.2f}M plate samples/s".format(len(events), num_samples/t_batch/1e6))
+
+    sort_key = lambda e: (e['shelf'], e['nB'])
+    events = sorted(events, key=sort_key)
+    for chunk_duration in chunk_durations:
+        chunk_len = max(int(chunk_duration*F_samp), 1)
+        detector = WeightEventDetector()
+        events_stream = []
+        t_start = time.time()
+        for n in range(0, len(t), chunk_len):
+            events_stream.extend(detector.push(t[n:n+chunk_len], w[..., n:n+chunk_len]))
+        events_stream.extend(detector.finish())
+        t_stream = time.time()-t_start
+
+        events_stream = sorted(events_stream, key=sort_key)
+        assert len(events) == len(events_stream) and all(
+            all(e[k] == e_s[k] for k in ('tB', 'tE', 'nB', 'nE', 'deltaW', 'shelf')) and all(np.array_equal(b, b_s) for b, b_s in zip(e['bins'], e_s['bins']))
+            for e, e_s in zip(events, events_stream)), "Streaming events don't match batch events!"
+        print("Streaming ({}s chunks): {:.2f}M plate samples/s ({:.0f}X real time)".format(chunk_duration, num_samples/t_stream/1e6, duration/t_stream))
+
+
+def benchmark_bin_pyramid(duration=3600, bin_widths=(1, 2, 3, 4, 6), num_sweeps=5, F_samp=60):
+    from weight_events import WeightBinPyramid, MovingMeanAndVar, aggregate_weights_into_bins
+
+    t, w = synthetic_shelf_weights(duration, F_samp)
+    bin_widths = list(bin_widths) + [None]  # None -> Whole shelf
+
+    def per_bin_width():  # Same as aggregateWeightsIntoBins.m: aggregate and compute the moving stats again for every bin width
+        out = []
+        for bin_width in bin_widths:
+            w_shelf, w_bins = aggregate_weights_into_bins(np.moveaxis(w, -1, 0), [bin_width or w.shape[1]])
+            w_mean, w_var = MovingMeanAndVar(60).push(w_bins[0].reshape(len(w_bins[0]), -1), is_last=True)
+            out.append((np.moveaxis(w_mean.reshape(w_bins[0].shape), 0, -1), np.moveaxis(w_var.reshape(w_bins[0].shape), 0, -1)))
+        return out
+
+    def pyramid_sweep(pyramid):
+        return [pyramid.get_mean_and_var(bin_width) for bin_width in bin_widths]
+
+    t_baseline, out = _time_it(lambda: [per_bin_width() for _ in range(num_sweeps)][-1])
+    t_build, pyramid = _time_it(WeightBinPyramid, w)
+    t_pyramid, out_pyramid = _time_it(lambda: [pyramid_sweep(pyramid) for _ in range(num_sweeps)][-1])
+    for (w_mean, w_var), (w_mean_p, w_var_p) in zip(out, out_pyramid):
+        assert np.allclose(w_mean, w_mean_p, atol=1e-6) and np.allclose(w_var, w_var_p, atol=1e-4), "Bin pyramid doesn't match per-bin-width aggregation!"
+    print("Per bin width ({} sweeps): {:.2f}s".format(num_sweeps, t_baseline))
+    print("Bin pyramid ({} sweeps): {:.2f}s ({:.2f}s to build) -> {:.2f}X speedup".format(num_sweeps, t_build+t_pyramid, t_build, t_baseline/(t_build+t_pyramid)))
+
+
+def benchmark_multicam_decode(duration=600, video_fps=25, cam_fps=30, resolution=(320, 180), keep=False):
+    import cv2
+    from synthetic_experiment import generate_synthetic_experiment
+    from generate_video import get_multicam_frame_nums
+    from video_io import SequentialVideoReader
+
+    with temp_experiment_folder(keep) as experiment_folder:
+        shutil.rmtree(experiment_folder)  # generate_synthetic_experiment creates it
+        generate_synthetic_experiment(os.path.dirname(experiment_folder), BENCHMARK_T_START, duration, fps=cam_fps, resolution=resolution, video_noise_std=0)
+        t_cam, frame_nums = get_multicam_frame_nums(experiment_folder, video_fps)
+        video_filenames = [os.path.join(experiment_folder, "cam{}_{}.mp4".format(cam+1, os.path.basename(experiment_folder))) for cam in range(len(frame_nums))]
+
+        def decode_with_seeks():  # What generate_multicam_video used to do: seek every camera on every output frame
+            videos_in = [cv2.VideoCapture(f) for f in video_filenames]
+            checksums = np.zeros(frame_nums.shape, dtype=np.int64)
+            for n in range(frame_nums.shape[1]):
+                for i, video_in in enumerate(videos_in):
+                    video_in.set(cv2.CAP_PROP_POS_FRAMES, frame_nums[i, n])
+                    checksums[i, n] = int(video_in.read()[1].sum(dtype=np.int64))
+            return checksums
+
+        def decode_sequentially():
+            videos_in = [SequentialVideoReader(f) for f in video_filenames]
+            checksums = np.zeros(frame_nums.shape, dtype=np.int64)
+            for n in range(frame_nums.shape[1]):
+                for i, video_in in enumerate(videos_in):
+                    checksums[i, n] = int(video_in.read(frame_nums[i, n])[1].sum(dtype=np.int64))
+            print("Sequential reader decoded {} frames ({} output frames x {} cams) with {} seeks".format(sum(v.num_decoded for v in videos_in), frame_nums.shape[1], len(videos_in), sum(v.num_seeks for v in videos_in)))
+            return checksums
+
+        t_seek, checksums = _time_it(decode_with_seeks)
+        print("Seek every frame: {:.2f}s ({:.1f} output fps)".format(t_seek, frame_nums.shape[1]/t_seek))
+        t_sequential, checksums_sequential = _time_it(decode_sequentially)
+        print("Sequential: {:.2f}s ({:.1f} output fps) -> {:.2f}X speedup".format(t_sequential, frame_nums.shape[1]/t_sequential, t_seek/t_sequential))
+        assert np.array_equal(checksums, checksums_sequential), "Sequential decoding doesn't return the same frames as seeking!"
+
+
+def benchmark_camera_timing(duration=3600, cam_fps=30, video_fps=25, num_cams=4, keep=False):
+    import h5py
+    from scipy.interpolate import interp1d
+    from aux_tools import save_datetime_to_h5, str_to_datetime, date_range, time_to_float
+    from generate_video import get_multicam_frame_nums
+    from datetime import timedelta
+
+    with temp_experiment_folder(keep) as experiment_folder:
+        rng = np.random.RandomState(0)
+        t_experiment_start = os.path.basename(experiment_folder)
+        for cam in range(num_cams):
+            t_frames = datetime_to_epoch(BENCHMARK_T_START) + rng.uniform(0, 0.5) + np.arange(int(duration*cam_fps))/float(cam_fps) + rng.normal(0, 0.002, int(duration*cam_fps))
+            t_frames = np.round(np.sort(t_frames), 6)  # Same resolution as t_str (like record_cams.py)
+            with h5py.File(os.path.join(experiment_folder, "cam{}_{}.h5".format(cam+1, t_experiment_start)), 'w') as f_hdf5:
+                save_datetime_to_h5(t_frames, f_hdf5, "t")
+        print("Wrote timestamps of {} cameras ({}s at {}fps)".format(num_cams, duration, cam_fps))
+
+        def parse_every_timestamp():  # What get_multicam_frame_nums used to do: one datetime per frame + interp1d over Python floats
+            camera_timestamps = []
+            for cam in range(num_cams):
+                with h5py.File(os.path.join(experiment_folder, "cam{}_{}.h5".format(cam+1, t_experiment_start)), 'r') as camera_info:
+                    camera_timestamps.append(np.array([str_to_datetime(t) for t in camera_info.get("t_str")]))
+            t_latest_start = max(t[0] for t in camera_timestamps)
+            t_cam = np.array(list(date_range(t_latest_start, min(t[-1] for t in camera_timestamps), timedelta(seconds=1.0/video_fps))))
+            to_float = lambda t_arr: np.array(time_to_float(t_arr, t_latest_start))
+            return np.array([interp1d(to_float(t), range(len(t)), kind='nearest', copy=False, assume_sorted=True)(to_float(t_cam)) for t in camera_timestamps])
+
+        t_parse, frame_nums = _time_it(parse_every_timestamp)
+        print("Parse every t_str + interp1d: {:.2f}s".format(t_parse))
+        t_vectorized, (t_cam, frame_nums_vectorized) = _time_it(get_multicam_frame_nums, experiment_folder, video_fps, num_cams)
+        print("Numeric t + searchsorted: {:.3f}s -> {:.0f}X speedup".format(t_vectorized, t_parse/t_vectorized))
+        num_frames = min(frame_nums.shape[1], frame_nums_vectorized.shape[1])  # Both timelines may differ by a frame at the very end
+        assert np.array_equal(frame_nums[:, :num_frames], frame_nums_vectorized[:, :num_frames]), "Vectorized frame numbers don't match!"
+
+
+def benchmark_weight_overlay(duration=600, num_frames=250, video_fps=25, t_lims=4):
+    import matplotlib
+    matplotlib.use('Agg')
+    from aux_tools import plt_fig_to_cv2_img
+    from generate_video import create_weight_figure
+    from weight_overlay import WeightOverlayRenderer
+
+    t, w = synthetic_shelf_weights(duration)
+    fig, ax, curr_t_lines = create_weight_figure(t-t[0], w.sum(axis=1), figsize=(3.5,5))  # Same figure generate_video overlays on multi-cam videos
+    curr_t = t_lims + np.arange(num_frames)/float(video_fps)
+
+    def matplotlib_overlay():  # What generate_video used to do: redraw the whole figure on every frame
+        imgs = []
+        for t_frame in curr_t:
+            ax[-1,0].set_xlim(t_frame-t_lims, t_frame+t_lims)
+            for l in curr_t_lines: l.set_xdata(t_frame)
+            fig.canvas.draw()
+            imgs.append(plt_fig_to_cv2_img(fig))
+        return imgs
+
+    t_matplotlib, imgs = _time_it(matplotlib_overlay)
+    print("Matplotlib redraw: {:.2f}ms/frame".format(1e3*t_matplotlib/num_frames))
+    t_build, weight_overlay = _time_it(WeightOverlayRenderer, fig, ax, t_lims)
+    t_fast, imgs_fast = _time_it(lambda: [weight_overlay.render(t_frame).copy() for t_frame in curr_t])
+    print("Pre-rasterized overlay: {:.2f}ms/frame (+{:.2f}s setup) -> {:.0f}X speedup".format(1e3*t_fast/num_frames, t_build, t_matplotlib/t_fast))
+    print("Mean absolute pixel difference: {:.2f} (out of 255)".format(np.mean([np.abs(img.astype(np.int16)-img_fast).mean() for img, img_fast in zip(imgs, imgs_fast)])))
+
+
+def synthetic_masks(num_frames=500, resolution=(1280, 720), num_people=2, seed=0, speckle=0.002):
+    """Background-subtraction-like masks (0/255): a few person-sized blobs moving around plus some speckle noise (fraction of pixels)"""
+    import cv2
+    rng = np.random.RandomState(seed)
+    w, h = resolution
+    centers = rng.rand(num_people, 2)*(w, h)
+    velocities = rng.randn(num_people, 2)*5
+    masks = np.zeros((num_frames, h, w), dtype=np.uint8)
+    for n in range(num_frames):
+        centers = np.mod(centers + velocities, (w, h))
+        for x, y in centers:
+            cv2.ellipse(masks[n], (int(x), int(y)), (w//16, h//5), 0, 0, 360, 255, -1)
+        if speckle > 0:
+            masks[n][rng.rand(h, w) < speckle] = 255
+    return masks
+
+
+def benchmark_mask_store(num_frames=500, resolution=(1280, 720), keep=False):
+    import cv2
+    from preprocess_experiments import HDF5_FRAME_NAME_FORMAT, BACKGROUND_MASKS_FOLDER_NAME
+    from mask_h5 import MaskH5Writer, MaskH5Reader, MASK_H5_SUFFIX
+
+    masks = synthetic_masks(num_frames, resolution)
+    with temp_experiment_folder(keep) as experiment_folder:
+        video_prefix = os.path.join(experiment_folder, "cam1_{}".format(os.path.basename(experiment_folder)))
+        mask_prefix = os.path.join(experiment_folder, BACKGROUND_MASKS_FOLDER_NAME, os.path.basename(video_prefix) + "_mask")
+        os.makedirs(os.path.dirname(mask_prefix))
+
+        def write_pngs():  # What BackgroundSubtractionStage used to do: encode one png per frame, synchronously
+            for n, mask in enumerate(masks):
+                cv2.imwrite("{}_{}.png".format(mask_prefix, HDF5_FRAME_NAME_FORMAT.format(n+1)), mask)
+
+        def write_h5():
+            mask_writer = MaskH5Writer(video_prefix + MASK_H5_SUFFIX, resolution[0], resolution[1])
+            t_write, _ = _time_it(lambda: [mask_writer.write(mask) for mask in masks])
+            mask_writer.close()
+            return t_write
+
+        t_png, _ = _time_it(write_pngs)
+        png_size = sum(os.path.getsize(os.path.join(os.path.dirname(mask_prefix), png)) for png in os.listdir(os.path.dirname(mask_prefix)))
+        print("Pngs: {:.2f}ms/frame, {} files, {:.1f}MB".format(1e3*t_png/num_frames, num_frames, png_size/1e6))
+        t_h5, t_h5_caller = _time_it(write_h5)
+        print("Bit-packed h5: {:.2f}ms/frame ({:.2f}ms/frame blocking the caller), 1 file, {:.1f}MB".format(1e3*t_h5/num_frames, 1e3*t_h5_caller/num_frames, os.path.getsize(video_prefix + MASK_H5_SUFFIX)/1e6))
+
+        frames = np.random.RandomState(0).randint(num_frames, size=min(num_frames, 100))
+        t_png_read, png_masks = _time_it(lambda: [cv2.imread("{}_{}.png".format(mask_prefix, HDF5_FRAME_NAME_FORMAT.format(n+1)), cv2.IMREAD_GRAYSCALE) > 127 for n in frames])
+        with MaskH5Reader(video_prefix + MASK_H5_SUFFIX) as reader:
+            t_h5_read, h5_masks = _time_it(lambda: [reader.read_frame(n) for n in frames])
+        print("Random frame reads: {:.2f}ms/frame (pngs) vs {:.2f}ms/frame (h5), identical masks: {}".format(1e3*t_png_read/len(frames), 1e3*t_h5_read/len(frames), all(np.array_equal(a, b) for a, b in zip(png_masks, h5_masks))))
+
+
+def benchmark_bgnd_subtraction(num_frames=200, resolution=(1280, 720), scales=(1.0, 0.5, 0.25), algorithms=None, seed=0):
+    import cv2
+    from preprocess_experiments import BackgroundSubtractor, BACKGROUND_SUBTRACTION_ALGORITHMS
+
+    # Synthetic video: static textured background + person-sized blobs moving around (ground truth foreground) + sensor noise
+    rng = np.random.RandomState(seed)
+    w, h = resolution
+    background = cv2.GaussianBlur(rng.randint(256, size=(h, w, 3)).astype(np.uint8), (0, 0), 5)
+    foreground = synthetic_masks(num_frames, resolution, seed=seed, speckle=0) > 0
+    noise = rng.randn(8, h, w, 3)*3  # (Cycle through a few noise frames, generating a new one for every frame would dominate the benchmark)
+
+    def frames():
+        for n in range(num_frames):
+            frame = np.clip(background + noise[n % len(noise)], 0, 255).astype(np.uint8)
+            frame[foreground[n]] = (40, 90, 160)
+            yield n, frame
+
+    n_eval = num_frames//2  # Let the models learn the background during the first half
+    for algorithm in (algorithms or BACKGROUND_SUBTRACTION_ALGORITHMS.keys()):
+        masks_full_res = None
+        for scale in sorted(scales, reverse=True):
+            try:
+                bgnd_subtractor = BackgroundSubtractor(algorithm, scale)
+            except AttributeError:
+                print("{}: not available (needs opencv-contrib), skipping".format(algorithm))
+                break
+            t_total, iou, masks = 0.0, [], []
+            for n, frame in frames():
+                t, mask = _time_it(bgnd_subtractor.run, frame)
+                t_total += t
+                if n >= n_eval:
+                    mask = mask > 127
+                    iou.append(np.logical_and(mask, foreground[n]).sum() / float(max(np.logical_or(mask, foreground[n]).sum(), 1)))
+                    masks.append(np.packbits(mask))
+            if masks_full_res is None:
+                masks_full_res = masks
+            agreement = np.mean([1 - np.unpackbits(np.bitwise_xor(a, b)).mean() for a, b in zip(masks, masks_full_res)])
+            print("{} @ scale {}: {:.1f} frames/s, IoU vs ground truth {:.3f}, pixel agreement vs scale {} {:.2f}%".format(algorithm, scale, num_frames/t_total, np.mean(iou), max(scales), 100*agreement))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', "--keep", default=False, action="store_true", help="Add this flag to keep the synthetic data on disk after the benchmark")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    parser_ingest = subparsers.add_parser("parallel_ingest", help="Serial vs parallel protobuf segment decoding")
+    parser_ingest.add_argument('-d', "--duration", default=600, type=float, help="Duration (in s) of the synthetic experiment")
+    parser_ingest.add_argument('-n', "--num-workers", default=cpu_count(), type=int, help="Number of parallel decoding workers")
+    parser_chunked = subparsers.add_parser("chunked_ingest", help="In-memory vs chunked (streaming) weight ingest, with gaps in the data (identical timestamps, max deviation)")
+    parser_chunked.add_argument('-d', "--duration", default=300, type=float, help="Duration (in s) of the synthetic experiment")
+    parser_chunked.add_argument('-c', "--chunk-duration", default=20, type=float, help="Duration (in s) of each streamed window")
+    parser_chunked.add_argument('-g', "--gap", default=5, type=float, help="Duration (in s) of the gap in the data of every other plate (longer than the 2s overlap)")
+    parser_chunked.add_argument('-n', "--num-workers", default=cpu_count(), type=int, help="Number of parallel decoding workers")
+    parser_resampling = subparsers.add_parser("resampling", help="Throughput and reconstruction error of each weight resampling mode")
+    parser_resampling.add_argument('-d', "--duration", default=600, type=float, help="Duration (in s) of the synthetic signal")
+    parser_resampling.add_argument('-r', "--fps", dest="F_dst", nargs='+', default=[60, 30, 10], type=int, help="Output sampling rate(s) to benchmark")
+    parser_events = subparsers.add_parser("weight_events", help="Batch vs streaming weight event detection (throughput and identical results)")
+    parser_events.add_argument('-d', "--duration", default=3600, type=float, help="Duration (in s) of the synthetic experiment")
+    parser_events.add_argument('-c', "--chunk-durations", nargs='+', default=[0.1, 1, 60], type=float, help="Duration(s) (in s) of the chunks streamed through the detector")
+    parser_pyramid = subparsers.add_parser("bin_pyramid", help="Per-bin-width aggregation vs prefix-sum bin pyramid (mean and var of every bin width)")
+    parser_pyramid.add_argument('-d', "--duration", default=3600, type=float, help="Duration (in s) of the synthetic experiment")
+    parser_pyramid.add_argument('-n', "--num-sweeps", default=5, type=int, help="Number of times every bin width is queried (e.g. parameter sweeps)")
+    parser_multicam = subparsers.add_parser("multicam_decode", help="Seeking every camera on every multicam frame vs forward-only sequential decoding")
+    parser_multicam.add_argument('-d', "--duration", default=600, type=float, help="Duration (in s) of the synthetic experiment")
+    parser_multicam.add_argument('-r', "--resolution", nargs=2, default=[320, 180], type=int, help="Resolution (width height) of the synthetic cameras")
+    parser_timing = subparsers.add_parser("camera_timing", help="Parsing every camera timestamp string vs vectorized loading + searchsorted (multicam frame numbers)")
+    parser_timing.add_argument('-d', "--duration", default=3600, type=float, help="Duration (in s) of the synthetic camera timestamps")
+    parser_overlay = subparsers.add_parser("weight_overlay", help="Redrawing generate_video's weight plot with matplotlib vs sliding a pre-rasterized one")
+    parser_overlay.add_argument('-d', "--duration", default=600, type=float, help="Duration (in s) of the synthetic weight signal")
+    parser_overlay.add_argument('-f', "--num-frames", default=250, type=int, help="Number of video frames to render the overlay for")
+    parser_masks = subparsers.add_parser("mask_store", help="One png per background mask vs bit-packed masks in a single h5 (written in the background)")
+    parser_masks.add_argument('-f', "--num-frames", default=500, type=int, help="Number of synthetic masks")
+    parser_masks.add_argument('-r', "--resolution", nargs=2, default=[1280, 720], type=int, help="Resolution (width height) of the synthetic masks")
+    parser_bgnd = subparsers.add_parser("bgnd_subtraction", help="Frames/s and mask quality of every background subtraction algorithm at every scale")
+    parser_bgnd.add_argument('-f', "--num-frames", default=200, type=int, help="Number of synthetic frames")
+    parser_bgnd.add_argument('-r', "--resolution", nargs=2, default=[1280, 720], type=int, help="Resolution (width height) of the synthetic frames")
+    parser_bgnd.add_argument('-s', "--scales", nargs='+', default=[1.0, 0.5, 0.25], type=float, help="Scale(s) at which to run background subtraction")
+    parser_bgnd.add_argument('-a', "--algorithms", nargs='+', default=None, help="Algorithm(s) to benchmark (default: all of them)")
+    args = parser.parse_args()
+
+    if args.benchmark == "parallel_ingest":
+        benchmark_parallel_ingest(args.duration, args.num_workers, args.keep)
+    elif args.benchmark == "chunked_ingest":
+        benchmark_chunked_ingest(args.duration, args.chunk_duration, gap=args.gap, num_workers=args.num_workers, keep=args.keep)
+    elif args.benchmark == "resampling":
+        benchmark_resampling(args.duration, F_dst=args.F_dst)
+    elif args.benchmark == "weight_events":
+        benchmark_weight_events(args.duration, args.chunk_durations)
+    elif args.benchmark == "bin_pyramid":
+        benchmark_bin_pyramid(args.duration, num_sweeps=args.num_sweeps)
+    elif args.benchmark == "multicam_decode":
+        benchmark_multicam_decode(args.duration, resolution=tuple(args.resolution), keep=args.keep)
+    elif args.benchmark == "camera_timing":
+        benchmark_camera_timing(args.duration, keep=args.keep)
+    elif args.benchmark == "weight_overlay":
+        benchmark_weight_overlay(args.duration, args.num_frames)
+    elif args.benchmark == "mask_store":
+        benchmark_mask_store(args.num_frames, tuple(args.resolution), args.keep)
+    elif args.benchmark == "bgnd_subtraction":
+        benchmark_bgnd_subtraction(args.num_frames, tuple(args.resolution), args.scales, args.algorithms)
+    else:
+        parser.print_help()
@@ -0,0 +1,156 @@
+import numpy as np
+from preprocess_experiments import BackgroundSubtractor
+from collections import deque
+import os
+
+
+# Pose and object detection only matter around shelf interactions (processExperiment.m only looks at the frames within Nvision of a weight event), so a
+# FrameSelector can make FanOutFrameSource skip the rest: skipped frames go to the stages' skip() instead of process(), and the pose/objdet h5 files record
+# which frames were actually processed in their HDF5_SELECTED_FRAMES_NAME dataset (1 per frame: 1 = processed, 0 = skipped, i.e. empty but not "nothing found")
+DEFAULT_N_VISION = 3.0  # Seconds, same as systemParams.Nvision in "Experiment postprocessing/loadCommonConstants.m"
+DEFAULT_MOTION_THRESH = 0.005  # Min fraction of foreground pixels for a frame to count as "something's moving"
+DEFAULT_MOTION_PAD = 1.0  # Seconds. Frames this close to some motion are also selected (e.g. a hand that stopped to grab a product)
+DEFAULT_MOTION_SCALE = 0.25  # Motion is only needed per frame (not per pixel) -> Background-subtract heavily downscaled frames
+WEIGHT_EVENTS_CHUNK_DURATION = 60  # Seconds of weight data streamed through the event detector at a time
+MASKS_CHUNK_LEN = 256  # Frames of packed masks read at a time
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)  # Number of bits set in every byte
+
+
+def weight_event_windows(weights_h5_filename, n_vision=DEFAULT_N_VISION, system_params=None):
+    """Returns the (t_a, t_b) time window (float epochs) of every weight event in weights_h5_filename, same as the ones processExperiment.m looks at:
+    [tB, tE+Nvision] if something was picked up, [tB-Nvision, tE] if it was put back"""
+    from weights_h5 import WeightsH5Reader
+    from weight_events import WeightEventDetector
+
+    detector = WeightEventDetector(system_params=system_params)
+    events = []
+    with WeightsH5Reader(weights_h5_filename) as reader:
+        t_end = reader.t_end
+        for t_a in np.arange(reader.t_start, t_end, WEIGHT_EVENTS_CHUNK_DURATION):
+            t_b = t_a + WEIGHT_EVENTS_CHUNK_DURATION
+            events.extend(detector.push(*reader.read(t_a, t_b if t_b <= t_end else None)))
+        events.extend(detector.finish())
+    return [(e['tB'], e['tE'] + n_vision) if e['deltaW'] <= 0 else (e['tB'] - n_vision, e['tE']) for e in events]
+
+
+def load_foreground_fractions(mask_h5_filename):
+    """Fraction of foreground pixels of every mask in a <video>_mask.h5 (counted straight from the packed bits, without unpacking them)"""
+    from mask_h5 import MaskH5Reader
+    with MaskH5Reader(mask_h5_filename) as reader:
+        fractions = np.zeros(reader.num_frames)
+        for frame_a in range(0, reader.num_frames, MASKS_CHUNK_LEN):
+            packed = reader.masks[frame_a:frame_a+MASKS_CHUNK_LEN]
+            fractions[frame_a:frame_a+len(packed)] = POPCOUNT[packed].sum(axis=(1, 2)) / float(reader.width*reader.height)
+    return fractions
+
+
+class FrameSelector:
+    """Decides which frames the vision stages run on (FanOutFrameSource push()es every decoded frame, in order): frames inside any of windows (if given, e.g.
+    weight_event_windows) where something is moving (if motion: more than motion_thresh of the pixels are foreground within motion_pad seconds of the frame).
+    Motion comes from foreground_fractions (e.g. load_foreground_fractions) if given, otherwise from background-subtracting downscaled frames on the fly"""
+
+    def __init__(self, t_frames, windows=None, motion=False, foreground_fractions=None, motion_thresh=DEFAULT_MOTION_THRESH, motion_pad=DEFAULT_MOTION_PAD, algorithm="GSOC", scale=DEFAULT_MOTION_SCALE):
+        self.t_frames = t_frames
+        self.windows = windows
+        if windows is not None:  # Merge overlapping windows, so each frame only needs to be checked against the last window starting before it
+            windows = sorted(windows)
+            merged = []
+            for t_a, t_b in windows:
+                if len(merged) > 0 and t_a <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], t_b)
+                else:
+                    merged.append([t_a, t_b])
+            self.window_starts, self.window_ends = np.array(merged).reshape(-1, 2).T
+        self.motion = motion
+        self.foreground_fractions = foreground_fractions
+        self.motion_thresh = motion_thresh
+        self.motion_pad = motion_pad
+        self.algorithm = algorithm
+        self.scale = scale
+        self.bgnd = None
+        self.lookahead = 0
+        self.pending = deque()  # (frame_num, frame, in_window) of the frames whose motion_pad hasn't been fully seen yet
+        self.last_moving = -np.inf
+        self.num_frames = 0
+        self.num_selected = 0
+
+    def describe(self):
+        criteria = []
+        if self.windows is not None:
+            criteria.append("{} weight event windows".format(len(self.windows)))
+        if self.motion:
+            criteria.append("foreground fraction > {} within {}s ({})".format(self.motion_thresh, self.motion_pad, "mask h5" if self.foreground_fractions is not None else "{} at scale {}".format(self.algorithm, self.scale)))
+        return " and ".join(criteria)
+
+    def start(self, video_info):
+        """video_info: see video_io.get_video_info"""
+        self.lookahead = int(round(self.motion_pad * video_info['fps'])) if self.motion else 0
+
+    def _in_windows(self, frame_num):
+        if self.windows is None or frame_num >= len(self.t_frames): return True  # (No timestamp -> Can't tell, don't skip it)
+        t = self.t_frames[frame_num]
+        i = np.searchsorted(self.window_starts, t, side='right') - 1
+        return i >= 0 and t <= self.window_ends[i]
+
+    def _is_moving(self, frame_num, frame):
+        if self.foreground_fractions is not None:
+            return frame_num >= len(self.foreground_fractions) or self.foreground_fractions[frame_num] > self.motion_thresh
+        if self.bgnd is None:
+            self.bgnd = BackgroundSubtractor(self.algorithm, self.scale)
+        mask = self.bgnd.run(frame, upscale=False)  # (Run on every frame, also outside windows, so the background model stays up to date)
+        return np.count_nonzero(mask > 127) > self.motion_thresh*mask.size
+
+    def push(self, frame_num, frame):
+        """Returns (frame_num, frame, selected) for every frame whose selection is now known (in order; up to motion_pad seconds behind frame_num)"""
+        if self.motion and self._is_moving(frame_num, frame):
+            self.last_moving = frame_num
+        self.pending.append((frame_num, frame, self._in_windows(frame_num)))
+        return self._pop_ready(frame_num - self.lookahead)
+
+    def finish(self):
+        """Returns the frames still waiting for their selection (call it after the last push())"""
+        return self._pop_ready(np.inf)
+
+    def _pop_ready(self, last_frame_num):
+        ready = []
+        while len(self.pending) > 0 and self.pending[0][0] <= last_frame_num:
+            frame_num, frame, in_window = self.pending.popleft()
+            selected = in_window and (not self.motion or self.last_moving >= frame_num - self.lookahead)  # (last_moving <= frame_num + lookahead)
+            self.num_frames += 1
+            self.num_selected += selected
+            ready.append((frame_num, frame, selected))
+        return ready
+
+
+def frame_selection_inputs(video_filename, event_gating=False, motion_gating=False, **kwargs):
+    """Files create_frame_selector(video_filename, event_gating, motion_gating, ...) reads (if they exist), e.g. to tell when its selection could change"""
+    from mask_h5 import MASK_H5_SUFFIX
+    video_prefix = os.path.splitext(video_filename)[0]
+    parent_folder = os.path.dirname(video_prefix)
+    return ([os.path.join(parent_folder, "weights_{}.h5".format(os.path.basename(parent_folder)))] if event_gating else []) + ([video_prefix + MASK_H5_SUFFIX] if motion_gating else [])
+
+
+def create_frame_selector(video_filename, event_gating=False, motion_gating=False, n_vision=DEFAULT_N_VISION, motion_thresh=DEFAULT_MOTION_THRESH, motion_pad=DEFAULT_MOTION_PAD, algorithm="GSOC", scale=DEFAULT_MOTION_SCALE):
+    """FrameSelector for a camera video: event_gating uses the weight events in its experiment's weights_<t>.h5, motion_gating the foreground fractions in
+    <video>_mask.h5 if it exists (otherwise they're computed on the fly). Returns None if nothing is gated (or gating isn't possible): run on every frame"""
+    from video_io import load_camera_timestamps
+    from mask_h5 import MASK_H5_SUFFIX
+    video_prefix = os.path.splitext(video_filename)[0]
+    parent_folder = os.path.dirname(video_prefix)
+    t_frames = load_camera_timestamps(video_prefix + ".h5") if os.path.exists(video_prefix + ".h5") else np.zeros(0)
+
+    windows = None
+    if event_gating:
+        weights_h5_filename = os.path.join(parent_folder, "weights_{}.h5".format(os.path.basename(parent_folder)))
+        if not os.path.exists(weights_h5_filename) or len(t_frames) == 0:
+            print("Can't select the frames of '{}' around weight events (missing '{}' or camera timestamps), not gating on them!".format(video_filename, weights_h5_filename))
+        else:
+            windows = weight_event_windows(weights_h5_filename, n_vision)
+
+    foreground_fractions = None
+    if motion_gating and os.path.exists(video_prefix + MASK_H5_SUFFIX):
+        foreground_fractions = load_foreground_fractions(video_prefix + MASK_H5_SUFFIX)
+
+    if windows is None and not motion_gating:
+        return None
+    return FrameSelector(t_frames, windows, motion_gating, foreground_fractions, motion_thresh, motion_pad, algorithm, scale)
@@ -1,148 +1,269 @@
 import matplotlib
 matplotlib.use('Agg')
 
-from preprocess_experiments import HDF5_WEIGHT_GROUP_NAME
-from aux_tools import format_axis_as_timedelta, _min, _max, str2bool, list_subfolders, DEFAULT_TIMEZONE, date_range, time_to_float, str_to_datetime, plt_fig_to_cv2_img
+from weights_h5 import WeightsH5Reader
+from weight_overlay import WeightOverlayRenderer
+from artifact_cache import ArtifactCache
+from video_io import SequentialVideoReader, DEFAULT_GOP_SIZE, _put_unless_stopped, _get_unless_stopped, split_frames_into_shards, concat_videos, load_camera_timestamps, load_multicam_timestamps, nearest_frame_nums
+from aux_tools import format_axis_as_timedelta, str2bool, list_subfolders, split_worker_budget, create_pool, date_range, time_to_float, epoch_to_datetime, datetime_to_epoch, epoch_to_str, plt_fig_to_cv2_img
 import cv2
 import numpy as np
-from scipy.interpolate import interp1d
 from matplotlib import pyplot as plt
-from datetime import datetime, timedelta
+from datetime import timedelta
+from multiprocessing import cpu_count
+import threading
+import queue
 import os
 import h5py
 import argparse
 
 
-def generate_multicam_video(experiment_base_folder, video_out_filename=None, t_start=0, t_end=-1, video_fps=25, visualize=False, overwrite=False):
+def get_multicam_frame_nums(experiment_base_folder, video_fps=25, num_cams=4):
+    """Returns (t_cam, frame_nums): float epoch timestamps of a constant video_fps timeline (during which all cameras were recording), and which frame of each camera is closest to each of them"""
+    t_experiment_start = experiment_base_folder.rsplit('/', 1)[-1]  # Last folder in the path should indicate time at which experiment started
+    camera_timestamps = [load_camera_timestamps(os.path.join(experiment_base_folder, "cam{}_{}.h5".format(cam+1, t_experiment_start))) for cam in range(num_cams)]
+    t_latest_start = max(t[0] for t in camera_timestamps)
+    t_earliest_end = min(t[-1] for t in camera_timestamps)
+
+    # Nearest frame of each camera, as if cameras had been sampled at constant fps
+    t_cam = date_range(t_latest_start, t_earliest_end, 1.0/video_fps)
+    return t_cam, np.array([nearest_frame_nums(t, t_cam) for t in camera_timestamps], dtype=np.uint32)
+
+
+MULTICAM_NUM_CAMS = 4
+MULTICAM_QUEUE_SIZE = 8  # Max frames buffered between pipeline stages (per camera)
+MULTICAM_PIPELINE_THREADS = MULTICAM_NUM_CAMS + 2  # Busy threads of a pipelined generate_multicam_video: 1 decoder per camera + composite + encoder
+SHARD_CODEC = 'FFV1'  # Lossless codec for the intermediate pieces of a sharded render (so joining them gives exactly the same frames as a serial render)
+SHARD_EXTENSION = ".avi"
+
+
+def _render_in_shards(render_fn, render_kwargs, num_frames, num_shards, video_out_filename, video_fps, codec, gop_size=DEFAULT_GOP_SIZE):
+    """Renders frames [0, num_frames) of video_out_filename by calling render_fn(**render_kwargs) on keyframe-aligned ranges of frames, each in its own process
+    (writing a lossless piece), then joins the pieces by encoding them in order with the final codec. Returns the list of render_fn's return values"""
+    shards = split_frames_into_shards(num_frames, num_shards, gop_size)
+    pieces = ["{}_shard{:03d}{}".format(os.path.splitext(video_out_filename)[0], i, SHARD_EXTENSION) for i in range(len(shards))]
+    print("Rendering '{}' in {} shards: {}".format(video_out_filename, len(shards), shards))
+    pool = create_pool(len(shards))
+    tasks_state = [pool.apply_async(render_fn, (), dict(render_kwargs, video_out_filename=piece, codec=SHARD_CODEC, frame_range=shard, num_shards=1)) for shard, piece in zip(shards, pieces)]
+    try:
+        results = [task_state.get() for task_state in tasks_state]
+    finally:
+        pool.close()
+        pool.join()
+
+    # No stream copy without ffmpeg -> Re-encode the (lossless) pieces once, in order, so the output is the same as if a single process had rendered it
+    num_frames_written = concat_videos([piece for piece in pieces if os.path.exists(piece)], video_out_filename, video_fps, codec)
+    for piece in pieces:
+        for filename in (piece, os.path.splitext(piece)[0] + ".h5"):
+            if os.path.exists(filename): os.remove(filename)
+    print("Joined {} frames from {} shards into '{}'".format(num_frames_written, len(shards), video_out_filename))
+    return results
+
+
+def _composite_multicam_frame(frames, out):
+    """Resizes each camera frame straight into its half-resolution quadrant of out (cam1 top-left, cam2 bottom-left, cam3 top-right, cam4 bottom-right).
+    Same result as stacking the full-resolution frames and downsizing the whole mosaic by 2 (as long as frames have even dimensions), without the 4X-sized intermediate image"""
+    half_h, half_w = out.shape[0]//2, out.shape[1]//2
+    for i, frame in enumerate(frames):
+        y, x = (i % 2)*half_h, (i // 2)*half_w
+        cv2.resize(frame, (half_w, half_h), out[y:y+half_h, x:x+half_w, :])
+    return out
+
+
+def _generate_multicam_frames_pipelined(videos_in, frame_nums, frames_to_render, video_out, video_size, visualize=False, queue_size=MULTICAM_QUEUE_SIZE, cb_frame_written=None):
+    """Threaded version of the generate_multicam_video loop: 1 decoder thread per camera -> bounded queues -> composite (this thread) -> bounded queue -> encoder thread"""
+    stop = threading.Event()
+    frame_queues = [queue.Queue(maxsize=queue_size) for _ in videos_in]
+    encode_queue = queue.Queue(maxsize=queue_size)
+    encoder_error = []
+
+    def decode(i):
+        try:
+            last_frame_num, frame = -1, None
+            for n in frames_to_render:
+                if frame_nums[i,n] != last_frame_num:  # Repeated frames are queued again without decoding (or copying) them
+                    ok, frame = videos_in[i].read(frame_nums[i,n])
+                    assert ok, "Couldn't read frame {} from camera {}!".format(n, i+1)
+                    frame = frame.copy()  # The reader reuses its buffer for the next frame
+                    last_frame_num = frame_nums[i,n]
+                if not _put_unless_stopped(frame_queues[i], frame, stop): return
+        except Exception as e:
+            _put_unless_stopped(frame_queues[i], e, stop)
+
+    def encode():
+        try:
+            for k in range(len(frames_to_render)):
+                img = encode_queue.get()
+                if img is None: return
+                video_out.write(img)
+                if cb_frame_written is not None: cb_frame_written(k)
+        except Exception as e:
+            encoder_error.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=decode, args=(i,)) for i in range(len(videos_in))] + [threading.Thread(target=encode)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for _ in frames_to_render:
+            frames = [_get_unless_stopped(q, stop) for q in frame_queues]
+            if not all(ok for ok, _ in frames): break  # The encoder failed and stopped the decoders (its error is raised below)
+            frames = [frame for _, frame in frames]
+            for frame in frames:
+                if isinstance(frame, Exception): raise frame
+            img = _composite_multicam_frame(frames, np.empty((video_size[1], video_size[0], 3), dtype=np.uint8))
+            if not _put_unless_stopped(encode_queue, img, stop): break
+
+            if visualize:
+                cv2.imshow("Frame", img)
+                # Let the visualization be stopped by pressing a key
+                k = cv2.waitKey(1)
+                if k > 0:
+                    print('Key pressed, exiting!')
+                    break
+    finally:
+        _put_unless_stopped(encode_queue, None, stop)  # Let the encoder write whatever's queued (in case we stopped early), then stop the decoders
+        threads[-1].join()
+        stop.set()
+        for thread in threads[:-1]: thread.join()
+    if len(encoder_error) > 0:
+        raise encoder_error[0]
+
+
+def generate_multicam_video(experiment_base_folder, video_out_filename=None, t_start=0, t_end=-1, video_fps=25, visualize=False, overwrite=False, gop_size=DEFAULT_GOP_SIZE, pipelined=False, decode_threads=None, codec='avc1', frame_range=None, num_shards=1):
+    """Reuses video_out_filename if it's up to date (same cameras and rendering parameters, see artifact_cache.py) unless overwrite"""
     t_experiment_start = experiment_base_folder.rsplit('/', 1)[-1]  # Last folder in the path should indicate time at which experiment started
     if video_out_filename is None:
         video_out_filename = os.path.join(experiment_base_folder, "multicam_{}.mp4".format(t_experiment_start))
-    if os.path.exists(video_out_filename):
-        print("Video {} already exists, {}".format(video_out_filename, "overwriting..." if overwrite else "nothing to do!"))
-        if not overwrite:  # Exit if don't want to overwrite
-            return video_out_filename
-    else:
-        print("Generating multi-cam video '{}'".format(video_out_filename))
-
-    # Load videos and get their frame timestamps
-    videos_in = []
-    camera_timestamps = []
-    t_latest_start = datetime.min.replace(tzinfo=DEFAULT_TIMEZONE)
-    t_earliest_end = datetime.max.replace(tzinfo=DEFAULT_TIMEZONE)
-    for cam in (range(4)):
-        camera_filename = os.path.join(experiment_base_folder, "cam{}_{}".format(cam+1, t_experiment_start))
-        videos_in.append(cv2.VideoCapture(camera_filename + ".mp4"))
-        camera_info = h5py.File(camera_filename + ".h5", 'r')
-        camera_timestamps.append(np.array([str_to_datetime(t) for t in camera_info.get("t_str")]))
-        t_latest_start = _max(camera_timestamps[-1][0], t_latest_start)
-        t_earliest_end = _min(camera_timestamps[-1][-1], t_earliest_end)
-
-    # Interpolate time (nearest frame) as if cameras had been sampled at constant fps
-    t_cam = np.array(list(date_range(t_latest_start, t_earliest_end, timedelta(seconds=1.0/video_fps))))
-    to_float = lambda t_arr: np.array(time_to_float(t_arr, t_latest_start))
-    frame_nums = []
-    for t in camera_timestamps:
-        frame_nums.append(interp1d(to_float(t), range(len(t)), kind='nearest', copy=False, assume_sorted=True)(to_float(t_cam)).astype(np.uint16))
-    frame_nums = np.array(frame_nums)
-
-    # Set up video file
-    video_size = (int(videos_in[0].get(cv2.CAP_PROP_FRAME_WIDTH)), int(videos_in[0].get(cv2.CAP_PROP_FRAME_HEIGHT)))
-    video_out = cv2.VideoWriter(video_out_filename, cv2.VideoWriter_fourcc(*'avc1'), video_fps, video_size)
-    rgb_data = np.zeros((2*video_size[1], 2*video_size[0], 3), dtype=np.uint8)
-    img = np.zeros((video_size[1], video_size[0], 3), dtype=np.uint8)
+    # The camera videos were recorded along with their timestamps -> Enough to tell if they changed (their h5 files get pose added later on, so they're not inputs)
+    cache = ArtifactCache(experiment_base_folder) if frame_range is None and not visualize else None  # (Shards are temporary pieces, and visualizing can stop halfway)
+    cache_inputs = [os.path.join(experiment_base_folder, "cam{}_{}.mp4".format(cam+1, t_experiment_start)) for cam in range(MULTICAM_NUM_CAMS)]
+    cache_params = {"t_start": t_start, "t_end": t_end, "video_fps": video_fps, "codec": codec}
+    h5_out_filename = os.path.splitext(video_out_filename)[0] + ".h5"  # Frame numbers of every camera for each output frame (loadCamsData.m needs it too -> Cached along with the video)
+    if cache is not None and not overwrite and all(cache.is_fresh(f, "multicam", cache_inputs, cache_params, adopt_untracked=False) for f in (video_out_filename, h5_out_filename)):
+        print("Video {} is up to date, nothing to do!".format(video_out_filename))
+        return video_out_filename
+    print("{} multi-cam video '{}'".format("Regenerating" if os.path.exists(video_out_filename) else "Generating", video_out_filename))
+
+    # Load videos and get the frame of each camera closest to every output frame's timestamp
+    t_cam, frame_nums = get_multicam_frame_nums(experiment_base_folder, video_fps, MULTICAM_NUM_CAMS)
+    # frame_nums only moves forward -> Decode each camera sequentially instead of seeking (decoding from the last keyframe) on every frame
+    videos_in = [SequentialVideoReader(os.path.join(experiment_base_folder, "cam{}_{}.mp4".format(cam+1, t_experiment_start)), gop_size, decode_threads) for cam in range(len(frame_nums))]
 
     # Save timing params so t_cam can be reconstructed (and the weights can be aligned)
-    with h5py.File(os.path.splitext(video_out_filename)[0] + ".h5", 'w') as f_hdf5:
-        f_hdf5.attrs['t_start'] = str(t_cam[0]).encode('utf8')
-        f_hdf5.attrs['t_end'] = str(t_cam[-1]).encode('utf8')
+    with h5py.File(h5_out_filename, 'w') as f_hdf5:
+        f_hdf5.attrs['t_start'], f_hdf5.attrs['t_end'] = epoch_to_str([t_cam[0], t_cam[-1]])
         f_hdf5.attrs['fps'] = video_fps
         f_hdf5.create_dataset('frame_nums', data=frame_nums)
 
-    # Generate video
-    for n,t in enumerate(t_cam):
-        curr_t = (t-t_cam[0]).total_seconds()
-        if curr_t < t_start or (t_end > 0 and curr_t > t_end): continue
-
-        for i in range(len(frame_nums)):
-            videos_in[i].set(cv2.CAP_PROP_POS_FRAMES, frame_nums[i,n])
-            ok = videos_in[i].read(img)
-            assert ok, "Couldn't read frame {} from camera {}!".format(n, i+1)
-            if i == 0:
-                rgb_data[:img.shape[0], :img.shape[1], :] = img
-            elif i == 1:
-                rgb_data[img.shape[0]:, :img.shape[1], :] = img
-            elif i == 2:
-                rgb_data[:img.shape[0], img.shape[1]:, :] = img
-            elif i == 3:
-                rgb_data[img.shape[0]:, img.shape[1]:, :] = img
+    if num_shards > 1:  # Render each time shard in a separate process and join them
+        for v in videos_in: v.release()
+        _render_in_shards(generate_multicam_video, {'experiment_base_folder': experiment_base_folder, 't_start': t_start, 't_end': t_end, 'video_fps': video_fps, 'overwrite': True,
+                                                    'gop_size': gop_size, 'pipelined': pipelined, 'decode_threads': decode_threads}, len(t_cam), num_shards, video_out_filename, video_fps, codec, gop_size)
+        if cache is not None:
+            for f in (video_out_filename, h5_out_filename): cache.record(f, "multicam", cache_inputs, cache_params, regenerable=True)
+        print("Video successfully saved as '{}'! :)".format(video_out_filename))
+        return video_out_filename
 
-        # Output the image (show it and write to file)
-        cv2.resize(rgb_data, None, img, fx=0.5, fy=0.5)
-        video_out.write(img)
-        print("{} out of {} frames ({:6.2f}%) written! ({})".format(n+1, len(t_cam), 100.0*(n+1)/len(t_cam), video_out_filename))
-
-        if visualize:
-            cv2.imshow("Frame", img)
-            # Let the visualization be stopped by pressing a key
-            k = cv2.waitKey(1)
-            if k > 0:
-                print('Key pressed, exiting!')
-                break
+    # Set up video file (same size as each camera: the 2x2 mosaic is downsized by 2)
+    video_size = (int(videos_in[0].get(cv2.CAP_PROP_FRAME_WIDTH)), int(videos_in[0].get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    video_out = cv2.VideoWriter(video_out_filename, cv2.VideoWriter_fourcc(*codec), video_fps, video_size)
+    img = np.zeros((video_size[1], video_size[0], 3), dtype=np.uint8)
 
-    # Close video file
+    # Generate video
+    n_first, n_last = frame_range if frame_range is not None else (0, len(t_cam))
+    t_rel = t_cam[n_first:n_last] - t_cam[0]
+    frames_to_render = (n_first + np.flatnonzero((t_start <= t_rel) & ~((t_end > 0) & (t_rel > t_end)))).tolist()
+    print_progress = lambda k: print("{} out of {} frames ({:6.2f}%) written! ({})".format(frames_to_render[k]+1, len(t_cam), 100.0*(frames_to_render[k]+1)/len(t_cam), video_out_filename))
+    if pipelined:
+        _generate_multicam_frames_pipelined(videos_in, frame_nums, frames_to_render, video_out, video_size, visualize, cb_frame_written=print_progress)
+    else:
+        for k,n in enumerate(frames_to_render):
+            frames = []
+            for i in range(len(frame_nums)):
+                ok, frame = videos_in[i].read(frame_nums[i,n])
+                assert ok, "Couldn't read frame {} from camera {}!".format(n, i+1)
+                frames.append(frame)
+
+            # Output the image (show it and write to file)
+            _composite_multicam_frame(frames, img)
+            video_out.write(img)
+            print_progress(k)
+
+            if visualize:
+                cv2.imshow("Frame", img)
+                # Let the visualization be stopped by pressing a key
+                k = cv2.waitKey(1)
+                if k > 0:
+                    print('Key pressed, exiting!')
+                    break
+
+    # Close video files
+    for v in videos_in: v.release()
     video_out.release()  # Make sure to release the video so it's actually written to disk
+    if cache is not None:
+        for f in (video_out_filename, h5_out_filename): cache.record(f, "multicam", cache_inputs, cache_params, regenerable=True)
     print("Video successfully saved as '{}'! :)".format(video_out_filename))
     return video_out_filename
 
 
-def generate_video(experiment_base_folder, camera_id=3, weight_id=5309446, t_lims=3, t_start=0, t_end=-1, weight_plot_scale=0.3, video_fps=25, visualize=True, save_video=False, cb_event_start_or_end=None, out_scale=0.5):
+def create_weight_figure(t_w, w, weight_id=None, figsize=(4,2)):
+    """Plots each weight signal in w (one per shelf, or a single load cell's if weight_id is given) in its own axes, with a dashed line marking the current time.
+    Returns (fig, ax, curr_t_lines)"""
+    fig = plt.figure(figsize=figsize)
+    num_axes = len(w)
+    ax = fig.subplots(num_axes, 1, sharex=True, squeeze=False)
+    curr_t_lines = []
+    for i in range(num_axes):
+        shelf_i = num_axes - (i+1)  # Shelf 1 is at the bottom
+        ax[i,0].plot(t_w, w[shelf_i])
+        ax[i,0].set_title('Shelf {}'.format(shelf_i+1) if weight_id is None else 'Load cell #{}'.format(weight_id))
+        ax[i,0].set_ylabel('Weight (g)')
+        format_axis_as_timedelta(ax[i,0].xaxis)
+        curr_t_lines.append(ax[i,0].axvline(0, linestyle='--', color='black', linewidth=1))
+    return fig, ax, curr_t_lines
+
+
+def generate_video(experiment_base_folder, camera_id=3, weight_id=5309446, t_lims=3, t_start=0, t_end=-1, weight_plot_scale=0.3, video_fps=25, visualize=True, save_video=False, cb_event_start_or_end=None, out_scale=0.5, video_out_filename='AIM3S_experiment.mp4', codec='avc1', frame_range=None, num_shards=1, fast_overlay=True):
     multiple_cams = (camera_id < 0)
     if multiple_cams:
         weight_plot_scale = 1.0  # Overwrite setting, weight plots will be hstacked (same height)
-        video_in_filename = generate_multicam_video(experiment_base_folder, t_start=t_start, t_end=t_end, video_fps=video_fps)
+        video_in_filename = generate_multicam_video(experiment_base_folder, t_start=t_start, t_end=t_end, video_fps=video_fps, num_shards=num_shards)
         video_in = cv2.VideoCapture(video_in_filename)
-        with h5py.File(os.path.splitext(video_in_filename)[0] + ".h5", 'r') as h5_cam:
-            t_cam = np.array(list(date_range(str_to_datetime(h5_cam.attrs['t_start']), str_to_datetime(h5_cam.attrs['t_end']), timedelta(seconds=1.0/h5_cam.attrs['fps']))))
+        t_cam = load_multicam_timestamps(os.path.splitext(video_in_filename)[0] + ".h5")
     else:
         t_experiment_start = experiment_base_folder.rsplit('/', 1)[-1]  # Last folder in the path should indicate time at which experiment started
         camera_filename = os.path.join(experiment_base_folder, "cam{}_{}".format(camera_id, t_experiment_start))
         video_in = cv2.VideoCapture(camera_filename + ".mp4")
-        camera_info = h5py.File(camera_filename + ".h5", 'r')
-        t_cam = np.array([str_to_datetime(t) for t in camera_info.get("t_str")])
+        t_cam = load_camera_timestamps(camera_filename + ".h5")
     video_in_width = int(video_in.get(cv2.CAP_PROP_FRAME_WIDTH))
     video_in_height = int(video_in.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if num_shards > 1 and save_video and not visualize:  # Render each time shard (video + weight plot) in a separate process and join them
+        video_in.release()
+        results = _render_in_shards(generate_video, {'experiment_base_folder': experiment_base_folder, 'camera_id': camera_id, 'weight_id': weight_id, 't_lims': t_lims, 't_start': t_start, 't_end': t_end,
+                                                     'weight_plot_scale': weight_plot_scale, 'video_fps': video_fps, 'visualize': False, 'save_video': True, 'out_scale': out_scale, 'fast_overlay': fast_overlay}, len(t_cam), num_shards, video_out_filename, video_fps, codec)
+        print("Video successfully saved as '{}'! :)".format(video_out_filename))
+        return results[0]
     rgb_data = np.zeros((video_in_height, video_in_width, 3), dtype=np.uint8)
 
     # Read all weight sensors for the full experiment duration at once
     t_experiment_start = experiment_base_folder.rsplit('/', 1)[-1]  # Last folder in the path should indicate time at which experiment started
-    with h5py.File(os.path.join(experiment_base_folder, "weights_{}.h5".format(t_experiment_start)), 'r') as h5_weights:
+    with WeightsH5Reader(os.path.join(experiment_base_folder, "weights_{}.h5".format(t_experiment_start))) as h5_weights:
         multiple_weights = (weight_id < 0)
         if multiple_weights:
-            weight_t = np.array([str_to_datetime(t) for t in h5_weights['t_str']])
-            weight_data = h5_weights['w'][:]
+            weight_t, weight_data = h5_weights.read()
             w = np.sum(weight_data, axis=1)
         else:
-            plate_info = h5_weights[HDF5_WEIGHT_GROUP_NAME.format(weight_id)]
-            weight_t = np.array([str_to_datetime(t) for t in plate_info['t_str']])
-            weight_data = plate_info['w'][:]
+            weight_t, weight_data = h5_weights.read_orig(weight_id)
             w = [weight_data]
     t_w = time_to_float(weight_t, weight_t[0])
 
     # Manually align weight and cam timestamps (not synced for some reason)
-    weight_to_cam_t_offset = weight_t[0] + timedelta(seconds=13)  # camera_timestamps[0]
+    weight_to_cam_t_offset = epoch_to_datetime(weight_t[0]) + timedelta(seconds=13)  # camera_timestamps[0]
 
     # Set up matplotlib figure
-    fig = plt.figure(figsize=(3.5,5) if multiple_cams else (4,2))
-    num_axes = len(weight_data) if multiple_weights else 1
-    ax = fig.subplots(num_axes, 1, sharex=True, squeeze=False)
-    curr_t_lines = []
-    for i in range(num_axes):
-        shelf_i = num_axes - (i+1)  # Shelf 1 is at the bottom
-        ax[i,0].plot(t_w, w[shelf_i])
-        ax[i,0].set_title('Shelf {}'.format(shelf_i+1) if multiple_weights else 'Load cell #{}'.format(weight_id))
-        ax[i,0].set_ylabel('Weight (g)')
-        format_axis_as_timedelta(ax[i,0].xaxis)
-        curr_t_lines.append(ax[i,0].axvline(0, linestyle='--', color='black', linewidth=1))
+    fig, ax, curr_t_lines = create_weight_figure(t_w, w, None if multiple_weights else weight_id, figsize=(3.5,5) if multiple_cams else (4,2))
     # Render the figure once to get its dimensions
     fig.canvas.draw()
     weight_img = plt_fig_to_cv2_img(fig)
@@ -151,20 +272,24 @@ def generate_video(experiment_base_folder, camera_id=3, weight_id=5309446, t_lim
     # Allocate extra space when the figure is going to be plotted to the right of the video
     if weight_plot_scale == 1:  # Render the figure once to get its dimensions
         rgb_data = np.zeros((rgb_data.shape[0], rgb_data.shape[1]+weight_fig_dimensions[1], 3), dtype=np.uint8)
+    # Instead of redrawing the whole figure on every frame, rasterize the curves once and just slide a window over them
+    weight_overlay = WeightOverlayRenderer(fig, ax, t_lims) if fast_overlay else None
 
     # Set up video file
     if save_video:
-        video_filename = 'AIM3S_experiment.mp4'
-        video_out = cv2.VideoWriter(video_filename, cv2.VideoWriter_fourcc(*'avc1'), video_fps, (video_in_width, video_in_height))
+        video_out = cv2.VideoWriter(video_out_filename, cv2.VideoWriter_fourcc(*codec), video_fps, (int(round(rgb_data.shape[1]*out_scale)), int(round(rgb_data.shape[0]*out_scale))))
 
     TIME_INCREMENT = timedelta(seconds=0.1)  # How much to shift the time offset cameras-weights from keyboard input (ASDW)
     FRAME_INCREMENT = 8  # How many frames to skip forward/backward on keyboard input (arrow keys)
     LEFT_RIGHT_MULTIPLIER = 10  # How much larger the skip is when using left-right (A-D) vs up-down (or W-S)
-    n = -1  # Frame number
+    n_first, n_last = frame_range if frame_range is not None else (0, len(t_cam))
+    if n_first > 0:
+        video_in.set(cv2.CAP_PROP_POS_FRAMES, n_first)
+    n = n_first-1  # Frame number
     is_paused = False
     refresh_weight = True
     do_skip_frames = False
-    while n < len(t_cam)-1:
+    while n < n_last-1:
         if not is_paused or do_skip_frames:
             n += 1
             ok = video_in.read(rgb_data[:,:video_in_width,:])
@@ -173,14 +298,17 @@ def generate_video(experiment_base_folder, camera_id=3, weight_id=5309446, t_lim
 
         if refresh_weight:
             # Update current time
-            curr_t = (t_cam[n]-weight_to_cam_t_offset).total_seconds()
+            curr_t = t_cam[n] - datetime_to_epoch(weight_to_cam_t_offset)
             if (t_start > 0 and curr_t < t_start) or (t_end > 0 and curr_t > t_end): continue
-            ax[-1,0].set_xlim(curr_t-t_lims, curr_t+t_lims)
 
             # Update weight plot and convert to image
-            for l in curr_t_lines: l.set_xdata(curr_t)
-            fig.canvas.draw()
-            weight_img = plt_fig_to_cv2_img(fig)
+            if weight_overlay is not None:
+                weight_img = weight_overlay.render(curr_t)
+            else:
+                ax[-1,0].set_xlim(curr_t-t_lims, curr_t+t_lims)
+                for l in curr_t_lines: l.set_xdata(curr_t)
+                fig.canvas.draw()
+                weight_img = plt_fig_to_cv2_img(fig)
 
             # Rescale weight (make the plot occupy weight_plot_scale of the whole camera frame)
             if weight_plot_scale == 1:  # Place the weight plot to the right of the camera frames
@@ -229,9 +357,9 @@ def generate_video(experiment_base_folder, camera_id=3, weight_id=5309446, t_lim
                 weight_to_cam_t_offset += TIME_INCREMENT
                 refresh_weight = True
             elif k == ord('b') and cb_event_start_or_end is not None:
-                cb_event_start_or_end(True, t_cam[n])
+                cb_event_start_or_end(True, epoch_to_datetime(t_cam[n]))
             elif k == ord('n') and cb_event_start_or_end is not None:
-                cb_event_start_or_end(False, t_cam[n])
+                cb_event_start_or_end(False, epoch_to_datetime(t_cam[n]))
             elif k == ord(' '):
                 is_paused = not is_paused
             elif k == 27 or (k > 0 and cb_event_start_or_end is None):  # Don't exit on unrecognized keys if labeling ground truth
@@ -248,9 +376,9 @@ def generate_video(experiment_base_folder, camera_id=3, weight_id=5309446, t_lim
     # Close video file
     if save_video:
         video_out.release()  # Make sure to release the video so it's actually written to disk
-        print("Video successfully saved as '{}'! :)".format(video_filename))
+        print("Video successfully saved as '{}'! :)".format(video_out_filename))
 
-    return weight_to_cam_t_offset, (weight_t[0]-weight_to_cam_t_offset).total_seconds()
+    return weight_to_cam_t_offset, (epoch_to_datetime(weight_t[0])-weight_to_cam_t_offset).total_seconds()
 
 
 if __name__ == '__main__':
@@ -263,17 +391,24 @@ if __name__ == '__main__':
     parser.add_argument('-e', "--t-end", default=-1, type=float, help="Experiment time at which to stop generating the video (-1 for no limit)")
     parser.add_argument('-k', "--scale", default=0.3, type=float, help="Ratio (0-1) to scale down the weight plot wrt the video's dimensions")
     parser.add_argument('-r', "--fps", default=25, type=int, help="Output video frame rate")
+    parser.add_argument("--matplotlib-overlay", default=False, action="store_true", help="Add this flag to redraw the weight plot with matplotlib on every frame (slow) instead of sliding a pre-rasterized one")
     parser.add_argument("--multi-cam", default=False, action="store_true", help="Add this flag to generate multi-cam videos")
+    parser.add_argument('-p', "--pipelined", default=False, action="store_true", help="Add this flag to decode, composite and encode multi-cam videos in separate threads")
+    parser.add_argument('-j', "--num-shards", default=1, type=int, help="Split each video's timeline into this many keyframe-aligned shards and render them in parallel")
+    parser.add_argument('-n', "--num-workers", default=cpu_count(), type=int, help="Total number of cores multi-cam video generation may use (split among experiments)")
     args = parser.parse_args()
 
     if args.multi_cam:
-        from multiprocessing import Pool, cpu_count
-        pool = Pool(processes=cpu_count() if True else 4)
+        from multiprocessing import Pool
+        folder_names = list_subfolders(args.folder, True)
+        # Each video renders num_shards shards at once, each of them keeping MULTICAM_PIPELINE_THREADS threads busy if pipelined -> Run fewer videos at once so they don't fight over the cores
+        num_processes = split_worker_budget(args.num_workers, (MULTICAM_PIPELINE_THREADS if args.pipelined else 1) * max(args.num_shards, 1), len(folder_names))
+        pool = Pool(processes=num_processes, initializer=cv2.setNumThreads, initargs=(1,))  # No extra OpenCV threads inside each worker
+        print("Generating {} multi-cam videos, {} at a time".format(len(folder_names), num_processes))
         tasks_state = []
 
-        folder_names = list_subfolders(args.folder, True)
         for experiment_folder in folder_names:
-            task_state = pool.apply_async(generate_multicam_video, (os.path.join(args.folder, experiment_folder),), {'video_fps': args.fps, 'overwrite': False})
+            task_state = pool.apply_async(generate_multicam_video, (os.path.join(args.folder, experiment_folder),), {'video_fps': args.fps, 'overwrite': False, 'pipelined': args.pipelined, 'decode_threads': 1, 'num_shards': args.num_shards})
             tasks_state.append(task_state)
 
         for i,task_state in enumerate(tasks_state):
@@ -281,4 +416,4 @@ if __name__ == '__main__':
             if not task_state.successful():
                 print("Uh oh... Task {}: {}".format(i+1, task_state._value))
     else:
-        generate_video(args.folder, args.cam, args.weight, args.t_lims, args.t_start, args.t_end, args.scale, args.fps, visualize=False, save_video=True, out_scale=1)
+        generate_video(args.folder, args.cam, args.weight, args.t_lims, args.t_start, args.t_end, args.scale, args.fps, visualize=False, save_video=True, out_scale=1, num_shards=args.num_shards, fast_overlay=not args.matplotlib_overlay)
@@ -1,6 +1,8 @@
 from threading import Event
 from generate_video import generate_multicam_video
-from aux_tools import str2bool, str_to_datetime, date_range, time_to_float, format_axis_as_timedelta, ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
+from video_io import load_multicam_timestamps
+from weights_h5 import WeightsH5Reader
+from aux_tools import str2bool, time_to_float, epoch_to_datetime, datetime_to_epoch, format_axis_as_timedelta, ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
 from datetime import datetime, timedelta
 from matplotlib import pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
@@ -8,7 +10,6 @@ from queue import Queue
 import os
 import cv2
 import numpy as np
-import h5py
 import json
 import argparse
 
@@ -47,22 +48,20 @@ class VideoAndWeightHandler:
         # Load video info
         video_in_filename = generate_multicam_video(experiment_base_folder)
         self.video_in = cv2.VideoCapture(video_in_filename)
-        with h5py.File(os.path.splitext(video_in_filename)[0] + ".h5", 'r') as h5_cam:
-            self.t_cam = np.array(list(date_range(str_to_datetime(h5_cam.attrs['t_start']), str_to_datetime(h5_cam.attrs['t_end']), timedelta(seconds=1.0/h5_cam.attrs['fps']))))
+        self.t_cam = load_multicam_timestamps(os.path.splitext(video_in_filename)[0] + ".h5")  # Float epochs
         self.video_dims = np.array([self.video_in.get(cv2.CAP_PROP_FRAME_HEIGHT), self.video_in.get(cv2.CAP_PROP_FRAME_WIDTH)]).astype(int)
         self.video_initial_dims = (self.initial_scale * self.video_dims).astype(int)
         self.weight_dims = np.array([self.video_initial_dims[0], 350]).astype(int)
 
         # Read all weight sensors for the full experiment duration at once
         t_experiment_start = experiment_base_folder.rsplit('/', 1)[-1]  # Last folder in the path should indicate time at which experiment started
-        with h5py.File(os.path.join(experiment_base_folder, "weights_{}.h5".format(t_experiment_start)), 'r') as h5_weights:
-            self.weight_t = np.array([str_to_datetime(t) for t in h5_weights['t_str']])
-            weight_data = h5_weights['w'][:]
+        with WeightsH5Reader(os.path.join(experiment_base_folder, "weights_{}.h5".format(t_experiment_start))) as h5_weights:
+            self.weight_t, weight_data = h5_weights.read()  # Float epochs
             w = np.sum(weight_data, axis=1)
         t_w = time_to_float(self.weight_t, self.weight_t[0])
 
         # Manually align weight and cam timestamps (not synced because OSX and Linux use different NTP servers)
-        self.weight_to_cam_t_offset = self.weight_t[0] + timedelta(seconds=13)  # Initialize the offset to ~13s (empirical)
+        self.weight_to_cam_t_offset = epoch_to_datetime(self.weight_t[0]) + timedelta(seconds=13)  # Initialize the offset to ~13s (empirical)
 
         # Set up matplotlib figure
         self.fig = plt.figure(figsize=self.weight_dims[::-1]/100.0)
@@ -127,7 +126,7 @@ class VideoAndWeightHandler:
         # Update weight plot (if needed)
         if self.refresh_weight:
             # Update current time and redraw whatever needed
-            curr_t = (self.t_cam[self.n]-self.weight_to_cam_t_offset).total_seconds()
+            curr_t = self.t_cam[self.n] - datetime_to_epoch(self.weight_to_cam_t_offset)
             self.fig.canvas.restore_region(self.bg_cache)  # We'll render on top of our cached bgnd (contains subplot frames, shelf number [title], ylabels, etc)
             for l in self.curr_t_lines: l.set_xdata(curr_t)  # Update time cursor (dashed black lines)
             for ax in self.fig.get_axes():
@@ -182,9 +181,9 @@ class VideoAndWeightHandler:
                 self.weight_to_cam_t_offset += self.TIME_INCREMENT
                 self.refresh_weight = True
             elif k == 'b':
-                self.cb_event_start_or_end(True, self.t_cam[self.n])
+                self.cb_event_start_or_end(True, epoch_to_datetime(self.t_cam[self.n]))
             elif k == 'n':
-                self.cb_event_start_or_end(False, self.t_cam[self.n])
+                self.cb_event_start_or_end(False, epoch_to_datetime(self.t_cam[self.n]))
             elif k == 'space':
                 self.is_paused = not self.is_paused
             elif k == 'escape':  # Don't exit on unrecognized keys if labeling ground truth
@@ -286,7 +285,7 @@ class GroundTruthLabelerWindow(tk.Tk):
 
         # Save final offset values
         self.weight_to_cam_t_offset = self.video_and_weight.weight_to_cam_t_offset
-        self.t_offset_float = (self.video_and_weight.weight_t[0]-self.weight_to_cam_t_offset).total_seconds()
+        self.t_offset_float = (epoch_to_datetime(self.video_and_weight.weight_t[0])-self.weight_to_cam_t_offset).total_seconds()
 
     def on_set_event_time_start_or_end(self, is_start, t):
         if is_start:
@@ -0,0 +1,186 @@
+import numpy as np
+from preprocess_experiments import HDF5_FRAME_NAME_FORMAT, BACKGROUND_MASKS_FOLDER_NAME
+from aux_tools import ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
+from video_io import DEFAULT_STAGE_QUEUE_SIZE, _put_unless_stopped
+from datetime import datetime
+import argparse
+import threading
+import queue
+import glob
+import h5py
+import cv2
+import os
+
+
+# <video>_mask.h5 layout (background subtraction masks, replaces the one png per frame in BACKGROUND_MASKS_FOLDER_NAME):
+#  - attrs: width, height (of the masks)
+#  - masks: (num_frames, height, ceil(width/8)) uint8, every mask binarized (> MASK_THRESHOLD) and bit-packed along its rows (np.packbits: 1st pixel = MSB).
+#           One chunk per frame (random access only decompresses that frame), gzip-compressed
+# Frame i (0-based) was taken at the time of frame i of <video>.h5 (see load_camera_timestamps)
+MASK_H5_SUFFIX = "_mask.h5"
+MASK_THRESHOLD = 127
+HDF5_MASKS_NAME = "masks"
+
+
+class MaskH5Writer:
+    """Appends binary masks to a (new) <video>_mask.h5. Packing, compressing and writing happen in a background thread, so write() only has to queue the mask
+    (write() doesn't copy it -> Don't modify it afterwards). close() waits for every queued mask to be written (and raises any error the thread ran into)"""
+
+    def __init__(self, h5_filename, width, height, compression="gzip", queue_size=DEFAULT_STAGE_QUEUE_SIZE):
+        self.h5_filename = h5_filename
+        self.f_hdf5 = h5py.File(h5_filename, 'w')
+        self.f_hdf5.attrs['width'] = width
+        self.f_hdf5.attrs['height'] = height
+        packed_shape = (height, (width+7)//8)
+        self.masks = self.f_hdf5.create_dataset(HDF5_MASKS_NAME, shape=(0,) + packed_shape, maxshape=(None,) + packed_shape, dtype=np.uint8, chunks=(1,) + packed_shape, compression=compression)
+        self.num_frames = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="mask_writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    mask = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    if self.stop.is_set(): break  # Aborted
+                    continue
+                if mask is None or self.stop.is_set(): break  # Done, or aborted (the rest of the queue is dropped)
+                n = self.masks.shape[0]
+                self.masks.resize(n+1, axis=0)
+                self.masks[n] = np.packbits(mask > MASK_THRESHOLD, axis=-1)
+        except Exception as e:
+            self.error = e
+            self.stop.set()
+
+    def write(self, mask):
+        if not _put_unless_stopped(self.queue, mask, self.stop):
+            raise self.error if self.error is not None else RuntimeError("Mask writer for '{}' was aborted!".format(self.h5_filename))
+        self.num_frames += 1
+
+    def close(self):
+        """Writes every queued mask and closes the file"""
+        if self.f_hdf5 is None: return
+        _put_unless_stopped(self.queue, None, self.stop)
+        self.thread.join()
+        self.f_hdf5.close()
+        self.f_hdf5 = None
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        """Closes the file without waiting for the queued masks (e.g. something else failed)"""
+        if self.f_hdf5 is None: return
+        self.stop.set()
+        self.thread.join()
+        self.f_hdf5.close()
+        self.f_hdf5 = None
+
+
+class MaskH5Reader:
+    """Reads (ranges of) frames of a <video>_mask.h5 file. Frames are 0-based and masks are returned as (height, width) bool arrays"""
+
+    def __init__(self, h5_filename):
+        self.h5_filename = h5_filename
+        self.f_hdf5 = h5py.File(h5_filename, 'r')
+        self.masks = self.f_hdf5[HDF5_MASKS_NAME]
+        self.width = int(self.f_hdf5.attrs['width'])
+        self.height = int(self.f_hdf5.attrs['height'])
+        self.num_frames = self.masks.shape[0]
+        self._t = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f_hdf5.close()
+
+    def get_t(self):
+        """Float epoch timestamp of every frame (from the camera's <video>.h5)"""
+        if self._t is None:
+            from video_io import load_camera_timestamps
+            self._t = load_camera_timestamps(self.h5_filename[:-len(MASK_H5_SUFFIX)] + ".h5")
+        return self._t
+
+    def _unpack(self, packed):
+        return np.unpackbits(packed, axis=-1)[..., :self.width].view(bool)  # (np.unpackbits only takes count= since numpy 1.17)
+
+    def read_frame(self, frame_i):
+        """Mask of frame frame_i"""
+        return self._unpack(self.masks[int(frame_i)])
+
+    def read_frames(self, frame_a=0, frame_b=None):
+        """(# frames, height, width) masks of every frame in [frame_a, frame_b)"""
+        frame_b = self.num_frames if frame_b is None else min(frame_b, self.num_frames)
+        return self._unpack(self.masks[int(frame_a):int(max(frame_a, frame_b))])
+
+    def read_time_window(self, t_a=None, t_b=None):
+        """Returns (frame_nums, masks) for every frame taken in [t_a, t_b) (float epochs, None means no limit)"""
+        t = self.get_t()
+        frame_a = 0 if t_a is None else int(np.searchsorted(t, t_a))
+        frame_b = len(t) if t_b is None else int(np.searchsorted(t, t_b))
+        masks = self.read_frames(frame_a, frame_b)
+        return np.arange(frame_a, frame_a+len(masks)), masks
+
+
+def convert_png_masks(video_prefix, delete_pngs=False, compression="gzip"):
+    """Packs every background mask png of <video_prefix> (BACKGROUND_MASKS_FOLDER_NAME/<video>_mask_frameNNNNN.png) into <video_prefix>_mask.h5"""
+    mask_prefix = os.path.join(os.path.dirname(video_prefix), BACKGROUND_MASKS_FOLDER_NAME, os.path.basename(video_prefix) + "_mask")
+    png_filenames = sorted(glob.glob("{}_{}.png".format(mask_prefix, HDF5_FRAME_NAME_FORMAT.replace("{:05d}", "[0-9]"*5))))
+    if len(png_filenames) == 0:
+        print("No background mask pngs found for '{}', skipping...".format(video_prefix))
+        return None
+    assert png_filenames[-1] == "{}_{}.png".format(mask_prefix, HDF5_FRAME_NAME_FORMAT.format(len(png_filenames))), "Some background mask pngs of '{}' are missing!".format(video_prefix)
+
+    mask_writer = None
+    try:
+        for png_filename in png_filenames:
+            mask = cv2.imread(png_filename, cv2.IMREAD_GRAYSCALE)
+            if mask_writer is None:
+                mask_writer = MaskH5Writer(video_prefix + MASK_H5_SUFFIX + ".tmp", mask.shape[1], mask.shape[0], compression)
+            mask_writer.write(mask)
+        mask_writer.close()
+    except BaseException:
+        if mask_writer is not None: mask_writer.abort()
+        raise
+    os.rename(video_prefix + MASK_H5_SUFFIX + ".tmp", video_prefix + MASK_H5_SUFFIX)  # Only create the h5 once it's been fully written
+    if delete_pngs:
+        for png_filename in png_filenames:
+            os.remove(png_filename)
+    print("Packed {} background mask pngs of '{}' into '{}'".format(len(png_filenames), video_prefix, video_prefix + MASK_H5_SUFFIX))
+    return video_prefix + MASK_H5_SUFFIX
+
+
+class PngMasksConverter(ExperimentTraverser):
+    def __init__(self, main_folder, start_datetime=datetime.min, end_datetime=datetime.max, delete_pngs=False, compression="gzip"):
+        super(PngMasksConverter, self).__init__(main_folder, start_datetime, end_datetime)
+        self.delete_pngs = delete_pngs
+        self.compression = compression
+
+    def process_subfolder(self, f):
+        for video_filename in sorted(glob.glob(os.path.join(self.main_folder, f, "cam*_{}.mp4".format(f)))):
+            convert_png_masks(os.path.splitext(video_filename)[0], self.delete_pngs, self.compression)
+
+
+if __name__ == "__main__":
+    from aux_tools import str2bool
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", default="Dataset/Evaluation", help="Folder containing the experiment(s) whose background mask pngs to pack into <video>{}".format(MASK_H5_SUFFIX))
+    parser.add_argument("-s", "--start-datetime", default="", help="Only convert experiments collected later than this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument("-e", "--end-datetime", default="", help="Only convert experiments collected before this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument('-d', "--delete-pngs", default=False, type=str2bool, help="Whether or not to delete the pngs once they've been packed")
+    parser.add_argument('-c', "--compression", default="gzip", choices=("gzip", "lzf"), help="Compression filter (NOTE: MATLAB can't read lzf)")
+    args = parser.parse_args()
+
+    t_start = datetime.strptime(args.start_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.start_datetime) > 0 else datetime.min
+    t_end = datetime.strptime(args.end_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.end_datetime) > 0 else datetime.max
+
+    PngMasksConverter(args.folder, t_start, t_end, args.delete_pngs, args.compression).run()
@@ -0,0 +1,202 @@
+import numpy as np
+from preprocess_experiments import HDF5_FRAME_NAME_FORMAT, HDF5_SELECTED_FRAMES_NAME
+from aux_tools import ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
+from datetime import datetime
+import argparse
+import glob
+import h5py
+import os
+
+
+# <video>_objdet.h5 (and product_prediction_camN_<t>.h5) v2 (ragged) layout. Instead of one (# detections, 4+# classes) scores_all dataset per frame
+# (v1: frame00001, frame00002...), every frame's detections are concatenated:
+#  - attrs: version=2, num_classes
+#  - boxes: (total # detections, 4) float32 [x_min, y_min, x_max, y_max], chunked + compressed
+#  - scores: (total # detections, # classes) float32 (or float16), chunked + compressed
+#  - frame_offsets: (num_frames+1,) int64. Frame i (0-based) is rows frame_offsets[i]:frame_offsets[i+1] of boxes and scores
+# Either layout: if only some frames went through the detector (see frame_selection.py), selected: (num_frames,) uint8 says which (skipped frames have no detections)
+OBJDET_H5_VERSION = 2
+OBJDET_H5_CHUNK_LEN = 1024  # Frames buffered in memory before appending them to the file
+OBJDET_H5_CHUNK_BYTES = 64*1024  # Chunks are read (decompressed) whole -> Keep them small so reading a single frame stays cheap
+OBJDET_H5_CACHE_BYTES = 16*1024*1024  # Readers' chunk cache (consecutive frames are read from the same chunks)
+NUM_BOX_COORDS = 4
+HDF5_OBJDET_BOXES_NAME = "boxes"
+HDF5_OBJDET_SCORES_NAME = "scores"
+HDF5_FRAME_OFFSETS_NAME = "frame_offsets"
+
+
+class ObjdetH5Writer:
+    """Writes every frame's detections ((# detections, 4+# classes): box followed by the score of every class) to an open h5 file.
+    Which frames were selected (actually went through the detector) is recorded if record_selection or if any frame wasn't"""
+
+    def __init__(self, f_hdf5, layout_version=OBJDET_H5_VERSION, scores_dtype=np.float32, compression="gzip", record_selection=False):
+        self.f_hdf5 = f_hdf5
+        self.record_selection = record_selection
+        self.selected = []
+        self.layout_version = layout_version
+        self.scores_dtype = scores_dtype
+        self.compression = compression
+        self.num_frames = 0
+        self.num_cols = None  # 4+# classes (known once a frame with detections comes in)
+        self.frame_offsets = [0]
+        self.pending = []
+        if layout_version >= 2:
+            f_hdf5.attrs['version'] = layout_version
+
+    def append_frame(self, detections, selected=True):
+        self.selected.append(selected)
+        if self.layout_version < 2:
+            if selected:  # (v1 readers treat missing frames as frames without detections)
+                self.f_hdf5.create_dataset(HDF5_FRAME_NAME_FORMAT.format(self.num_frames+1), data=detections)
+        else:
+            detections = np.asarray(detections, dtype=np.float32)
+            if self.num_cols is None and detections.size > 0:
+                self.num_cols = detections.shape[1]
+            self.pending.append(detections)
+            self.frame_offsets.append(self.frame_offsets[-1] + (len(detections) if detections.size > 0 else 0))
+            if len(self.pending) >= OBJDET_H5_CHUNK_LEN and self.num_cols is not None:  # Until some frame has detections, we can't know the number of classes (but all pending frames are empty)
+                self._flush()
+        self.num_frames += 1
+
+    def _append_rows(self, name, rows):
+        if rows.shape[1] == 0:  # No classes (no detections at all) -> Nothing to chunk
+            self.f_hdf5.create_dataset(name, data=rows)
+            return
+        if name not in self.f_hdf5:
+            self.f_hdf5.create_dataset(name, shape=(0, rows.shape[1]), maxshape=(None, rows.shape[1]), dtype=rows.dtype, chunks=(max(OBJDET_H5_CHUNK_BYTES//(rows.shape[1]*rows.dtype.itemsize), 1), rows.shape[1]), compression=self.compression)
+        dataset = self.f_hdf5[name]
+        n = dataset.shape[0]
+        dataset.resize(n + len(rows), axis=0)
+        dataset[n:] = rows
+
+    def _flush(self):
+        rows = np.concatenate([d.reshape(-1, self.num_cols) for d in self.pending] + [np.zeros((0, self.num_cols), dtype=np.float32)])
+        self._append_rows(HDF5_OBJDET_BOXES_NAME, rows[:, :NUM_BOX_COORDS])
+        self._append_rows(HDF5_OBJDET_SCORES_NAME, rows[:, NUM_BOX_COORDS:].astype(self.scores_dtype))
+        self.pending = []
+
+    def close(self):
+        if self.record_selection or not all(self.selected):
+            self.f_hdf5.create_dataset(HDF5_SELECTED_FRAMES_NAME, data=np.array(self.selected, dtype=np.uint8), compression=self.compression)
+        if self.layout_version >= 2:
+            if self.num_cols is None: self.num_cols = NUM_BOX_COORDS  # No detections at all
+            self._flush()
+            self.f_hdf5.attrs['num_classes'] = self.f_hdf5[HDF5_OBJDET_SCORES_NAME].shape[1]
+            self.f_hdf5.create_dataset(HDF5_FRAME_OFFSETS_NAME, data=np.array(self.frame_offsets, dtype=np.int64), compression=self.compression)
+
+
+class ObjdetH5Reader:
+    """Reads the detections of (ranges of) frames of an object detection h5 file, in either the v1 (one dataset per frame) or the v2 (ragged) layout.
+    Frames are 0-based and every frame's detections are returned as a (# detections, 4+# classes) float32 array, same as v1's scores_all"""
+
+    def __init__(self, h5_filename):
+        self.h5_filename = h5_filename
+        self.f_hdf5 = h5py.File(h5_filename, 'r', rdcc_nbytes=OBJDET_H5_CACHE_BYTES)
+        self.version = int(self.f_hdf5.attrs.get('version', 1))
+        if self.version >= 2:
+            self.frame_offsets = self.f_hdf5[HDF5_FRAME_OFFSETS_NAME][:]
+            self.num_frames = len(self.frame_offsets) - 1
+            self.num_classes = int(self.f_hdf5.attrs['num_classes'])
+            self.boxes = self.f_hdf5[HDF5_OBJDET_BOXES_NAME]
+            self.scores = self.f_hdf5[HDF5_OBJDET_SCORES_NAME]
+        else:
+            frame_prefix = HDF5_FRAME_NAME_FORMAT.split('{')[0]
+            frame_ids = [int(name[len(frame_prefix):]) for name in self.f_hdf5 if name.startswith(frame_prefix)]  # Frames without detections may be missing
+            self.num_frames = max(frame_ids) if len(frame_ids) > 0 else 0
+            self.num_classes = next((d.shape[1]-NUM_BOX_COORDS for d in self.f_hdf5.values() if d.ndim == 2), 0)
+        self.has_selection = HDF5_SELECTED_FRAMES_NAME in self.f_hdf5
+        if self.has_selection:  # Only some frames went through the detector
+            self.selected = self.f_hdf5[HDF5_SELECTED_FRAMES_NAME][:] > 0
+            self.num_frames = max(self.num_frames, len(self.selected))
+        else:
+            self.selected = np.ones(self.num_frames, dtype=bool)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f_hdf5.close()
+
+    def read_frame(self, frame_i):
+        """Detections found in frame frame_i (empty if frame_i is out of range)"""
+        if not 0 <= frame_i < self.num_frames:
+            return np.zeros((0, NUM_BOX_COORDS + self.num_classes), dtype=np.float32)
+        return self.read_frames(frame_i, frame_i+1)[0]
+
+    def read_frames(self, frame_a=0, frame_b=None, split=True):
+        """Detections found in every frame in [frame_a, frame_b) (clipped to [0, num_frames)): a list with one array per frame if split, otherwise
+        (detections, offsets), where offsets (one entry per frame + 1) locate each frame's rows in detections. In v2, only the rows of those frames are read"""
+        frame_b = self.num_frames if frame_b is None else min(max(frame_b, 0), self.num_frames)
+        frame_a = min(max(frame_a, 0), frame_b)
+        num_cols = NUM_BOX_COORDS + self.num_classes
+        if self.version >= 2:
+            offsets = self.frame_offsets[frame_a:frame_b+1] - self.frame_offsets[frame_a]
+            n_a, n_b = int(self.frame_offsets[frame_a]), int(self.frame_offsets[frame_b])  # (h5py takes a much slower path when slicing with numpy ints)
+            detections = np.empty((n_b-n_a, num_cols), dtype=np.float32)
+            detections[:, :NUM_BOX_COORDS] = self.boxes[n_a:n_b]
+            detections[:, NUM_BOX_COORDS:] = self.scores[n_a:n_b]
+        else:
+            frames = []
+            for frame_i in range(frame_a, frame_b):
+                frame_i_str = HDF5_FRAME_NAME_FORMAT.format(frame_i+1)
+                frames.append(self.f_hdf5[frame_i_str][()].reshape(-1, num_cols).astype(np.float32) if frame_i_str in self.f_hdf5 else np.zeros((0, num_cols), dtype=np.float32))
+            if split:
+                return frames
+            detections = np.concatenate(frames) if len(frames) > 0 else np.zeros((0, num_cols), dtype=np.float32)
+            offsets = np.cumsum([0] + [len(d) for d in frames])
+
+        if split:
+            return np.split(detections, offsets[1:-1]) if frame_b > frame_a else []
+        return detections, offsets
+
+
+def migrate_objdet_h5(h5_filename, out_filename=None, scores_dtype=np.float32, compression="gzip"):
+    """Converts an object detection h5 file to the v2 (ragged) layout (in place, unless out_filename is given), OBJDET_H5_CHUNK_LEN frames at a time"""
+    with ObjdetH5Reader(h5_filename) as reader:
+        if reader.version >= OBJDET_H5_VERSION:
+            print("File {} already uses objdet layout v{}, nothing to do!".format(h5_filename, reader.version))
+            return h5_filename
+
+        out_filename = out_filename or h5_filename
+        with h5py.File(out_filename + ".tmp", 'w') as f_out:
+            f_out.attrs.update(reader.f_hdf5.attrs)
+            writer = ObjdetH5Writer(f_out, OBJDET_H5_VERSION, scores_dtype, compression, record_selection=reader.has_selection)
+            for frame_a in range(0, reader.num_frames, OBJDET_H5_CHUNK_LEN):
+                for frame_i, detections in enumerate(reader.read_frames(frame_a, frame_a+OBJDET_H5_CHUNK_LEN), frame_a):
+                    writer.append_frame(detections, reader.selected[frame_i])
+            writer.close()
+    os.rename(out_filename + ".tmp", out_filename)  # Only replace the original file once the new one has been fully written
+    print("Migrated detections of '{}' ({} frames) to layout v{} as '{}'".format(h5_filename, reader.num_frames, OBJDET_H5_VERSION, out_filename))
+    return out_filename
+
+
+class ObjdetH5Migrator(ExperimentTraverser):
+    def __init__(self, main_folder, start_datetime=datetime.min, end_datetime=datetime.max, scores_dtype=np.float32, compression="gzip"):
+        super(ObjdetH5Migrator, self).__init__(main_folder, start_datetime, end_datetime)
+        self.scores_dtype = scores_dtype
+        self.compression = compression
+
+    def process_subfolder(self, f):
+        for pattern in ("cam*_{}*_objdet.h5", "product_prediction_cam*_{}.h5"):
+            for h5_filename in sorted(glob.glob(os.path.join(self.main_folder, f, pattern.format(f)))):
+                migrate_objdet_h5(h5_filename, scores_dtype=self.scores_dtype, compression=self.compression)
+
+
+if __name__ == "__main__":
+    from aux_tools import str2bool
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", default="Dataset/Evaluation", help="Folder containing the experiment(s) whose object detection h5 files to migrate to the v{} layout".format(OBJDET_H5_VERSION))
+    parser.add_argument("-s", "--start-datetime", default="", help="Only migrate experiments collected later than this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument("-e", "--end-datetime", default="", help="Only migrate experiments collected before this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument('-c', "--compression", default="gzip", choices=("gzip", "lzf"), help="Compression filter (NOTE: MATLAB can't read lzf)")
+    parser.add_argument('-f16', "--float16", default=False, type=str2bool, help="Whether or not to store the class scores as float16 (half the size; NOTE: MATLAB can't read float16)")
+    args = parser.parse_args()
+
+    t_start = datetime.strptime(args.start_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.start_datetime) > 0 else datetime.min
+    t_end = datetime.strptime(args.end_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.end_datetime) > 0 else datetime.max
+
+    ObjdetH5Migrator(args.folder, t_start, t_end, np.float16 if args.float16 else np.float32, args.compression).run()
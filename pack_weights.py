@@ -0,0 +1,36 @@
+from read_dataset import pack_weight_segments, get_weight_pack_filename, is_weight_pack_stale
+from aux_tools import str2bool, ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
+from datetime import datetime
+import argparse
+import os
+
+
+class WeightSegmentsPacker(ExperimentTraverser):
+    def __init__(self, main_folder, start_datetime=datetime.min, end_datetime=datetime.max, overwrite=False):
+        super(WeightSegmentsPacker, self).__init__(main_folder, start_datetime, end_datetime)
+        self.overwrite = overwrite
+
+    def process_subfolder(self, f):
+        experiment_folder = os.path.join(self.main_folder, f)
+        pack_filename = get_weight_pack_filename(experiment_folder)
+        if os.path.exists(pack_filename) and not self.overwrite:
+            if not is_weight_pack_stale(experiment_folder, pack_filename, thorough=True):
+                print("File {} is up to date, not packing!".format(pack_filename))
+                return
+            print("File {} is out of date (sensor segments changed), packing again".format(pack_filename))
+
+        pack_weight_segments(experiment_folder, pack_filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", default="Dataset/Evaluation", help="Folder containing the experiment(s) whose weight segments to pack")
+    parser.add_argument("-s", "--start-datetime", default="", help="Only pack experiments collected later than this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument("-e", "--end-datetime", default="", help="Only pack experiments collected before this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument('-o', "--overwrite", default=False, type=str2bool, help="Whether or not to regenerate existing pack files (even if they're up to date)")
+    args = parser.parse_args()
+
+    t_start = datetime.strptime(args.start_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.start_datetime) > 0 else datetime.min
+    t_end = datetime.strptime(args.end_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.end_datetime) > 0 else datetime.max
+
+    WeightSegmentsPacker(args.folder, t_start, t_end, args.overwrite).run()
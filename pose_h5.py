@@ -0,0 +1,207 @@
+import numpy as np
+from preprocess_experiments import HDF5_POSE_GROUP_NAME, HDF5_HANDS_GROUP_NAME, HDF5_FRAME_NAME_FORMAT, HDF5_SELECTED_FRAMES_NAME
+from aux_tools import JointEnum, ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
+from datetime import datetime
+import argparse
+import glob
+import h5py
+import os
+
+
+# camN_<t>.h5 pose/hands v2 (columnar) layout. Instead of one dataset per frame (v1: pose/frame00001, hands/frame00001...), every frame is concatenated (CSR style):
+#  - pose.attrs['version'] = hands.attrs['version'] = 2
+#  - pose/keypoints: (total # people, # keypoints, 3) float32 [x, y, confidence], chunked + compressed
+#  - hands/data: (total # hands, 4) float32 [x, y, person_id, wrist_id], chunked + compressed
+#  - pose/frame_offsets, hands/frame_offsets: (num_frames+1,) int64. Frame i (0-based) is rows frame_offsets[i]:frame_offsets[i+1]
+# Either layout: if only some frames went through the pose model (see frame_selection.py), pose/selected: (num_frames,) uint8 says which (skipped frames are empty)
+POSE_H5_VERSION = 2
+POSE_H5_CHUNK_LEN = 1024  # Rows per chunk (and frames buffered in memory before appending them to the file)
+NUM_POSE_KEYPOINTS = len(JointEnum) - 1  # OpenPose's BODY_25 model (JointEnum also has BACKGND)
+HDF5_POSE_KEYPOINTS_NAME = "keypoints"
+HDF5_HANDS_DATA_NAME = "data"
+HDF5_FRAME_OFFSETS_NAME = "frame_offsets"
+
+
+class PoseH5Writer:
+    """Writes every frame's poses ((# people, # keypoints, 3)) and hands ((# hands, 4)) to the pose and hands groups of an open h5 file (replacing them if they existed).
+    Which frames were selected (actually went through the pose model) is recorded if record_selection or if any frame wasn't"""
+
+    def __init__(self, f_hdf5, layout_version=POSE_H5_VERSION, compression="gzip", record_selection=False):
+        for group_name in (HDF5_POSE_GROUP_NAME, HDF5_HANDS_GROUP_NAME):
+            if group_name in f_hdf5: del f_hdf5[group_name]  # OVERWRITE (delete if already existed)
+        self.pose = f_hdf5.create_group(HDF5_POSE_GROUP_NAME)
+        self.hands = f_hdf5.create_group(HDF5_HANDS_GROUP_NAME)
+        self.layout_version = layout_version
+        self.compression = compression
+        self.record_selection = record_selection
+        self.selected = []
+        self.num_frames = 0
+        self.pose_offsets = [0]
+        self.hands_offsets = [0]
+        self.pending_poses = []
+        self.pending_hands = []
+        if layout_version >= 2:
+            self.pose.attrs['version'] = self.hands.attrs['version'] = layout_version
+
+    def append_frame(self, poses, hands, selected=True):
+        self.selected.append(selected)
+        if self.layout_version < 2:
+            frame_i_str = HDF5_FRAME_NAME_FORMAT.format(self.num_frames+1)
+            self.pose.create_dataset(frame_i_str, data=poses)
+            self.hands.create_dataset(frame_i_str, data=hands)
+        else:
+            poses = np.asarray(poses, dtype=np.float32)
+            hands = np.asarray(hands, dtype=np.float32)
+            self.pending_poses.append(poses)
+            self.pending_hands.append(hands.reshape(-1, 4))
+            self.pose_offsets.append(self.pose_offsets[-1] + (len(poses) if poses.size > 0 else 0))
+            self.hands_offsets.append(self.hands_offsets[-1] + len(self.pending_hands[-1]))
+            if len(self.pending_poses) >= POSE_H5_CHUNK_LEN:
+                self._flush()
+        self.num_frames += 1
+
+    def _append_rows(self, group, name, rows):
+        if name not in group:
+            group.create_dataset(name, shape=(0,) + rows.shape[1:], maxshape=(None,) + rows.shape[1:], dtype=np.float32, chunks=(POSE_H5_CHUNK_LEN,) + rows.shape[1:], compression=self.compression)
+        dataset = group[name]
+        n = dataset.shape[0]
+        dataset.resize(n + len(rows), axis=0)
+        dataset[n:] = rows
+
+    def _flush(self):
+        non_empty = [p for p in self.pending_poses if p.size > 0]
+        num_keypoints = self.pose[HDF5_POSE_KEYPOINTS_NAME].shape[1] if HDF5_POSE_KEYPOINTS_NAME in self.pose else (non_empty[0].shape[1] if len(non_empty) > 0 else NUM_POSE_KEYPOINTS)
+        self._append_rows(self.pose, HDF5_POSE_KEYPOINTS_NAME, np.concatenate([p.reshape(-1, num_keypoints, 3) for p in self.pending_poses]) if len(self.pending_poses) > 0 else np.zeros((0, num_keypoints, 3), dtype=np.float32))
+        self._append_rows(self.hands, HDF5_HANDS_DATA_NAME, np.concatenate(self.pending_hands) if len(self.pending_hands) > 0 else np.zeros((0, 4), dtype=np.float32))
+        self.pending_poses = []
+        self.pending_hands = []
+
+    def close(self):
+        if self.record_selection or not all(self.selected):
+            self.pose.create_dataset(HDF5_SELECTED_FRAMES_NAME, data=np.array(self.selected, dtype=np.uint8), compression=self.compression)
+        if self.layout_version >= 2:
+            self._flush()
+            self.pose.create_dataset(HDF5_FRAME_OFFSETS_NAME, data=np.array(self.pose_offsets, dtype=np.int64), compression=self.compression)
+            self.hands.create_dataset(HDF5_FRAME_OFFSETS_NAME, data=np.array(self.hands_offsets, dtype=np.int64), compression=self.compression)
+
+
+class PoseH5Reader:
+    """Reads the poses and hands of (ranges of) frames of a camN_<t>.h5 file, in either the v1 (one dataset per frame) or the v2 (columnar) layout.
+    Frames are 0-based, poses are returned as (# people, # keypoints, 3) and hands as (# hands, 4) arrays"""
+
+    def __init__(self, h5_filename):
+        self.h5_filename = h5_filename
+        self.f_hdf5 = h5py.File(h5_filename, 'r')
+        self.pose = self.f_hdf5[HDF5_POSE_GROUP_NAME]
+        self.hands = self.f_hdf5[HDF5_HANDS_GROUP_NAME]
+        self.version = int(self.pose.attrs.get('version', 1))
+        if self.version >= 2:
+            self.pose_offsets = self.pose[HDF5_FRAME_OFFSETS_NAME][:]
+            self.hands_offsets = self.hands[HDF5_FRAME_OFFSETS_NAME][:]
+            self.num_frames = len(self.pose_offsets) - 1
+            self.num_keypoints = self.pose[HDF5_POSE_KEYPOINTS_NAME].shape[1]
+        else:
+            self.num_frames = len([name for name in self.pose if name.startswith(HDF5_FRAME_NAME_FORMAT.split('{')[0])])
+            self.num_keypoints = NUM_POSE_KEYPOINTS
+        self.has_selection = HDF5_SELECTED_FRAMES_NAME in self.pose
+        self.selected = self.pose[HDF5_SELECTED_FRAMES_NAME][:] > 0 if self.has_selection else np.ones(self.num_frames, dtype=bool)
+        self._t = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f_hdf5.close()
+
+    def get_t(self):
+        """Float epoch timestamp of every frame"""
+        if self._t is None:
+            from video_io import load_camera_timestamps
+            self._t = load_camera_timestamps(self.h5_filename)
+        return self._t
+
+    def read_frame(self, frame_i):
+        """Returns (poses, hands) of frame frame_i"""
+        poses, hands = self.read_frames(frame_i, frame_i+1)
+        return poses[0], hands[0]
+
+    def read_frames(self, frame_a=0, frame_b=None):
+        """Returns (poses, hands): lists with the poses and hands of every frame in [frame_a, frame_b). In v2, only the rows of those frames are read"""
+        frame_b = self.num_frames if frame_b is None else min(frame_b, self.num_frames)
+        if frame_b <= frame_a:
+            return [], []
+        if self.version >= 2:
+            keypoints = self.pose[HDF5_POSE_KEYPOINTS_NAME][int(self.pose_offsets[frame_a]):int(self.pose_offsets[frame_b])]  # (h5py takes a much slower path when slicing with numpy ints)
+            hands_data = self.hands[HDF5_HANDS_DATA_NAME][int(self.hands_offsets[frame_a]):int(self.hands_offsets[frame_b])]
+            return np.split(keypoints, self.pose_offsets[frame_a+1:frame_b]-self.pose_offsets[frame_a]), np.split(hands_data, self.hands_offsets[frame_a+1:frame_b]-self.hands_offsets[frame_a])
+
+        poses, hands = [], []
+        for frame_i in range(frame_a, frame_b):
+            frame_i_str = HDF5_FRAME_NAME_FORMAT.format(frame_i+1)
+            poses.append(self.pose[frame_i_str][()].reshape(-1, self.num_keypoints, 3))
+            hands.append(self.hands[frame_i_str][()].reshape(-1, 4))
+        return poses, hands
+
+    def read_time_window(self, t_a=None, t_b=None):
+        """Returns (frame_nums, poses, hands) for every frame taken in [t_a, t_b) (float epochs, None means no limit)"""
+        t = self.get_t()
+        frame_a = 0 if t_a is None else int(np.searchsorted(t, t_a))
+        frame_b = len(t) if t_b is None else int(np.searchsorted(t, t_b))
+        poses, hands = self.read_frames(frame_a, frame_b)
+        return np.arange(frame_a, frame_a+len(poses)), poses, hands
+
+
+def migrate_pose_h5(h5_filename, out_filename=None, compression="gzip"):
+    """Converts the pose and hands groups of a camN_<t>.h5 file to the v2 (columnar) layout (in place, unless out_filename is given). Everything else in the file is copied as is"""
+    with PoseH5Reader(h5_filename) as reader:
+        if reader.version >= POSE_H5_VERSION:
+            print("File {} already uses pose layout v{}, nothing to do!".format(h5_filename, reader.version))
+            return h5_filename
+        poses, hands = reader.read_frames()
+
+        out_filename = out_filename or h5_filename
+        with h5py.File(out_filename + ".tmp", 'w') as f_out:
+            f_out.attrs.update(reader.f_hdf5.attrs)
+            for name in reader.f_hdf5:
+                if name not in (HDF5_POSE_GROUP_NAME, HDF5_HANDS_GROUP_NAME):
+                    reader.f_hdf5.copy(name, f_out)
+            writer = PoseH5Writer(f_out, POSE_H5_VERSION, compression, record_selection=reader.has_selection)
+            for frame_poses, frame_hands, selected in zip(poses, hands, reader.selected):
+                writer.append_frame(frame_poses, frame_hands, selected)
+            writer.close()
+    os.rename(out_filename + ".tmp", out_filename)  # Only replace the original file once the new one has been fully written
+    print("Migrated poses of '{}' ({} frames) to layout v{} as '{}'".format(h5_filename, len(poses), POSE_H5_VERSION, out_filename))
+    return out_filename
+
+
+class PoseH5Migrator(ExperimentTraverser):
+    def __init__(self, main_folder, start_datetime=datetime.min, end_datetime=datetime.max, compression="gzip"):
+        super(PoseH5Migrator, self).__init__(main_folder, start_datetime, end_datetime)
+        self.compression = compression
+
+    def process_subfolder(self, f):
+        for h5_filename in sorted(glob.glob(os.path.join(self.main_folder, f, "cam*_{}.h5".format(f)))):
+            with h5py.File(h5_filename, 'r') as f_hdf5:
+                has_pose = HDF5_POSE_GROUP_NAME in f_hdf5
+            if not has_pose:
+                print("File {} has no poses, skipping...".format(h5_filename))
+                continue
+
+            migrate_pose_h5(h5_filename, compression=self.compression)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", default="Dataset/Evaluation", help="Folder containing the experiment(s) whose camN_<t>.h5 poses to migrate to the v{} layout".format(POSE_H5_VERSION))
+    parser.add_argument("-s", "--start-datetime", default="", help="Only migrate experiments collected later than this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument("-e", "--end-datetime", default="", help="Only migrate experiments collected before this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument('-c', "--compression", default="gzip", choices=("gzip", "lzf"), help="Compression filter (NOTE: MATLAB can't read lzf)")
+    args = parser.parse_args()
+
+    t_start = datetime.strptime(args.start_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.start_datetime) > 0 else datetime.min
+    t_end = datetime.strptime(args.end_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.end_datetime) > 0 else datetime.max
+
+    PoseH5Migrator(args.folder, t_start, t_end, args.compression).run()
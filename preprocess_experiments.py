@@ -1,36 +1,49 @@
 import cv2
 import numpy as np
-from aux_tools import str2bool, _min, _max, ensure_folder_exists, format_axis_as_timedelta, JointEnum, save_datetime_to_h5, ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
+from video_io import FanOutFrameSource, FrameStage, BackgroundWorker
+from aux_tools import str2bool, _min, _max, ensure_folder_exists, format_axis_as_timedelta, JointEnum, save_datetime_to_h5, append_datetime_to_h5, append_to_h5, epoch_to_datetime, ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
 from datetime import datetime
 from multiprocessing import Pool, cpu_count
+import threading
 import traceback
+import shutil
 import glob
 import argparse
 import h5py
 import json
+import time
 import os
 
 
-class BackgroundSubtractor:
-    def __init__(self):
-        self.fgbg = cv2.bgsegm.createBackgroundSubtractorGSOC()
-        self.fgbg2 = cv2.bgsegm.createBackgroundSubtractorMOG()
-        self.fgbg3 = cv2.bgsegm.createBackgroundSubtractorGMG()
-        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-
-    def runGMG(self, frame):
-        mask = self.fgbg3.apply(frame)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
-        return mask
-
-    def runMOG(self, frame):
-        return self.fgbg2.apply(frame)
+BACKGROUND_SUBTRACTION_ALGORITHMS = {  # GSOC, MOG and GMG need opencv-contrib (cv2.bgsegm)
+    "GSOC": lambda: cv2.bgsegm.createBackgroundSubtractorGSOC(),
+    "MOG": lambda: cv2.bgsegm.createBackgroundSubtractorMOG(),
+    "GMG": lambda: cv2.bgsegm.createBackgroundSubtractorGMG(),
+    "MOG2": lambda: cv2.createBackgroundSubtractorMOG2(),
+    "KNN": lambda: cv2.createBackgroundSubtractorKNN(),
+}
 
-    def runGSOC(self, frame):
-        return self.fgbg.apply(frame)
 
-    def run(self, frame):
-        return self.runGSOC(frame)
+class BackgroundSubtractor:
+    """Runs one of BACKGROUND_SUBTRACTION_ALGORITHMS on every frame. If scale < 1, frames are downscaled before subtracting the background
+    (much faster, the models' cost grows with the # of pixels) and masks are upscaled back to the frame's size (and re-binarized)"""
+
+    def __init__(self, algorithm="GSOC", scale=1.0):
+        self.algorithm = algorithm
+        self.scale = scale
+        self.fgbg = BACKGROUND_SUBTRACTION_ALGORITHMS[algorithm]()  # Only create the model we'll use
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)) if algorithm == "GMG" else None  # GMG's masks are noisy -> Open them
+
+    def run(self, frame, upscale=True):
+        """Returns the frame's foreground mask (uint8: 0 or 255). If not upscale, at the downscaled size"""
+        small_frame = frame if self.scale == 1 else cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        mask = self.fgbg.apply(small_frame)
+        if self.kernel is not None:
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+        if self.scale != 1 and upscale:
+            mask = cv2.resize(mask, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR)
+            mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]  # Smooth edges instead of blocky ones, but still binary
+        return mask
 
 
 HDF5_FRAME_NAME_FORMAT = "frame{:05d}"
@@ -40,175 +53,685 @@ HDF5_ORIG_WEIGHT_GROUP_NAME = "orig_weights"
 HDF5_WEIGHT_GROUP_NAME = "weight_{}"
 HDF5_WEIGHT_T_NAME = "t"
 HDF5_WEIGHT_DATA_NAME = "w"
+HDF5_SEGMENTS_MANIFEST_NAME = "segments_manifest"
+HDF5_SELECTED_FRAMES_NAME = "selected"  # (See frame_selection.py)
+STALE_ARTIFACT_SUFFIX = ".stale"  # (See VisionArtifacts)
 BACKGROUND_MASKS_FOLDER_NAME = "background_masks"
 
 
-def preprocess_weight(parent_folder, do_tare=False, visualize=False):
-    from read_dataset import read_weights_data
-    from matplotlib import pyplot as plt
+def _weight_inputs(parent_folder):
+    """Files preprocess_weight reads: the raw sensor data (pack file if any, see read_dataset.pack_weight_segments) and the calibration"""
+    from read_dataset import get_weight_pack_filename, get_weight_calibration_filename
+    return sorted(glob.glob(os.path.join(parent_folder, "sensors_*"))) + [get_weight_pack_filename(parent_folder), get_weight_calibration_filename()]  # (Absolute, so the key doesn't depend on the working directory)
+
+
+def preprocess_weight(parent_folder, do_tare=False, visualize=False, num_workers=1, chunk_duration=None, resample_mode="cubic", F_samp=60, incremental=False, layout_version=1):
+    from artifact_cache import ArtifactCache
 
     print("Processing weights at {}".format(parent_folder))
     t_start = os.path.basename(parent_folder)
 
     h5_filename = os.path.join(parent_folder, "weights_{}.h5".format(t_start))
-    if os.path.exists(h5_filename):
-        print("File {} exists, not preprocessing!".format(h5_filename))
+    cache = ArtifactCache(parent_folder)
+    cache_params = {"do_tare": do_tare, "resample_mode": resample_mode, "F_samp": F_samp, "layout_version": layout_version}  # (Chunking doesn't change the output)
+    if incremental and os.path.exists(h5_filename) and not _is_incremental_weights_h5(h5_filename):
+        print("WARNING: '{}' was created by a non-incremental run, so new segments can't be appended to it. Processing it as usual instead (delete it to switch it to incremental)".format(h5_filename))
+        incremental = False
+    if incremental:  # Only ingest segments that weren't in the file yet (creates the file if it doesn't exist)
+        if layout_version != 1:
+            raise ValueError("Incremental weight preprocessing needs to append to the v1 layout (layout_version=1)")
+        _preprocess_weight_incremental(parent_folder, h5_filename, do_tare, resample_mode, F_samp)
+    elif cache.is_fresh(h5_filename, "weight", _weight_inputs(parent_folder), cache_params):
+        print("File {} is up to date, not preprocessing!".format(h5_filename))
         return
+    else:  # (Regenerated into a temporary file: a stale h5 is only replaced once the new one is complete)
+        if chunk_duration is not None:  # NOTE: visualize needs the whole experiment in memory -> Not supported when streaming
+            _preprocess_weight_chunked(parent_folder, h5_filename, chunk_duration, do_tare, resample_mode, F_samp, num_workers, layout_version)
+        else:
+            _preprocess_weight_full(parent_folder, h5_filename, do_tare, visualize, num_workers, resample_mode, F_samp, layout_version)
+    cache.record(h5_filename, "weight", _weight_inputs(parent_folder), cache_params)
+    return h5_filename
 
-    weight_t, weight_data, weights_orig = read_weights_data(parent_folder, do_tare=do_tare)
-    with h5py.File(h5_filename, 'w') as f_hdf5:
-        save_datetime_to_h5(weight_t, f_hdf5, HDF5_WEIGHT_T_NAME)
-        f_hdf5.create_dataset("w", data=weight_data)
 
-        # Save original weight info as well, just in case
-        orig_weights_group = f_hdf5.create_group(HDF5_ORIG_WEIGHT_GROUP_NAME)
-        for weight_id, weight_info in weights_orig.items():
-            orig_weight = orig_weights_group.create_group(HDF5_WEIGHT_GROUP_NAME.format(weight_id))
-            save_datetime_to_h5(weight_info['t'], orig_weight, HDF5_WEIGHT_T_NAME)
-            orig_weight.create_dataset(HDF5_WEIGHT_DATA_NAME, data=weight_info['w'])
+def _preprocess_weight_full(parent_folder, h5_filename, do_tare=False, visualize=False, num_workers=1, resample_mode="cubic", F_samp=60, layout_version=1):
+    from read_dataset import read_weights_data
+    from matplotlib import pyplot as plt
 
-            if visualize:
-                fig = plt.figure(figsize=(4, 2))
-                ax = fig.subplots()
-                ax.plot([(t - weight_t[0]).total_seconds() for t in weight_t], weight_data)
-                ax.set_title('Load cell #{}'.format(weight_id))
-                ax.set_ylabel('Weight (g)')
-                format_axis_as_timedelta(ax.xaxis)
-                fig.show()
+    weight_t, weight_data, weights_orig = read_weights_data(parent_folder, F_samp=F_samp, num_workers=num_workers, resample_mode=resample_mode, do_tare=do_tare)
+    if layout_version == 2:  # Chunked, compressed, no timestamp strings (see weights_h5.py)
+        from weights_h5 import save_weights_h5_v2
+        save_weights_h5_v2(h5_filename + ".tmp", weight_t[0], F_samp, weight_data, weights_orig, {'resample_mode': resample_mode})
+    else:
+        with h5py.File(h5_filename + ".tmp", 'w') as f_hdf5:
+            f_hdf5.attrs['resample_mode'] = resample_mode
+            f_hdf5.attrs['F_samp'] = F_samp
+            save_datetime_to_h5(weight_t, f_hdf5, HDF5_WEIGHT_T_NAME)
+            f_hdf5.create_dataset(HDF5_WEIGHT_DATA_NAME, data=weight_data)
+
+            # Save original weight info as well, just in case
+            orig_weights_group = f_hdf5.create_group(HDF5_ORIG_WEIGHT_GROUP_NAME)
+            for weight_id, weight_info in weights_orig.items():
+                orig_weight = orig_weights_group.create_group(HDF5_WEIGHT_GROUP_NAME.format(weight_id))
+                save_datetime_to_h5(weight_info['t'], orig_weight, HDF5_WEIGHT_T_NAME)
+                orig_weight.create_dataset(HDF5_WEIGHT_DATA_NAME, data=weight_info['w'])
+    os.replace(h5_filename + ".tmp", h5_filename)
+
+    if visualize:
+        for weight_id in weights_orig.keys():
+            fig = plt.figure(figsize=(4, 2))
+            ax = fig.subplots()
+            ax.plot(weight_t - weight_t[0], weight_data)
+            ax.set_title('Load cell #{}'.format(weight_id))
+            ax.set_ylabel('Weight (g)')
+            format_axis_as_timedelta(ax.xaxis)
+            fig.show()
+
+    print("Done processing weights as '{}'! t_min={}; t_max={}; N={}".format(h5_filename, epoch_to_datetime(weight_t[0]), epoch_to_datetime(weight_t[-1]), weight_data.shape))
+
+
+def _preprocess_weight_chunked(parent_folder, h5_filename, chunk_duration, do_tare=False, resample_mode="cubic", F_samp=60, num_workers=1, layout_version=1):
+    from read_dataset import iter_resampled_weights
+
+    # Resample chunk_duration seconds at a time and append each window to resizable datasets (peak memory doesn't depend on the experiment length)
+    N = 0
+    windows = iter_resampled_weights(parent_folder, F_samp=F_samp, chunk_duration=chunk_duration, do_tare=do_tare, resample_mode=resample_mode, num_workers=num_workers)
+    if layout_version == 2:  # Straight to the v2 layout (see weights_h5.py), no need to write a v1 file and convert it
+        from weights_h5 import WeightsH5V2Writer
+        with WeightsH5V2Writer(h5_filename + ".tmp", F_samp, {'resample_mode': resample_mode}) as writer:
+            for weight_t, weight_data, weights_orig in windows:
+                writer.append(weight_t, weight_data, weights_orig)
+                print("Resampled {} weight samples from '{}' so far...".format(writer.num_samples, parent_folder))
+        os.replace(h5_filename + ".tmp", h5_filename)
+        print("Done processing weights as '{}'! t_min={}; t_max={}; N={}".format(h5_filename, epoch_to_datetime(writer.t0), epoch_to_datetime(writer.t_end), writer.num_samples))
+        return
 
-    print("Done processing weights as '{}'! t_min={}; t_max={}; N={}".format(h5_filename, weight_t[0], weight_t[-1], weight_data.shape))
+    with h5py.File(h5_filename + ".tmp", 'w') as f_hdf5:
+        f_hdf5.attrs['resample_mode'] = resample_mode
+        f_hdf5.attrs['F_samp'] = F_samp
+        orig_weights_group = f_hdf5.create_group(HDF5_ORIG_WEIGHT_GROUP_NAME)
+        for weight_t, weight_data, weights_orig in windows:
+            if len(weight_t) > 0:
+                append_datetime_to_h5(weight_t, f_hdf5, HDF5_WEIGHT_T_NAME)
+                append_to_h5(f_hdf5, HDF5_WEIGHT_DATA_NAME, weight_data)
+                N += len(weight_t)
+
+            # Save original weight info as well, just in case
+            for weight_id, weight_info in weights_orig.items():
+                orig_weight = orig_weights_group.require_group(HDF5_WEIGHT_GROUP_NAME.format(weight_id))
+                append_datetime_to_h5(weight_info['t'], orig_weight, HDF5_WEIGHT_T_NAME)
+                append_to_h5(orig_weight, HDF5_WEIGHT_DATA_NAME, weight_info['w'])
+            print("Resampled {} weight samples from '{}' so far...".format(N, parent_folder))
+        t_str = f_hdf5[HDF5_WEIGHT_T_NAME + "_str"]
+        t_min, t_max = t_str[0], t_str[-1]
+    os.replace(h5_filename + ".tmp", h5_filename)  # Don't leave a partial file behind (it would be skipped on the next run), nor lose the previous one
+
+    print("Done processing weights as '{}'! t_min={}; t_max={}; N={}".format(h5_filename, t_min.decode('utf8'), t_max.decode('utf8'), N))
+
+
+def _read_h5_tail(t_dataset, t_min):
+    """Returns the index of the first sample of t_dataset (sorted) that could be >= t_min, without reading the whole dataset"""
+    i = len(t_dataset)
+    step = 4096
+    while i > 0 and t_dataset[i-1] >= t_min:
+        i = _max(i-step, 0)
+        step *= 2
+    return i
+
+
+def _is_incremental_weights_h5(h5_filename):
+    with h5py.File(h5_filename, 'r') as f_hdf5:
+        return HDF5_SEGMENTS_MANIFEST_NAME in f_hdf5
+
+
+def _preprocess_weight_incremental(parent_folder, h5_filename, do_tare=False, resample_mode="cubic", F_samp=60, overlap=2):
+    from read_dataset import parse_weight_calibration, scan_weight_segments, read_weight_segment, merge_weight_segments, resample_weight
+
+    weight_calib = parse_weight_calibration()
+    segments = scan_weight_segments(parent_folder)
+    with h5py.File(h5_filename, 'a') as f_hdf5:
+        if HDF5_SEGMENTS_MANIFEST_NAME in f_hdf5:  # Resume: new samples have to be resampled the same way as the ones already in the file
+            manifest = f_hdf5[HDF5_SEGMENTS_MANIFEST_NAME][:]
+            file_settings = (f_hdf5.attrs['resample_mode'], float(f_hdf5.attrs['F_samp']), bool(f_hdf5.attrs['do_tare']))
+            if file_settings != (resample_mode, float(F_samp), bool(do_tare)):
+                raise ValueError("'{}' was created with resample_mode={}, F_samp={}, do_tare={}, can't append to it with resample_mode={}, F_samp={}, do_tare={} (delete it to start over)".format(h5_filename, *(file_settings + (resample_mode, F_samp, do_tare))))
+        elif len(f_hdf5.keys()) > 0:  # (Created by a non-incremental run, see preprocess_weight)
+            raise ValueError("'{}' wasn't created incrementally, can't append to it".format(h5_filename))
+        else:  # New file
+            manifest = np.zeros(0, dtype=segments.dtype)
+            f_hdf5.attrs['resample_mode'] = resample_mode
+            f_hdf5.attrs['F_samp'] = F_samp
+            f_hdf5.attrs['do_tare'] = do_tare
+        orig_weights_group = f_hdf5.require_group(HDF5_ORIG_WEIGHT_GROUP_NAME)
+
+        # Figure out which segments are new. If a segment we already ingested changed, we can't patch it in place -> Rebuild
+        ingested = dict(((m['plate_id'], m['filename']), (m['size'], m['mtime'])) for m in manifest)
+        is_new = np.array([(m['plate_id'], m['filename']) not in ingested for m in segments], dtype=bool)
+        needs_rebuild = any(ingested[(m['plate_id'], m['filename'])] != (m['size'], m['mtime']) for m in segments[~is_new])
+        new_segments = segments[is_new]
+        print("Found {} new weight segments in '{}' ({} already ingested)".format(len(new_segments), parent_folder, len(manifest)))
+
+        # Decode, calibrate and append new segments to orig_weights, one plate at a time
+        for plate_id in ([] if needs_rebuild else np.unique(new_segments['plate_id'])):
+            plate_inds = np.flatnonzero(new_segments['plate_id'] == plate_id)
+            sensor_folder = os.path.join(parent_folder, "sensors_{}".format(plate_id))
+            decoded = [read_weight_segment(os.path.join(sensor_folder, new_segments['filename'][i].decode('utf8'))) for i in plate_inds]
+            for i, (t, _) in zip(plate_inds, decoded):
+                new_segments['t_first'][i], new_segments['t_last'][i] = t[0], t[-1]
+            weight_t, weight_data, _ = merge_weight_segments(decoded, int(plate_id), weight_calib)
+
+            orig_weight = orig_weights_group.require_group(HDF5_WEIGHT_GROUP_NAME.format(plate_id))
+            if HDF5_WEIGHT_T_NAME in orig_weight:
+                t_dataset = orig_weight[HDF5_WEIGHT_T_NAME]
+                if weight_t[0] < t_dataset.attrs['t0'] + t_dataset[-1] - 1e-6:  # Late segment (older than samples we already appended)
+                    needs_rebuild = True
+                    break
+            elif HDF5_WEIGHT_T_NAME in f_hdf5:  # New plate showed up after the resampled time grid was already fixed
+                needs_rebuild = True
+                break
+            elif do_tare:  # Tare it (same as read_weight_data, remember the offset for future runs)
+                orig_weight.attrs['tare'] = weight_data[0:60].mean()
+            if do_tare:
+                weight_data -= orig_weight.attrs['tare'].astype(weight_data.dtype)
+            append_datetime_to_h5(weight_t, orig_weight, HDF5_WEIGHT_T_NAME)
+            append_to_h5(orig_weight, HDF5_WEIGHT_DATA_NAME, weight_data)
+
+        if not needs_rebuild:
+            append_to_h5(f_hdf5, HDF5_SEGMENTS_MANIFEST_NAME, new_segments)
+            _resample_weight_incremental(f_hdf5, weight_calib, resample_mode, F_samp, overlap)
+
+    if needs_rebuild:
+        print("Previously ingested weight data in '{}' changed, rebuilding it from scratch...".format(h5_filename))
+        os.remove(h5_filename)
+        return _preprocess_weight_incremental(parent_folder, h5_filename, do_tare, resample_mode, F_samp, overlap)
+
+
+def _resample_weight_incremental(f_hdf5, weight_calib, resample_mode, F_samp, overlap):
+    from read_dataset import resample_weight
+
+    # Time span covered by every plate (same as read_weights_data)
+    plates = {}
+    for group_name, orig_weight in f_hdf5[HDF5_ORIG_WEIGHT_GROUP_NAME].items():
+        t_dataset = orig_weight[HDF5_WEIGHT_T_NAME]
+        plates[int(group_name.rsplit('_', 1)[1])] = (orig_weight, t_dataset.attrs['t0'] + t_dataset[0], t_dataset.attrs['t0'] + t_dataset[-1])
+    if len(plates) == 0:
+        return
+    t_earliest_end = min(t_last for _, _, t_last in plates.values())
+    if HDF5_WEIGHT_T_NAME in f_hdf5:
+        t_latest_start = f_hdf5[HDF5_WEIGHT_T_NAME].attrs['t0']
+        n_old = len(f_hdf5[HDF5_WEIGHT_T_NAME])
+    else:
+        t_latest_start = max(t_first for _, t_first, _ in plates.values())
+        n_old = 0
+
+    # Resampled timestamps are t_latest_start + n/F_samp. Also recompute the last overlap seconds we had already written, since back then
+    # the cubic spline couldn't see any samples past the end
+    dt = 1.0/F_samp
+    N = int(np.ceil((t_earliest_end-t_latest_start)/dt))
+    if N <= n_old:
+        return
+    n_redo = _max(n_old - int(overlap*F_samp), 0)
+    t = t_latest_start + dt*np.arange(n_redo, N)
+    if HDF5_WEIGHT_DATA_NAME in f_hdf5:
+        w_shape = f_hdf5[HDF5_WEIGHT_DATA_NAME].shape[:2]
+    else:
+        w_shape = (max(weight_calib[p]['shelf_id'] for p in plates), max(weight_calib[p]['plate_num'] for p in plates))
+    w = np.zeros(w_shape + (len(t),), dtype=np.float32)
+    for plate_id, (orig_weight, _, _) in plates.items():
+        t_dataset = orig_weight[HDF5_WEIGHT_T_NAME]
+        i = _read_h5_tail(t_dataset, t[0] - overlap - t_dataset.attrs['t0'])  # Only need the raw samples around the part we're resampling
+        weight_t = t_dataset[i:] + (t_dataset.attrs['t0'] - t_latest_start)  # Interpolate relative to t_latest_start (better float precision than raw epochs)
+        calib_info = weight_calib[plate_id]
+        w[calib_info['shelf_id']-1, calib_info['plate_num']-1, :] = resample_weight(weight_t, orig_weight[HDF5_WEIGHT_DATA_NAME][i:], t - t_latest_start, resample_mode)
+
+    # Overwrite the redone part and append the rest
+    if n_redo < n_old:
+        f_hdf5[HDF5_WEIGHT_DATA_NAME][:, :, n_redo:n_old] = w[:, :, :n_old-n_redo]
+    append_datetime_to_h5(t[n_old-n_redo:], f_hdf5, HDF5_WEIGHT_T_NAME)
+    append_to_h5(f_hdf5, HDF5_WEIGHT_DATA_NAME, w[:, :, n_old-n_redo:])
+    print("Resampled weights now span N={} samples ({} new)".format(N, N-n_old))
+
+
+OBJDET_BATCH_SIZE = 15  # Frames per MaskRCNN inference call (initially, see AdaptiveBatchSize)
+OBJDET_MAX_BATCH_SIZE = 60  # (Every frame in a batch and the next one are kept in memory)
+OBJDET_MAX_BATCH_LATENCY = 10.0  # Seconds. Don't grow batches beyond this
+OBJDET_WRITER_QUEUE_BATCHES = 2  # Inferred batches waiting to be written
+OPENPOSE_JSON_FORMAT = "{}_{:012d}_keypoints.json"  # Same name OpenPose's write_json gives each frame's json (<video name>_<frame>_keypoints.json)
+
+
+def _get_frame_poses_and_hands(people_keypoints, wrist_thresh=0.2):
+    """Returns the pose of each person found in a frame and the position of every wrist detected with high enough confidence"""
+    hands_info = []
+    poses = []
+    for i_person,keypoints in enumerate(people_keypoints):
+        keypoints = np.reshape(keypoints, (-1,3))
+        poses.append(keypoints)
+
+        # Look for hands with high enough confidence and crop an image around each one
+        for i_wrist in (JointEnum.LWRIST.value, JointEnum.RWRIST.value):
+            if keypoints[i_wrist,-1] > wrist_thresh:  # Found a wrist with high enough confidence
+                center = keypoints[i_wrist, 0:2]
+                hands_info.append(np.hstack((center, i_person, i_wrist)))  # [x, y, person_id, wrist_id] (wrist_id see JointEnum, 4=Right;7=Left)
+    return poses, hands_info
+
+
+def _run_in_background(target, *args):
+    """Starts target(*args) in its own thread. Returns a function that waits for it to finish (and re-raises whatever exception it raised)"""
+    errors = []
+
+    def run():
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, name=target.__name__)
+    thread.start()
+
+    def wait():
+        thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+    return wait
+
+
+def _pose_jsons_exist(pose_prefix):
+    return os.path.exists(pose_prefix) and len(os.listdir(pose_prefix)) > 0
+
+
+def _parse_pose_jsons(pose_prefix, h5_filename, wrist_thresh=0.2, layout_version=1):
+    """Combines OpenPose's json files (one per frame) into the pose and hands groups of h5_filename (layout_version: see pose_h5.py)"""
+    from pose_h5 import PoseH5Writer
+    with h5py.File(h5_filename, 'a') as f_hdf5:
+        pose_writer = PoseH5Writer(f_hdf5, layout_version)
+        for json_filename in sorted(os.listdir(pose_prefix)):
+            with open(os.path.join(pose_prefix, json_filename)) as f_json:
+                data = json.load(f_json)
+            pose_writer.append_frame(*_get_frame_poses_and_hands([p["pose_keypoints_2d"] for p in data["people"]], wrist_thresh), selected=not data.get("skipped", False))
+        pose_writer.close()
+
+
+class BackgroundSubtractionStage(FrameStage):
+    """Writes <video>_mask.mp4 (every frame with its background removed) and every frame's background mask: one png per frame in BACKGROUND_MASKS_FOLDER_NAME
+    (mask_format="png") or all of them bit-packed into <video>_mask.h5 (mask_format="h5", see mask_h5.py). algorithm and scale: see BackgroundSubtractor"""
+    name = "background_subtraction"
+
+    def __init__(self, video_filename, mask_format="png", algorithm="GSOC", scale=1.0):
+        self.video_prefix = os.path.splitext(video_filename)[0]  # Remove extension
+        self.mask_prefix = os.path.join(os.path.dirname(self.video_prefix), BACKGROUND_MASKS_FOLDER_NAME, os.path.basename(self.video_prefix) + "_mask")
+        self.mask_format = mask_format
+        self.algorithm = algorithm
+        self.scale = scale
+        self.video_mask = None
+        self.mask_writer = None
+
+    def start(self, video_info):
+        if self.mask_format == "h5":
+            from mask_h5 import MaskH5Writer, MASK_H5_SUFFIX
+            self.mask_writer = MaskH5Writer(self.video_prefix + MASK_H5_SUFFIX, video_info['width'], video_info['height'])
+        else:
+            ensure_folder_exists(os.path.dirname(self.mask_prefix))  # Create folder if it didn't exist
+        self.video_mask = cv2.VideoWriter("{}_mask.mp4".format(self.video_prefix), cv2.VideoWriter_fourcc(*'avc1'), 25.0, (video_info['width'], video_info['height']))
+        self.bgnd_subtractor = BackgroundSubtractor(self.algorithm, self.scale)
+
+    def process(self, frame_num, frame):
+        background_mask = self.bgnd_subtractor.run(frame)
+        self.video_mask.write(cv2.bitwise_and(frame, frame, mask=background_mask))
+        if self.mask_writer is not None:
+            self.mask_writer.write(background_mask)
+        else:
+            cv2.imwrite("{}_{}.png".format(self.mask_prefix, HDF5_FRAME_NAME_FORMAT.format(frame_num+1)), background_mask)
 
+    def flush(self):
+        if self.mask_writer is not None:
+            self.mask_writer.close()  # Wait for the writer thread to write every mask
 
-def preprocess_vision_object_detection(video_filename, gpu_id, config_file="configs/aim3s.yaml", confidence_thresh=0.1, categories_file="../aim3s_dataset/aim3s.names", generate_video=True):
-    from maskrcnn_benchmark.config import cfg
-    from predictor_skus import SKUsDemo
+    def finish(self):
+        if self.video_mask is not None:
+            self.video_mask.release()
+        if self.mask_writer is not None:
+            self.mask_writer.abort()  # No-op if flush() already closed it
 
-    video_prefix = os.path.splitext(video_filename)[0]  # Remove extension
-    file_prefix = video_prefix + "_objdet"
-
-    # Load MaskRCNN config
-    cfg.merge_from_file(config_file)
-    cfg.MODEL.DEVICE = gpu_id  # Run the model on the specified gpu
-    #cfg.freeze()
-
-    # Load category names
-    with open(categories_file) as f:
-        categories = f.readlines()
-
-    # Prepare object that handles inference plus adds predictions on top of image
-    model = SKUsDemo(
-        cfg,
-        categories=categories,
-        confidence_threshold=confidence_thresh,
-    )
-
-    # Initialize video
-    v = cv2.VideoCapture(video_filename)
-    N = v.get(cv2.CAP_PROP_FRAME_COUNT)
-    n = 0
-    if generate_video:
-        v_out = cv2.VideoWriter("{}.mp4".format(file_prefix), cv2.VideoWriter_fourcc(*'mp4v'), 25.0,
-            (int(v.get(cv2.CAP_PROP_FRAME_WIDTH)), int(v.get(cv2.CAP_PROP_FRAME_HEIGHT))))
-
-    # Process video
-    with h5py.File("{}.h5".format(file_prefix), 'w') as f:
-        while n < N:  # Read every frame
-            images = []
-            while n < N and len(images) < 15:  # Read a block of frames
-                ok, img = v.read()
-                assert ok, "Couldn't read frame from video {}".format(video_filename)
-                images.append(img)
-                n += 1
-
-            # Process frame block
-            preds = model.compute_prediction_list(images)
-
-            for i, predictions in enumerate(preds):
-                predictions = model.select_top_predictions(predictions)
-                f.create_dataset(HDF5_FRAME_NAME_FORMAT.format(n-len(preds)+i+1), data=predictions.get_field("scores_all").numpy())
-
-                if generate_video:
-                    img = model.overlay_boxes(images[i], predictions)
-                    img = model.overlay_class_names(img, predictions)
-                    v_out.write(img)
-
-                # Display progress
-                #if n % 25 == 0:
-            print("Processed frame {}/{} for video {} ({:.2f}%)".format(n, N, video_filename, 100.*n/N))
-
-    if generate_video:
-        v_out.release()
-
-
-def preprocess_vision(video_filename, pose_model_folder, wrist_thresh=0.2, crop_half_w=100, crop_half_h=100):
-    print("Processing video '{}'...".format(video_filename))
-    video_prefix = os.path.splitext(video_filename)[0]  # Remove extension
-    pose_prefix = video_prefix + "_pose"
-    mask_prefix = os.path.join(os.path.dirname(video_prefix), BACKGROUND_MASKS_FOLDER_NAME, os.path.basename(video_prefix) + "_mask")
-    ensure_folder_exists(os.path.dirname(mask_prefix))  # Create folder if it didn't exist
 
-    # Run Openpose to find people and their poses
-    if os.path.exists(pose_prefix) and len(os.listdir(pose_prefix)) > 0:
-        print("Folder '{}' exists, not running Openpose!".format(pose_prefix))
-    else:
-        from openpose import pyopenpose as op
-        openpose_params = {
-            "model_folder": pose_model_folder,
-            "video": video_filename,
-            "write_video": pose_prefix + ".mp4",
-            "write_json": pose_prefix,  # Will create the folder and save a json per frame in the video
-            "display": 0,
-            "render_pose": 1,  # 1 for CPU (slightly faster), 2 for GPU
-        }
-        openpose_wrapper = op.WrapperPython(3)
-        openpose_wrapper.configure(openpose_params)
-        openpose_wrapper.execute()  # Blocking call
-        print("Openpose done processing video '{}'!".format(video_filename))
-
-    # Initialize background subtractor
-    video_orig = cv2.VideoCapture(video_filename)
-    video_mask = cv2.VideoWriter("{}_mask.mp4".format(video_prefix), cv2.VideoWriter_fourcc(*'avc1'), 25.0,
-            (int(video_orig.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video_orig.get(cv2.CAP_PROP_FRAME_HEIGHT))))
-    bgnd_subtractor = BackgroundSubtractor()
-
-    # Postprocess json files (one per frame) + combine into a single hdf file, as well as compute bgnd subtraction mask
-    with h5py.File(video_prefix + ".h5", 'a') as f_hdf5:
-        if HDF5_POSE_GROUP_NAME in f_hdf5: del f_hdf5[HDF5_POSE_GROUP_NAME]  # OVERWRITE (delete if already existed)
-        if HDF5_HANDS_GROUP_NAME in f_hdf5: del f_hdf5[HDF5_HANDS_GROUP_NAME]
-        pose = f_hdf5.create_group(HDF5_POSE_GROUP_NAME)
-        hands = f_hdf5.create_group(HDF5_HANDS_GROUP_NAME)
-
-        # Parse every json (every frame of video_orig)
-        for frame_i,json_filename in enumerate(sorted(os.listdir(pose_prefix))):
-            frame_i_str = HDF5_FRAME_NAME_FORMAT.format(frame_i+1)
-            _, frame_img = video_orig.read()
-
-            # Run background subtractor
-            background_mask = bgnd_subtractor.run(frame_img)
-            background_removed_img = cv2.bitwise_and(frame_img, frame_img, mask=background_mask)
-            video_mask.write(background_removed_img)
-
-            # Parse frame json
-            with open(os.path.join(pose_prefix, json_filename)) as f_json:
-                data = json.load(f_json)
+class PoseEstimationStage(FrameStage):
+    """Runs a pose model (OpenPose unless model says otherwise, see vision_models.POSE_MODELS) on the decoded frames and writes what OpenPose's own video mode
+    would: one json per frame in <video>_pose/, the rendered <video>_pose.mp4, plus the pose and hands groups of <video>.h5"""
+    name = "pose"
 
-            # Parse pose for each person found
-            hands_info = []
-            poses = []
-            for i_person,p in enumerate(data["people"]):
-                keypoints = np.reshape(p["pose_keypoints_2d"], (-1,3))
-                poses.append(keypoints)
-
-                # Look for hands with high enough confidence and crop an image around each one
-                for i_wrist in (JointEnum.LWRIST.value, JointEnum.RWRIST.value):
-                    if keypoints[i_wrist,-1] > wrist_thresh:  # Found a wrist with high enough confidence
-                        center = keypoints[i_wrist, 0:2]
-                        hands_info.append(np.hstack((center, i_person, i_wrist)))  # [x, y, person_id, wrist_id] (wrist_id see JointEnum, 4=Right;7=Left)
-            pose.create_dataset(frame_i_str, data=poses)
-            hands.create_dataset(frame_i_str, data=hands_info)
-            cv2.imwrite("{}_{}.png".format(mask_prefix, frame_i_str), background_mask)
-
-    video_mask.release()
+    def __init__(self, video_filename, pose_model_folder, gpu_id=None, wrist_thresh=0.2, layout_version=1, model="openpose", record_selection=False):
+        self.video_prefix = os.path.splitext(video_filename)[0]  # Remove extension
+        self.pose_prefix = self.video_prefix + "_pose"
+        self.pose_model_folder = pose_model_folder
+        self.gpu_id = gpu_id
+        self.wrist_thresh = wrist_thresh
+        self.layout_version = layout_version
+        self.model_name = model
+        self.record_selection = record_selection
+        self.video_pose = None
+        self.f_hdf5 = None
+        self.pose_writer = None
+
+    def start(self, video_info):
+        from vision_models import get_resident_model
+        self.model = get_resident_model("pose", self.model_name, model_folder=self.pose_model_folder, gpu_id=self.gpu_id)  # Only loaded the first time this process needs it
+
+        ensure_folder_exists(self.pose_prefix)
+        self.video_pose = cv2.VideoWriter(self.pose_prefix + ".mp4", cv2.VideoWriter_fourcc(*'avc1'), video_info['fps'], (video_info['width'], video_info['height']))
+        from pose_h5 import PoseH5Writer
+        self.f_hdf5 = h5py.File(self.video_prefix + ".h5", 'a')
+        self.pose_writer = PoseH5Writer(self.f_hdf5, self.layout_version, record_selection=self.record_selection)
+
+    def process(self, frame_num, frame):
+        people_keypoints, rendered = self.model.predict(frame)
+        self._write_frame(frame_num, people_keypoints, rendered, True)
+
+    def skip(self, frame_num, frame):
+        self._write_frame(frame_num, [], frame, False)  # Nobody, and the frame as is
+
+    def _write_frame(self, frame_num, people_keypoints, rendered, selected):
+        frame_json = {"version": 1.3, "people": [{"person_id": [-1], "pose_keypoints_2d": keypoints.ravel().tolist()} for keypoints in people_keypoints]}
+        if not selected: frame_json["skipped"] = True  # (So _parse_pose_jsons can tell skipped frames apart from frames with nobody in them)
+        with open(os.path.join(self.pose_prefix, OPENPOSE_JSON_FORMAT.format(os.path.basename(self.video_prefix), frame_num)), 'w') as f_json:
+            json.dump(frame_json, f_json)
+        self.video_pose.write(rendered)
+        self.pose_writer.append_frame(*_get_frame_poses_and_hands(people_keypoints, self.wrist_thresh), selected=selected)
+
+    def finish(self):
+        if self.video_pose is not None:
+            self.video_pose.release()
+        if self.pose_writer is not None:
+            self.pose_writer.close()
+        if self.f_hdf5 is not None:
+            self.f_hdf5.close()
+
+
+class AdaptiveBatchSize:
+    """Picks the size of the next inference batch from how long the previous ones took: keeps doubling it (up to max_size) while that improves the throughput and
+    a batch takes less than max_latency seconds, halves it when a batch is too slow or throughput was better with smaller batches. Running out of memory also lowers max_size"""
+
+    def __init__(self, initial_size, max_size, max_latency=OBJDET_MAX_BATCH_LATENCY, min_size=1):
+        self.max_size = max(max_size, min_size)
+        self.min_size = min_size
+        self.size = min(max(initial_size, min_size), self.max_size)
+        self.max_latency = max_latency
+        self.fps = {}  # Measured throughput (frames/s, moving average) of every batch size tried
+
+    def update(self, batch_size, latency):
+        if batch_size != self.size: return  # Last (partial) batch or batch split after running out of memory -> Not representative
+        fps = batch_size / max(latency, 1e-9)
+        self.fps[batch_size] = fps if batch_size not in self.fps else (self.fps[batch_size] + fps) / 2
+        bigger, smaller = min(2*self.size, self.max_size), max(self.size//2, self.min_size)
+        if latency > self.max_latency or self.fps.get(smaller, 0) > self.fps[self.size]:
+            self.size = smaller
+        elif latency*bigger/self.size <= self.max_latency and self.fps[self.size] >= self.fps.get(smaller, 0) and self.fps.get(bigger, np.inf) > self.fps[self.size]:
+            self.size = bigger  # (Only keep growing while growing helped)
+
+    def on_out_of_memory(self, batch_size):
+        self.max_size = max(batch_size//2, self.min_size)
+        self.size = min(self.size, self.max_size)
+
+
+def _is_out_of_memory_error(e):
+    return isinstance(e, MemoryError) or "out of memory" in str(e).lower()  # (torch raises a RuntimeError: "CUDA out of memory...")
+
+
+class ObjectDetectionStage(FrameStage):
+    """Runs a detection model (MaskRCNN unless model says otherwise, see vision_models.DETECTION_MODELS) on batches of frames: writes every frame's
+    scores_all to <video>_objdet.h5 (layout_version: see objdet_h5.py) (+ the predictions overlaid on <video>_objdet.mp4).
+    Pipelined: FanOutFrameSource keeps decoding the next batch while the model runs (the stage's queue fits a whole batch), outputs are written from a
+    background thread, and the batch size adapts (from batch_size up to max_batch_size, see AdaptiveBatchSize) to how fast the model turns out to be"""
+    name = "objdet"
+
+    def __init__(self, video_filename, gpu_id, config_file="configs/aim3s.yaml", confidence_thresh=0.1, categories_file="../aim3s_dataset/aim3s.names", generate_video=True, batch_size=OBJDET_BATCH_SIZE, layout_version=1, scores_dtype=np.float32, model="maskrcnn", max_batch_size=OBJDET_MAX_BATCH_SIZE, record_selection=False):
+        self.video_filename = video_filename
+        self.file_prefix = os.path.splitext(video_filename)[0] + "_objdet"
+        self.gpu_id = gpu_id
+        self.config_file = config_file
+        self.confidence_thresh = confidence_thresh
+        self.categories_file = categories_file
+        self.generate_video = generate_video
+        self.batch_size = batch_size
+        self.max_batch_size = max(max_batch_size, batch_size)
+        self.queue_size = self.max_batch_size  # Prefetch: let the decoder get a whole batch ready while the model runs
+        self.layout_version = layout_version
+        self.scores_dtype = scores_dtype
+        self.model_name = model
+        self.record_selection = record_selection
+        self.frames = []  # (frame, selected) of every frame waiting for the current batch (skipped frames are only passed on to the writer)
+        self.num_images = 0  # Selected frames in self.frames
+        self.num_frames_done = 0
+        self.f_hdf5 = None
+        self.objdet_writer = None
+        self.v_out = None
+        self.output_writer = None
+        self.stats = {'frames': 0, 'batches': 0, 't_inference': 0.0}
+
+    def start(self, video_info):
+        from vision_models import get_resident_model
+        self.model = get_resident_model("detector", self.model_name, gpu_id=self.gpu_id, config_file=self.config_file, confidence_thresh=self.confidence_thresh, categories_file=self.categories_file)  # Only loaded the first time this process needs it
+
+        self.N = video_info['num_frames']
+        from objdet_h5 import ObjdetH5Writer
+        self.f_hdf5 = h5py.File("{}.h5".format(self.file_prefix), 'w')
+        self.objdet_writer = ObjdetH5Writer(self.f_hdf5, self.layout_version, self.scores_dtype, record_selection=self.record_selection)
+        if self.generate_video:
+            self.v_out = cv2.VideoWriter("{}.mp4".format(self.file_prefix), cv2.VideoWriter_fourcc(*'mp4v'), 25.0, (video_info['width'], video_info['height']))
+        self.batch_sizer = AdaptiveBatchSize(self.batch_size, self.max_batch_size)
+        self.output_writer = BackgroundWorker(self._write_batch, queue_size=OBJDET_WRITER_QUEUE_BATCHES, name="objdet_writer")
+
+    def process(self, frame_num, frame):
+        self.frames.append((frame, True))
+        self.num_images += 1
+        if self.num_images >= self.batch_sizer.size:
+            self._process_batch()
+
+    def skip(self, frame_num, frame):
+        self.frames.append((frame, False))
+        if self.num_images == 0:  # Nothing to wait for
+            self._process_batch()
+
+    def flush(self):
+        if len(self.frames) > 0:
+            self._process_batch()
+        self.output_writer.close()
+        self.print_stats()
+
+    def _predict(self, images):
+        try:
+            return self.model.predict(images, render=self.generate_video)  # (Models draw on copies: frames are shared with other stages)
+        except Exception as e:
+            if len(images) <= 1 or not _is_out_of_memory_error(e): raise
+        # Batch didn't fit in memory -> Use smaller batches from now on, and split this one in two
+        self.batch_sizer.on_out_of_memory(len(images))
+        print("Ran out of memory running object detection on {} frames of video {}, max batch size is now {}".format(len(images), self.video_filename, self.batch_sizer.max_size))
+        try:
+            import torch
+            torch.cuda.empty_cache()
+        except ImportError:
+            pass
+        half = len(images)//2
+        detections_a, rendered_a = self._predict(images[:half])
+        detections_b, rendered_b = self._predict(images[half:])
+        return detections_a + detections_b, (rendered_a + rendered_b) if self.generate_video else None
+
+    def _process_batch(self):
+        frames = self.frames
+        self.frames = []
+        self.num_images = 0
+        images = [frame for frame, selected in frames if selected]
+        detections, rendered = iter(()), iter(())
+        if len(images) > 0:
+            t = time.time()
+            detections, rendered = self._predict(images)
+            latency = time.time()-t
+            self.batch_sizer.update(len(images), latency)
+            self.stats['t_inference'] += latency
+            self.stats['frames'] += len(images)
+            self.stats['batches'] += 1
+            detections, rendered = iter(detections), iter(rendered or ())
+
+        # Skipped frames: no detections (None), and the frame as is in the overlay video
+        frames_detections = [next(detections) if selected else None for frame, selected in frames]
+        frames_rendered = [next(rendered) if selected else frame for frame, selected in frames] if self.generate_video else None
+        self.output_writer.put(frames_detections, frames_rendered)  # Only blocks if the writer falls OBJDET_WRITER_QUEUE_BATCHES batches behind
+        self.num_frames_done += len(frames)
+        if len(images) == 0: return
+
+        # Display progress
+        print("Processed frame {}/{} for video {} ({:.2f}%, batch of {} frames took {:.2f}s, next batch: {} frames)".format(self.num_frames_done, self.N, self.video_filename, 100.*self.num_frames_done/max(self.N, 1), len(images), latency, self.batch_sizer.size))
+
+    def _write_batch(self, detections, rendered):
+        for i, frame_detections in enumerate(detections):
+            if frame_detections is None:
+                self.objdet_writer.append_frame(np.zeros((0, 0), dtype=np.float32), selected=False)
+            else:
+                self.objdet_writer.append_frame(frame_detections)
+            if self.generate_video:
+                self.v_out.write(rendered[i])
+
+    def print_stats(self):
+        writer_stats = self.output_writer.stats
+        print("Object detection on '{}': {} frames in {} batches ({} frames skipped)".format(self.video_filename, self.stats['frames'], self.stats['batches'], self.num_frames_done-self.stats['frames']))
+        print("\tinference: {:.2f}s ({:.1f} fps), batch sizes tried (fps): {}".format(self.stats['t_inference'], self.stats['frames']/max(self.stats['t_inference'], 1e-9), ", ".join("{} ({:.1f})".format(b, fps) for b, fps in sorted(self.batch_sizer.fps.items()))))
+        print("\twriter: {:.2f}s ({:.1f} fps), inference blocked on it for {:.2f}s".format(writer_stats['t_busy'], self.stats['frames']/max(writer_stats['t_busy'], 1e-9), writer_stats['t_backpressure']))
+
+    def finish(self):
+        if self.output_writer is not None:
+            self.output_writer.abort()  # (Already closed, unless something failed)
+        if self.v_out is not None:
+            self.v_out.release()
+        if self.objdet_writer is not None:
+            self.objdet_writer.close()
+        if self.f_hdf5 is not None:
+            self.f_hdf5.close()
+
+
+def _create_frame_selector(video_filename, frame_selection):
+    if frame_selection is None:
+        return None
+    from frame_selection import create_frame_selector
+    return create_frame_selector(video_filename, **frame_selection)
+
+
+class VisionArtifacts:
+    """Cache bookkeeping (see artifact_cache.py) of the outputs of a video's vision stages: each stage's main output is reused if it's fresh (same video,
+    parameters and frame selection inputs), and recorded along with its overlay video (regenerable, unlike the main output) once the stages are done.
+    Stale outputs are moved aside (<artifact>.stale) while they're regenerated: only deleted once the stages succeed, put back if they fail"""
+
+    def __init__(self, video_filename, frame_selection=None):
+        from artifact_cache import ArtifactCache
+        from frame_selection import frame_selection_inputs
+        self.video_filename = video_filename
+        self.video_prefix = os.path.splitext(video_filename)[0]
+        self.cache = ArtifactCache(os.path.dirname(video_filename))
+        self.selection_inputs = frame_selection_inputs(video_filename, **frame_selection) if frame_selection is not None else []
+        self.to_record = []
+        self.set_aside = []
+
+    def is_fresh(self, stage, artifact, params, uses_selection=True, adopt_untracked=True):
+        self._put_back(artifact)  # (In case a previous run died while regenerating it)
+        inputs = [self.video_filename] + (self.selection_inputs if uses_selection else [])
+        if self.cache.is_fresh(artifact, stage, inputs, params, adopt_untracked):
+            print("'{}' is up to date, not running {} on '{}'!".format(artifact, stage, self.video_filename))
+            return True
+        if os.path.exists(artifact):  # (Out of the way: e.g. the jsons of a previous pose run would get mixed up with the new ones)
+            os.replace(artifact, artifact + STALE_ARTIFACT_SUFFIX)
+            self.set_aside.append(artifact)
+        return False
+
+    def _put_back(self, artifact):
+        if os.path.exists(artifact + STALE_ARTIFACT_SUFFIX):
+            _remove_path(artifact)  # (Partial output of the run that failed)
+            os.replace(artifact + STALE_ARTIFACT_SUFFIX, artifact)
+
+    def will_generate(self, stage, artifact, params, overlay=None, uses_selection=True, regenerable=False):
+        inputs = [self.video_filename] + (self.selection_inputs if uses_selection else [])
+        self.to_record.append((artifact, stage, inputs, params, regenerable))
+        if overlay is not None:
+            self.to_record.append((overlay, stage, inputs, params, True))
+
+    def record(self):
+        """Once the stages succeeded: records their outputs and deletes the stale ones they replace"""
+        for artifact, stage, inputs, params, regenerable in self.to_record:
+            if os.path.exists(artifact):
+                self.cache.record(artifact, stage, inputs, params, regenerable)
+        for artifact in self.set_aside:
+            _remove_path(artifact + STALE_ARTIFACT_SUFFIX)
+        self.set_aside = []
+
+    def restore(self):
+        """If the stages failed: puts the stale outputs back (they're still stale, so they'll be regenerated next time)"""
+        for artifact in self.set_aside:
+            self._put_back(artifact)
+        self.set_aside = []
+
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def preprocess_vision_object_detection(video_filename, gpu_id, config_file="configs/aim3s.yaml", confidence_thresh=0.1, categories_file="../aim3s_dataset/aim3s.names", generate_video=True, layout_version=1, scores_dtype=np.float32, model="maskrcnn", max_batch_size=OBJDET_MAX_BATCH_SIZE, frame_selection=None):
+    """frame_selection: kwargs of frame_selection.create_frame_selector, to only run the detector on some frames (None: on every frame)"""
+    video_prefix = os.path.splitext(video_filename)[0]
+    artifacts = VisionArtifacts(video_filename, frame_selection)
+    objdet_params = {"model": model, "config_file": config_file, "confidence_thresh": confidence_thresh, "categories_file": categories_file, "layout_version": layout_version, "scores_dtype": scores_dtype, "frame_selection": frame_selection}
+    if artifacts.is_fresh("objdet", video_prefix + "_objdet.h5", objdet_params): return
+    artifacts.will_generate("objdet", video_prefix + "_objdet.h5", objdet_params, video_prefix + "_objdet.mp4" if generate_video else None)
+    try:
+        selector = _create_frame_selector(video_filename, frame_selection)
+        FanOutFrameSource(video_filename, [ObjectDetectionStage(video_filename, gpu_id, config_file, confidence_thresh, categories_file, generate_video, layout_version=layout_version, scores_dtype=scores_dtype, model=model, max_batch_size=max_batch_size, record_selection=selector is not None)], selector).run()
+    except BaseException:
+        artifacts.restore()
+        raise
+    artifacts.record()
+
+
+def preprocess_vision(video_filename, pose_model_folder, wrist_thresh=0.2, crop_half_w=100, crop_half_h=100, pose_layout_version=1, mask_format="png", bgnd_algorithm="GSOC", bgnd_scale=1.0, pose_model="openpose", frame_selection=None):
+    """Pose estimation (unless OpenPose's jsons are up to date) + background subtraction, on a single decode of the video (see preprocess_video)"""
+    preprocess_video(video_filename, None, True, False, pose_model_folder, wrist_thresh, pose_layout_version, mask_format=mask_format, bgnd_algorithm=bgnd_algorithm, bgnd_scale=bgnd_scale, pose_model=pose_model, frame_selection=frame_selection)
+
+
+def preprocess_video(video_filename, gpu_id=0, do_pose=True, do_objdet=True, pose_model_folder="openpose-models/", wrist_thresh=0.2, pose_layout_version=1, objdet_layout_version=1, objdet_scores_dtype=np.float32, mask_format="png", bgnd_algorithm="GSOC", bgnd_scale=1.0, pose_model="openpose", objdet_model="maskrcnn", objdet_max_batch_size=OBJDET_MAX_BATCH_SIZE, frame_selection=None):
+    """Same outputs as preprocess_vision (if do_pose) + preprocess_vision_object_detection (if do_objdet), but decoding the video only once for all of them.
+    frame_selection: kwargs of frame_selection.create_frame_selector, to only run pose and object detection on some frames (background subtraction sees them all)
+    Outputs that are up to date (see VisionArtifacts) aren't generated again"""
+    print("Processing video '{}' (single decode)...".format(video_filename))
+    video_prefix = os.path.splitext(video_filename)[0]  # Remove extension
+    artifacts = VisionArtifacts(video_filename, frame_selection)
+    stages = []
+    wait_pose_jsons = lambda: None
+    if do_pose:
+        from mask_h5 import MASK_H5_SUFFIX
+        bgnd_params = {"algorithm": bgnd_algorithm, "scale": bgnd_scale}
+        if mask_format != "h5":  # (One png per frame, in a folder shared by all cameras -> Not cached, always regenerated)
+            stages.append(BackgroundSubtractionStage(video_filename, mask_format, bgnd_algorithm, bgnd_scale))
+        elif not artifacts.is_fresh("background_subtraction", video_prefix + MASK_H5_SUFFIX, bgnd_params, uses_selection=False, adopt_untracked=False):  # (Cheap to regenerate)
+            artifacts.will_generate("background_subtraction", video_prefix + MASK_H5_SUFFIX, bgnd_params, video_prefix + "_mask.mp4", uses_selection=False, regenerable=True)
+            stages.append(BackgroundSubtractionStage(video_filename, mask_format, bgnd_algorithm, bgnd_scale))
+    selector = _create_frame_selector(video_filename, frame_selection)  # (Once stale masks are gone, so motion gating doesn't use them)
+    if do_pose:
+        pose_params = {"model": pose_model, "frame_selection": frame_selection}
+        if _pose_jsons_exist(video_prefix + "_pose") and artifacts.is_fresh("pose", video_prefix + "_pose", pose_params):  # Openpose already ran -> Just combine its jsons (while the stages run)
+            wait_pose_jsons = _run_in_background(_parse_pose_jsons, video_prefix + "_pose", video_prefix + ".h5", wrist_thresh, pose_layout_version)
+        else:
+            artifacts.will_generate("pose", video_prefix + "_pose", pose_params, video_prefix + "_pose.mp4")
+            stages.append(PoseEstimationStage(video_filename, pose_model_folder, gpu_id, wrist_thresh, pose_layout_version, pose_model, record_selection=selector is not None))
+    if do_objdet:
+        objdet_params = {"model": objdet_model, "config_file": "configs/aim3s.yaml", "confidence_thresh": 0.1, "categories_file": "../aim3s_dataset/aim3s.names", "layout_version": objdet_layout_version, "scores_dtype": objdet_scores_dtype, "frame_selection": frame_selection}  # (Same as preprocess_vision_object_detection's)
+        if not artifacts.is_fresh("objdet", video_prefix + "_objdet.h5", objdet_params):
+            artifacts.will_generate("objdet", video_prefix + "_objdet.h5", objdet_params, video_prefix + "_objdet.mp4")
+            stages.append(ObjectDetectionStage(video_filename, gpu_id, layout_version=objdet_layout_version, scores_dtype=objdet_scores_dtype, model=objdet_model, max_batch_size=objdet_max_batch_size, record_selection=selector is not None))
+    try:
+        if len(stages) > 0:
+            FanOutFrameSource(video_filename, stages, selector).run()
+            artifacts.record()
+    except BaseException:
+        artifacts.restore()
+        raise
+    finally:
+        wait_pose_jsons()
     print("Done processing video '{}'!".format(video_filename))
 
 
@@ -222,75 +745,111 @@ def _crop_image(img, center, half_w, half_h):
     return img[y_min:y_max+1, x_min:x_max+1, :]
 
 
+# Rough peak needs of every kind of ExperimentPreProcessor task (see task_scheduler.Task's resources): video tasks decode + background-subtract on their own CPU
+PREPROCESS_TASK_RESOURCES = {
+    "weight": {"cpu": 1, "memory": 4e9},
+    "weight_chunked": {"cpu": 1, "memory": 1e9},
+    "vision": {"cpu": 2, "memory": 2e9},
+    "objdet": {"cpu": 1, "memory": 3e9},
+    "video": {"cpu": 2, "memory": 4e9},
+}
+
+
 class ExperimentPreProcessor(ExperimentTraverser):
-    def __init__(self, main_folder, start_datetime=datetime.min, end_datetime=datetime.max, do_weight=True, do_pose=True, do_objdet=True, pose_model_folder="openpose-models/", num_processes_weight=cpu_count(), num_processes_vision=3, num_processes_objdet=4, num_gpus=3):
+    """Preprocesses every experiment's weights and videos. Every piece of work is a task_scheduler.Task that declares its input/output files (e.g. with
+    gate_events, vision tasks wait for their experiment's weights) and the resources it needs: CPUs (num_cpus), memory (max_memory bytes, all of it if None)
+    and, for object detection, a slot on one of the num_gpus GPUs (num_processes_objdet each). Tasks run on long-lived pools as soon as both are available"""
+
+    def __init__(self, main_folder, start_datetime=datetime.min, end_datetime=datetime.max, do_weight=True, do_pose=True, do_objdet=True, pose_model_folder="openpose-models/", num_processes_weight=cpu_count(), num_processes_vision=3, num_processes_objdet=4, num_gpus=3, weight_chunk_duration=None, weight_resample_mode="cubic", weight_incremental=False, weight_layout_version=1, single_decode=False, pose_layout_version=1, objdet_layout_version=1, objdet_float16=False, mask_format="png", bgnd_algorithm="GSOC", bgnd_scale=1.0, pose_model="openpose", objdet_model="maskrcnn", preload_models=True, objdet_max_batch_size=OBJDET_MAX_BATCH_SIZE, gate_events=False, gate_motion=False, gate_n_vision=3.0, gate_motion_thresh=0.005, num_cpus=cpu_count(), max_memory=None, max_retries=1, summary_interval=30, cache_max_size=None):
+        from vision_models import init_model_worker
+        from task_scheduler import TaskScheduler, get_total_memory
         super(ExperimentPreProcessor, self).__init__(main_folder, start_datetime, end_datetime)
+        self.single_decode = single_decode
+        self.pose_layout_version = pose_layout_version
+        self.mask_format = mask_format
+        self.bgnd_kwds = {"bgnd_algorithm": bgnd_algorithm, "bgnd_scale": bgnd_scale}
+        self.objdet_kwds = {"layout_version": objdet_layout_version, "scores_dtype": np.float16 if objdet_float16 else np.float32, "model": objdet_model, "max_batch_size": objdet_max_batch_size}
+        self.pose_model = pose_model
+        self.frame_selection = {"event_gating": gate_events, "motion_gating": gate_motion, "n_vision": gate_n_vision, "motion_thresh": gate_motion_thresh, "algorithm": bgnd_algorithm} if gate_events or gate_motion else None
+        self.weight_chunk_duration = weight_chunk_duration
+        self.weight_resample_mode = weight_resample_mode
+        self.weight_incremental = weight_incremental
+        self.weight_layout_version = weight_layout_version
         self.do_weight = do_weight
         self.do_objdet = do_objdet
         self.do_pose = do_pose
         self.pose_model_folder = pose_model_folder
 
-        self.pool_weight = Pool(processes=num_processes_weight) if do_weight else None
-        self.pool_vision = Pool(processes=num_processes_vision) if do_pose else None
-        self.pool_objdet = [Pool(processes=num_processes_objdet) if do_objdet else None for i in range(num_gpus)]
-        self.weight_tasks_state = []
-        self.vision_tasks_state = []
-        self.num_weight_tasks_done = 0
-        self.num_vision_tasks_done = 0
-        self.next_gpu = 0
-        self.num_gpus = num_gpus
-
-    def _task_done_cb(self, is_weight):
-        if is_weight:
-            self.num_weight_tasks_done += 1
-            n = self.num_weight_tasks_done
-            total = len(self.weight_tasks_state)
-            str_type = "Weight"
-        else:
-            self.num_vision_tasks_done += 1
-            n = self.num_vision_tasks_done
-            total = len(self.vision_tasks_state)
-            str_type = "Vision"
-
-        print("{} tasks done: {}/{} ({:5.2f}%)".format(str_type, n, total, 100*n/total))
+        # Vision workers live for the whole run and keep their models loaded (see vision_models.get_resident_model) -> Load them once, as each worker starts
+        pose_model_spec = lambda gpu_id: ("pose", pose_model, {"model_folder": pose_model_folder, "gpu_id": gpu_id})
+        vision_models = [pose_model_spec(0 if single_decode else None)] if do_pose and preload_models else []
+        objdet_models = lambda gpu_id: [("detector", objdet_model, {"gpu_id": gpu_id})] + ([pose_model_spec(gpu_id)] if single_decode and do_pose else []) if preload_models else []
+        executors = {}
+        if do_weight:
+            executors["weight"] = (Pool(processes=num_processes_weight), num_processes_weight)
+        if do_pose and not (single_decode and do_objdet):
+            executors["vision"] = (Pool(processes=num_processes_vision, initializer=init_model_worker, initargs=(vision_models,)), num_processes_vision)
+        if do_objdet:  # One pool per GPU (objdet0, objdet1...). When single_decode, every video task (pose+objdet) runs here
+            executors.update({"objdet{}".format(i): (Pool(processes=num_processes_objdet, initializer=init_model_worker, initargs=(objdet_models(i),)), num_processes_objdet) for i in range(num_gpus)})
+        resources = {"cpu": num_cpus, "memory": max_memory or get_total_memory()}
+        resources.update({"gpu{}".format(i): num_processes_objdet for i in range(num_gpus)})
+        self.pools = [pool for pool, _ in executors.values()]
+        self.cache_max_size = cache_max_size
+        self.experiment_folders = []
+        self.scheduler = TaskScheduler(resources, executors, max_retries, summary_interval)
 
     def process_subfolder(self, f):
+        from task_scheduler import Task
         parent_folder = os.path.join(self.main_folder, f)
+        self.experiment_folders.append(parent_folder)
+        weights_h5 = os.path.join(parent_folder, "weights_{}.h5".format(f))
 
-        # Tell the weight preprocessor to merge all weight sensors into a single h5 file
+        # Merge all weight sensors into a single h5 file
         if self.do_weight:
-            task_state = self.pool_weight.apply_async(preprocess_weight, (parent_folder,), callback=lambda _: self._task_done_cb(is_weight=True))
-            self.weight_tasks_state.append(task_state)
+            self.scheduler.add(Task("weight {}".format(f), preprocess_weight, (parent_folder,), {"chunk_duration": self.weight_chunk_duration, "resample_mode": self.weight_resample_mode, "incremental": self.weight_incremental, "layout_version": self.weight_layout_version},
+                                    executor="weight", outputs=[weights_h5], resources=PREPROCESS_TASK_RESOURCES["weight" if self.weight_chunk_duration is None else "weight_chunked"]))
+
+        # Run pose estimation and object detection on every camera video
+        gated_on = [weights_h5] if self.frame_selection is not None and self.frame_selection["event_gating"] else []  # (Frame selection can do without them if weights fail)
+        for video in sorted(glob.glob(os.path.join(parent_folder, "cam*_{}.mp4".format(f)))):
+            video_prefix = os.path.splitext(video)[0]
+            mask_outputs = [video_prefix + "_mask.h5"] if self.do_pose and self.mask_format == "h5" else []
+            objdet_outputs = [video_prefix + "_objdet.h5"] if self.do_objdet else []
+            if self.single_decode and (self.do_pose or self.do_objdet):  # One task per video: decode it once for all vision stages
+                kwds = {"do_pose": self.do_pose, "do_objdet": self.do_objdet, "pose_model_folder": self.pose_model_folder, "pose_layout_version": self.pose_layout_version, "objdet_layout_version": self.objdet_kwds["layout_version"], "objdet_scores_dtype": self.objdet_kwds["scores_dtype"], "mask_format": self.mask_format, "pose_model": self.pose_model, "objdet_model": self.objdet_kwds["model"], "objdet_max_batch_size": self.objdet_kwds["max_batch_size"], "frame_selection": self.frame_selection, **self.bgnd_kwds}
+                if not self.do_objdet: kwds["gpu_id"] = 0  # (Otherwise the scheduler picks the GPU)
+                self.scheduler.add(Task("video {}".format(os.path.basename(video)), preprocess_video, (video,), kwds, executor="objdet" if self.do_objdet else "vision", device="gpu" if self.do_objdet else None,
+                                        optional_inputs=gated_on, outputs=mask_outputs + objdet_outputs, resources=PREPROCESS_TASK_RESOURCES["video"]))
+                continue
 
-        # Tell the pose preprocessor to run pose estimation on every camera video
-        for video in glob.glob(os.path.join(parent_folder, "cam*_{}.mp4".format(f))):
             if self.do_pose:
                 kwds = {"crop_half_w": 200, "crop_half_h": 200} if os.path.basename(video).startswith("cam4") else {}  # Top-down camera is closer -> Crop bigger window
-                task_state = self.pool_vision.apply_async(preprocess_vision, (video, self.pose_model_folder), kwds, callback=lambda _: self._task_done_cb(is_weight=False))
-                self.vision_tasks_state.append(task_state)
+                kwds.update({"pose_layout_version": self.pose_layout_version, "mask_format": self.mask_format, "pose_model": self.pose_model, "frame_selection": self.frame_selection, **self.bgnd_kwds})
+                self.scheduler.add(Task("vision {}".format(os.path.basename(video)), preprocess_vision, (video, self.pose_model_folder), kwds, executor="vision",
+                                        optional_inputs=gated_on, outputs=mask_outputs, resources=PREPROCESS_TASK_RESOURCES["vision"]))
 
             if self.do_objdet:
-                task_state = self.pool_objdet[self.next_gpu].apply_async(preprocess_vision_object_detection, (video, self.next_gpu), callback=lambda _: self._task_done_cb(is_weight=False))
-                self.next_gpu = (self.next_gpu+1) % self.num_gpus
-                self.vision_tasks_state.append(task_state)
-
+                motion_from = mask_outputs if self.frame_selection is not None and self.frame_selection["motion_gating"] else []  # Reuse the masks' foreground fractions (instead of recomputing them)
+                self.scheduler.add(Task("objdet {}".format(os.path.basename(video)), preprocess_vision_object_detection, (video,), dict(self.objdet_kwds, frame_selection=self.frame_selection), executor="objdet", device="gpu",
+                                        optional_inputs=gated_on + motion_from, outputs=objdet_outputs, resources=PREPROCESS_TASK_RESOURCES["objdet"]))
 
     def on_done(self):
-        print("Preprocessing tasks enqueued, waiting for them to complete!")
-        for tasks_state in (self.weight_tasks_state, self.vision_tasks_state):
-            for i,task_state in enumerate(tasks_state):
-                try:
-                    task_state.get()
-                except Exception as e:
-                    traceback.print_exc()
-                # task_state.wait()
-                # if not task_state.successful():
-                #     print("Uh oh... {} task {}: {}".format("Weight" if tasks_state==self.weight_tasks_state else "Vision", i+1, task_state._value))
-
-        print("All done!")
+        print("Preprocessing tasks created, running them!")
+        try:
+            failed = self.scheduler.run()
+        finally:
+            for pool in self.pools:
+                pool.close()
+                pool.join()
+        if self.cache_max_size is not None:  # Keep regenerable outputs (overlay videos, masks...) under budget
+            from artifact_cache import ArtifactCache, evict_lru
+            evict_lru([ArtifactCache(folder) for folder in self.experiment_folders], self.cache_max_size)
+        print("All done!" if len(failed) == 0 else "All done, but {} tasks failed: {}".format(len(failed), ", ".join(task.name for task in failed)))
 
 
 if __name__ == "__main__":
+    from read_dataset import RESAMPLE_MODES
+
     parser = argparse.ArgumentParser()
     parser.add_argument("folder", default="Dataset/Evaluation", help="Folder containing the experiment(s) to preprocess")
     parser.add_argument("-s", "--start-datetime", default="", help="Only preprocess experiments collected later than this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
@@ -303,10 +862,34 @@ if __name__ == "__main__":
     parser.add_argument('-nv', "--num-processes-vision", default=3, type=int, help="Number of processes to spawn for vision preprocessing")
     parser.add_argument('-no', "--num-processes-objdet", default=4, type=int, help="Number of processes to spawn for object detection preprocessing (will be multiplied by the number of GPUs)")
     parser.add_argument('-ng', "--num-gpus", default=1, type=int, help="Number of GPUs available")
+    parser.add_argument('-wc', "--weight-chunk-duration", default=None, type=float, help="If set, resample weights in windows of this many seconds (bounded memory, independent of the experiment length)")
+    parser.add_argument('-wr', "--weight-resample-mode", default="cubic", choices=RESAMPLE_MODES, help="Kernel used to resample the weights at a fixed rate (linear is much faster than cubic)")
+    parser.add_argument('-wi', "--weight-incremental", default=False, type=str2bool, help="Whether or not to only ingest weight segments that weren't in weights_<t>.h5 yet (instead of skipping experiments that already have one)")
+    parser.add_argument('-wl', "--weight-layout-version", default=1, type=int, choices=(1, 2), help="Layout of weights_<t>.h5 (2: chunked, compressed, numeric time axis; see weights_h5.py)")
+    parser.add_argument('-sd', "--single-decode", default=False, type=str2bool, help="Whether or not to decode each video once for all vision stages (one task per video, run in the object detection pools if --do-objdet)")
+    parser.add_argument('-pl', "--pose-layout-version", default=1, type=int, choices=(1, 2), help="Layout of the pose and hands groups in camN_<t>.h5 (2: columnar, chunked, compressed; see pose_h5.py)")
+    parser.add_argument('-mf', "--mask-format", default="png", choices=("png", "h5"), help="How to store the background subtraction masks (png: one file per frame in {}/; h5: bit-packed into <video>_mask.h5, see mask_h5.py)".format(BACKGROUND_MASKS_FOLDER_NAME))
+    parser.add_argument('-ba', "--bgnd-algorithm", default="GSOC", choices=sorted(BACKGROUND_SUBTRACTION_ALGORITHMS.keys()), help="Background subtraction algorithm (GSOC, MOG and GMG need opencv-contrib)")
+    parser.add_argument('-bs', "--bgnd-scale", default=1.0, type=float, help="Scale at which to run background subtraction (e.g. 0.5: on 640x360 frames, masks are upscaled back to 1280x720)")
+    parser.add_argument('-pe', "--pose-model", default="openpose", choices=("openpose", "stub"), help="Pose estimation model (stub: lightweight CPU stand-in, for testing)")
+    parser.add_argument('-od', "--objdet-model", default="maskrcnn", choices=("maskrcnn", "stub"), help="Object detection model (stub: lightweight CPU stand-in, for testing)")
+    parser.add_argument('-mb', "--objdet-max-batch-size", default=OBJDET_MAX_BATCH_SIZE, type=int, help="Object detection batches start at {} frames and grow up to this many frames while that speeds inference up (set it to {} to keep them fixed)".format(OBJDET_BATCH_SIZE, OBJDET_BATCH_SIZE))
+    parser.add_argument('-lm', "--preload-models", default=True, type=str2bool, help="Whether or not every vision worker should load its models as soon as it starts (they're kept loaded for every video it processes either way)")
+    parser.add_argument('-ge', "--gate-events", default=False, type=str2bool, help="Whether or not to only run pose and object detection on frames around weight events (within --gate-n-vision seconds, same windows as processExperiment.m)")
+    parser.add_argument('-gm', "--gate-motion", default=False, type=str2bool, help="Whether or not to only run pose and object detection on frames where something is moving (foreground fraction above --gate-motion-thresh)")
+    parser.add_argument('-gn', "--gate-n-vision", default=3.0, type=float, help="Seconds of video around each weight event to run pose and object detection on (systemParams.Nvision)")
+    parser.add_argument('-gt', "--gate-motion-thresh", default=0.005, type=float, help="Min fraction of foreground pixels for a frame to count as moving")
+    parser.add_argument('-nc', "--num-cpus", default=cpu_count(), type=int, help="Number of CPUs all tasks share (e.g. weight tasks take 1, video tasks 2; see PREPROCESS_TASK_RESOURCES)")
+    parser.add_argument('-mm', "--max-memory", default=None, type=float, help="GB of memory all tasks share (default: all of it)")
+    parser.add_argument('-rt', "--max-retries", default=1, type=int, help="How many times to retry a task that failed")
+    parser.add_argument('-si', "--summary-interval", default=30, type=float, help="Seconds between summaries of the tasks' progress and resource utilization")
+    parser.add_argument('-cg', "--cache-max-gb", default=None, type=float, help="If set, evict regenerable outputs (overlay videos, mask h5s...) of the experiments processed, least recently used first, until they take up at most this many GB (see artifact_cache.py)")
+    parser.add_argument('-ol', "--objdet-layout-version", default=1, type=int, choices=(1, 2), help="Layout of <video>_objdet.h5 (2: ragged, all frames' detections in chunked, compressed datasets; see objdet_h5.py)")
+    parser.add_argument('-of', "--objdet-float16", default=False, type=str2bool, help="Whether or not to store the object detection class scores as float16 (only with --objdet-layout-version 2; NOTE: MATLAB can't read float16)")
     args = parser.parse_args()
 
     t_start = datetime.strptime(args.start_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.start_datetime) > 0 else datetime.min
     t_end = datetime.strptime(args.end_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.end_datetime) > 0 else datetime.max
 
-    ExperimentPreProcessor(args.folder, t_start, t_end, args.do_weight, args.do_pose, args.do_objdet, args.pose_model_folder, args.num_processes_weight, args.num_processes_vision, args.num_processes_objdet, args.num_gpus).run()
+    ExperimentPreProcessor(args.folder, t_start, t_end, args.do_weight, args.do_pose, args.do_objdet, args.pose_model_folder, args.num_processes_weight, args.num_processes_vision, args.num_processes_objdet, args.num_gpus, args.weight_chunk_duration, args.weight_resample_mode, args.weight_incremental, args.weight_layout_version, args.single_decode, args.pose_layout_version, args.objdet_layout_version, args.objdet_float16, args.mask_format, args.bgnd_algorithm, args.bgnd_scale, args.pose_model, args.objdet_model, args.preload_models, args.objdet_max_batch_size, args.gate_events, args.gate_motion, args.gate_n_vision, args.gate_motion_thresh, args.num_cpus, args.max_memory*1e9 if args.max_memory is not None else None, args.max_retries, args.summary_interval, args.cache_max_gb*1e9 if args.cache_max_gb is not None else None).run()
 
@@ -4,8 +4,7 @@ import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
-from datetime import datetime, timedelta
-from aux_tools import _min, _max, DEFAULT_TIMEZONE, date_range, time_to_float
+from aux_tools import _min, _max, date_range, create_pool
 
 # NOTE: Dependencies for the protos: pip install --upgrade protobuf grpcio googleapis-common-protos
 
@@ -55,11 +54,20 @@ def parse_product_info(product_info_file=""):
     return product_info['products']
 
 
+def get_weight_calibration_filename(calib_file=""):
+    """Absolute path of the calibration json parse_weight_calibration reads: calib_file, or by default Dataset/weight_calibration.json (from the current
+    directory if it has one, otherwise this repo's)"""
+    if calib_file == "":
+        calib_file = "Dataset/weight_calibration.json"
+        if not os.path.exists(calib_file):
+            calib_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), calib_file)
+    return os.path.abspath(calib_file)
+
+
 def parse_weight_calibration(calib_file=""):
     import json
 
-    if calib_file == "":
-        calib_file = "Dataset/weight_calibration.json"
+    calib_file = get_weight_calibration_filename(calib_file)
 
     # Parse the calibration json
     with open(calib_file) as f:
@@ -74,32 +82,30 @@ def parse_weight_calibration(calib_file=""):
     return weight_params
 
 
-def read_weight_data(sensor_folder, weight_calib=None, do_tare=False, is_phidget=False):
+def read_weight_segment(segment_filename):
+    """Decodes a single protobuf segment file into its timestamps and (uncalibrated) values"""
     from sensing_proto.sensors_pb2 import SensorData
-    if isinstance(weight_calib, str):
-        weight_calib = parse_weight_calibration(weight_calib)
 
-    sensor_t = []
-    sensor_data = []
-    sensor_id = int(sensor_folder.rsplit('_', 1)[1])  # Plate ID is the numbers that come after the '_' on the folder name
+    with open(segment_filename, 'rb') as f:
+        return unpack(SensorData.FromString(f.read()))
 
-    # Parse every file in the folder (order doesn't matter, will sort by timestamp later)
-    for filename in os.listdir(sensor_folder):
-        with open(os.path.join(sensor_folder, filename), 'rb') as f:
-            data = SensorData.FromString(f.read())
-            t, weights = unpack(data)
-            if weight_calib is not None:
-                weights = (weights-weight_calib[sensor_id]['offset'])*weight_calib[sensor_id]['slope']
-            sensor_t.append(t)
-            sensor_data.append(weights)
 
-    # Stack all the segments together (convert to np.array)
-    sensor_t = np.hstack(sensor_t)
-    sensor_data = np.vstack(sensor_data) if is_phidget else np.hstack(sensor_data)
+def list_weight_segments(sensor_folder):
+    return [os.path.join(sensor_folder, filename) for filename in sorted(os.listdir(sensor_folder))]  # Sorted so merging is deterministic
+
 
-    # Segments usually aren't read in (time-series) order -> Sort by timestamp
-    t_inds = sensor_t.argsort()
-    sensor_t = np.array([datetime.fromtimestamp(t, tz=DEFAULT_TIMEZONE) for t in sensor_t[t_inds]])
+def merge_weight_segments(segments, sensor_id, weight_calib=None, do_tare=False, is_phidget=False):
+    """Stacks a list of decoded (t, values) segments of one plate, calibrates them and sorts them by timestamp"""
+    # Stack all the segments together (convert to np.array)
+    sensor_t = np.hstack([t for t, _ in segments])
+    sensor_data = np.vstack([w for _, w in segments]) if is_phidget else np.hstack([w for _, w in segments])
+    if weight_calib is not None:
+        sensor_data = (sensor_data-weight_calib[sensor_id]['offset'])*weight_calib[sensor_id]['slope']
+
+    # Segments usually aren't read in (time-series) order -> Sort by timestamp (stable, so duplicate timestamps keep file order)
+    # NOTE: timestamps are kept as float epoch seconds (use aux_tools.epoch_to_datetime if a datetime is really needed)
+    t_inds = sensor_t.argsort(kind='stable')
+    sensor_t = sensor_t[t_inds]
     sensor_data = np.array(sensor_data[t_inds, :] if is_phidget else sensor_data[t_inds])
     if do_tare:
         sensor_data -= sensor_data[0:60].mean().astype(sensor_data.dtype)  # Tare it
@@ -107,18 +113,212 @@ def read_weight_data(sensor_folder, weight_calib=None, do_tare=False, is_phidget
     return sensor_t, sensor_data, sensor_id
 
 
-def read_weights_data(experiment_folder, calib_file="", F_samp=60, *args, **kwargs):
+def read_weight_data(sensor_folder, weight_calib=None, do_tare=False, is_phidget=False):
+    if isinstance(weight_calib, str):
+        weight_calib = parse_weight_calibration(weight_calib)
+    sensor_id = int(sensor_folder.rsplit('_', 1)[1])  # Plate ID is the numbers that come after the '_' on the folder name
+
+    # Parse every file in the folder (order doesn't matter, will sort by timestamp later)
+    return merge_weight_segments(decode_sensor_folder(sensor_folder), sensor_id, weight_calib, do_tare, is_phidget)
+
+
+SEGMENTS_MANIFEST_DTYPE = np.dtype([('plate_id', '<i8'), ('filename', 'S128'), ('size', '<i8'), ('mtime', '<f8'), ('t_first', '<f8'), ('t_last', '<f8')])
+
+
+def scan_weight_segments(experiment_folder):
+    """Lists every segment of every sensors_<id> folder as a SEGMENTS_MANIFEST_DTYPE array (t_first and t_last are NaN until decoded)"""
+    manifest = []
+    for sensor_folder in sorted(glob.glob(os.path.join(experiment_folder, "sensors_*"))):
+        plate_id = int(sensor_folder.rsplit('_', 1)[1])  # Plate ID is the numbers that come after the '_' on the folder name
+        for filename in list_weight_segments(sensor_folder):
+            stat = os.stat(filename)
+            manifest.append((plate_id, os.path.basename(filename).encode('utf8'), stat.st_size, stat.st_mtime, np.nan, np.nan))
+    return np.array(manifest, dtype=SEGMENTS_MANIFEST_DTYPE)
+
+
+def decode_sensor_folder(sensor_folder):
+    return [read_weight_segment(filename) for filename in list_weight_segments(sensor_folder)]
+
+
+def decode_sensor_folders(sensor_folders, num_workers=1, use_threads=False):
+    """Decodes every segment of every sensor folder. Returns a list (same order as sensor_folders) of lists of (t, values) segments"""
+    if num_workers <= 1:
+        return [decode_sensor_folder(sensor_folder) for sensor_folder in sensor_folders]
+
+    # Decode all plates concurrently (pool.map keeps the order of sensor_folders, so merging is deterministic)
+    pool = create_pool(num_workers, use_threads)
+    try:
+        return pool.map(decode_sensor_folder, sensor_folders, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+WEIGHT_PACK_FILENAME = "segments_{}.pack"
+WEIGHT_PACK_MAGIC = b"AIM3SPK1"
+WEIGHT_PACK_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('index_offset', '<u8'), ('num_segments', '<u8')])
+WEIGHT_PACK_INDEX_DTYPE = np.dtype([('plate_id', '<i8'), ('t_latest', '<f8'), ('F_samp', '<f8'), ('num_samples', '<i8'), ('offset', '<u8'), ('length', '<u8')])
+
+
+def get_weight_pack_filename(experiment_folder):
+    return os.path.join(experiment_folder, WEIGHT_PACK_FILENAME.format(os.path.basename(os.path.normpath(experiment_folder))))
+
+
+def pack_weight_segments(experiment_folder, pack_filename=None):
+    """Consolidates every protobuf segment of every sensors_<id> folder of an experiment into a single indexed file"""
+    # Layout: [header][segment bytes, grouped by plate, in list_weight_segments order][index (one WEIGHT_PACK_INDEX_DTYPE row per segment)]
+    from sensing_proto.sensors_pb2 import SensorData
+
+    if pack_filename is None:
+        pack_filename = get_weight_pack_filename(experiment_folder)
+    sensor_folders = sorted(glob.glob(os.path.join(experiment_folder, "sensors_*")))
+    index = []
+    with open(pack_filename + ".tmp", 'wb') as f_pack:
+        f_pack.write(np.zeros(1, dtype=WEIGHT_PACK_HEADER_DTYPE).tobytes())  # Placeholder, will fill in once we know where the index is
+        for sensor_folder in sensor_folders:
+            plate_id = int(sensor_folder.rsplit('_', 1)[1])  # Plate ID is the numbers that come after the '_' on the folder name
+            for filename in list_weight_segments(sensor_folder):
+                with open(filename, 'rb') as f:
+                    raw = f.read()
+                data = SensorData.FromString(raw)
+                index.append((plate_id, data.t_latest.ToMilliseconds()/1000.0, data.F_samp, data.values.shape[-1], f_pack.tell(), len(raw)))
+                f_pack.write(raw)
+
+        # Write the index at the end and fill in the header
+        index_offset = f_pack.tell()
+        f_pack.write(np.array(index, dtype=WEIGHT_PACK_INDEX_DTYPE).tobytes())
+        f_pack.seek(0)
+        f_pack.write(np.array([(WEIGHT_PACK_MAGIC, index_offset, len(index))], dtype=WEIGHT_PACK_HEADER_DTYPE).tobytes())
+    os.rename(pack_filename + ".tmp", pack_filename)  # Only expose the pack once it's complete
+
+    print("Packed {} segments from {} sensors into '{}'".format(len(index), len(sensor_folders), pack_filename))
+    return pack_filename
+
+
+def read_weight_pack_index(pack_filename):
+    with open(pack_filename, 'rb') as f:
+        header = np.frombuffer(f.read(WEIGHT_PACK_HEADER_DTYPE.itemsize), dtype=WEIGHT_PACK_HEADER_DTYPE)[0]
+        if header['magic'] != WEIGHT_PACK_MAGIC:
+            raise IOError("'{}' is not a weight segments pack file!".format(pack_filename))
+        f.seek(int(header['index_offset']))
+        return np.frombuffer(f.read(int(header['num_segments'])*WEIGHT_PACK_INDEX_DTYPE.itemsize), dtype=WEIGHT_PACK_INDEX_DTYPE)
+
+
+def is_weight_pack_stale(experiment_folder, pack_filename=None, index=None, thorough=False):
+    """Whether the sensors_<id> folders changed since pack_filename was written (segments added or removed), i.e. the pack is missing data.
+    Only stats the folders themselves (adding or removing a file updates its folder's mtime), so it's cheap enough to check on every read. thorough also
+    compares every segment's size and mtime, to catch segments rewritten in place (pack_weights.py does that).
+    A pack whose sensor folders are gone (e.g. deleted to save space) is all there is -> Never stale"""
+    if pack_filename is None:
+        pack_filename = get_weight_pack_filename(experiment_folder)
+    sensor_folders = glob.glob(os.path.join(experiment_folder, "sensors_*"))
+    if len(sensor_folders) == 0:
+        return False
+    if index is None:
+        index = read_weight_pack_index(pack_filename)
+    if not thorough:
+        plate_ids = set(int(sensor_folder.rsplit('_', 1)[1]) for sensor_folder in sensor_folders)  # Plate ID is the numbers that come after the '_' on the folder name
+        return plate_ids != set(np.unique(index['plate_id']).tolist()) or max(os.path.getmtime(f) for f in sensor_folders) > os.path.getmtime(pack_filename)
+
+    segments = scan_weight_segments(experiment_folder)
+    if len(index) != len(segments) or np.any(index['plate_id'] != segments['plate_id']) or np.any(index['length'] != segments['size']):  # (Same order: pack_weight_segments also goes through list_weight_segments)
+        return True
+    return len(segments) > 0 and segments['mtime'].max() > os.path.getmtime(pack_filename)
+
+
+def read_weight_pack(pack_filename, t_lims=None, index=None):
+    """Reads a pack file generated by pack_weight_segments. Returns a list of (plate_id, [(t, values) segments]), sorted by plate_id"""
+    from sensing_proto.sensors_pb2 import SensorData
+    import mmap
+
+    if index is None:
+        index = read_weight_pack_index(pack_filename)
+    if t_lims is not None:  # t_lims=(t_a, t_b) in float epochs -> Use the index to skip straight to the segments overlapping [t_a, t_b)
+        t_first = index['t_latest'] - index['num_samples']/index['F_samp']
+        index = index[(index['t_latest'] >= t_lims[0]) & (t_first < t_lims[1])]
+
+    # Single sequential pass over the memory-mapped file
+    plates = {}
+    with open(pack_filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for plate_id, offset, length in zip(index['plate_id'], index['offset'], index['length']):
+            plates.setdefault(int(plate_id), []).append(unpack(SensorData.FromString(mm[offset:offset+length])))
+    return sorted(plates.items())
+
+
+def load_weight_segments(experiment_folder, num_workers=1, use_threads=False, t_lims=None):
+    """Returns a list of (plate_id, [(t, values) segments]), read from the experiment's pack file if it's up to date or from its sensors_<id> folders otherwise"""
+    pack_filename = get_weight_pack_filename(experiment_folder)
+    if os.path.exists(pack_filename):
+        if not is_weight_pack_stale(experiment_folder, pack_filename):
+            return read_weight_pack(pack_filename, t_lims)
+        print("Pack file '{}' is out of date (sensor segments changed since it was written), reading the sensor folders instead".format(pack_filename))
+
+    sensor_folders = sorted(glob.glob(os.path.join(experiment_folder, "sensors_*")))
+    plate_ids = [int(sensor_folder.rsplit('_', 1)[1]) for sensor_folder in sensor_folders]  # Plate ID is the numbers that come after the '_' on the folder name
+    plates = zip(plate_ids, decode_sensor_folders(sensor_folders, num_workers, use_threads))
+    if t_lims is not None:
+        plates = [(plate_id, [(t, w) for t, w in segments if t[-1] >= t_lims[0] and t[0] < t_lims[1]]) for plate_id, segments in plates]
+    return sorted(plates, key=lambda plate: plate[0])
+
+
+RESAMPLE_MODES = ("linear", "nearest", "cubic", "polyphase")
+
+
+def resample_weight(t_src, w_src, t_dst, mode="cubic"):
+    """Resamples a (sorted) weight time-series at times t_dst. t_dst must be evenly spaced for mode='polyphase'"""
+    valid_inds = np.hstack((True, np.logical_not(np.equal(t_src[1:], t_src[:-1]))))  # Remove duplicate timestamps
+    t_src = t_src[valid_inds]
+    w_src = w_src[valid_inds]
+
+    if mode == "linear":
+        return np.interp(t_dst, t_src, w_src)
+    elif mode == "nearest":
+        i = np.clip(np.searchsorted(t_src, t_dst), 1, len(t_src)-1)
+        i -= (t_dst-t_src[i-1]) <= (t_src[i]-t_dst)  # Round to whichever neighbor is closest
+        return w_src[i]
+    elif mode == "cubic":
+        return interp1d(t_src, w_src, kind='cubic', copy=False, assume_sorted=True)(t_dst)
+    elif mode == "polyphase":
+        return _resample_weight_polyphase(t_src, w_src, t_dst)
+    else:
+        raise ValueError("Unknown resampling mode '{}' (valid options: {})".format(mode, ', '.join(RESAMPLE_MODES)))
+
+
+def _resample_weight_polyphase(t_src, w_src, t_dst, max_denominator=100, pad_duration=2.0):
+    from scipy.signal import resample_poly
+    from fractions import Fraction
+
+    if len(t_dst) < 2:
+        return np.interp(t_dst, t_src, w_src)
+
+    # Find the closest rational up/down ratio between the output rate and the (median) input rate
+    F_dst = 1.0/(t_dst[1]-t_dst[0])
+    F_src = 1.0/np.median(np.diff(t_src))
+    ratio = Fraction(F_dst/F_src).limit_denominator(max_denominator)
+    up, down = ratio.numerator, ratio.denominator
+
+    # Linearly map the raw samples onto a uniform grid at exactly F_dst*down/up that lines up with t_dst (padded with
+    # extra input on either side to avoid filter edge effects), then let resample_poly apply the anti-aliasing filter
+    n_pad = int(_max(_min(np.floor((t_dst[0]-t_src[0])*F_dst), pad_duration*F_dst), 0))
+    n_out = len(t_dst) + n_pad + int(_max(_min(np.floor((t_src[-1]-t_dst[-1])*F_dst), pad_duration*F_dst), 0))
+    t_uniform = (t_dst[0] - n_pad/F_dst) + np.arange(int(np.ceil(n_out*down/float(up))))*(up/(F_dst*down))
+    w_out = resample_poly(np.interp(t_uniform, t_src, w_src), up, down)
+    return w_out[n_pad:n_pad+len(t_dst)]
+
+
+def read_weights_data(experiment_folder, calib_file="", F_samp=60, *args, num_workers=1, use_threads=False, t_lims=None, resample_mode="cubic", **kwargs):
     weight_calib = parse_weight_calibration(calib_file)  # Load calibration file to figure out the plate and shelf arrangement
     shelves = {}  # Keeps track of what shelves have at least 1 plate. Keys are shelf_id's, values are largest plate_id (number of plates in that shelf)
     weights = {}  # We first load all weights and track them by plate_id. Then, we arrange each shelf in a multidimensional numpy array
 
     # Load all weights
-    t_latest_start = datetime.min.replace(tzinfo=DEFAULT_TIMEZONE)
-    t_earliest_end = datetime.max.replace(tzinfo=DEFAULT_TIMEZONE)
+    t_latest_start = -np.inf
+    t_earliest_end = np.inf
     print("Loading weight data from '{}', this might take ~30s, please wait :)".format(experiment_folder))
-    for sensor_folder in glob.glob(os.path.join(experiment_folder, "sensors_*")):
+    for plate_id, segments in load_weight_segments(experiment_folder, num_workers, use_threads, t_lims):
+        if len(segments) == 0: continue  # No data within t_lims
         # Read weight
-        weight_t, weight_data, plate_id = read_weight_data(sensor_folder, weight_calib, *args, **kwargs)
+        weight_t, weight_data, _ = merge_weight_segments(segments, plate_id, weight_calib, *args, **kwargs)
         # Store results
         weights[plate_id] = {'t': weight_t, 'w': weight_data}
         t_latest_start = _max(weight_t[0], t_latest_start)
@@ -128,20 +328,113 @@ def read_weights_data(experiment_folder, calib_file="", F_samp=60, *args, **kwar
         shelves[shelf_id] = _max(weight_calib[plate_id]['plate_num'], shelves.get(shelf_id, 0))
     if len(shelves) == 0:
         raise IOError("No weight data found!")
+    if t_lims is not None:  # Segments might extend a bit past the requested time range
+        t_latest_start = _max(t_lims[0], t_latest_start)
+        t_earliest_end = _min(t_lims[1], t_earliest_end)
 
     # Resample the whole fixture as if it had been sampled at fixed F_samp
-    t = np.array(list(date_range(t_latest_start, t_earliest_end, timedelta(seconds=1.0/F_samp))))
+    t = date_range(t_latest_start, t_earliest_end, 1.0/F_samp)  # Float epoch timestamps
     w = np.zeros((max(shelves.keys()), max(shelves.values()), len(t)), dtype=np.float32)  # 1st dimension should be len(shelves) but then we'd need to know how to map each shelf index to each row of this matrix -> Fix later
-    to_float = lambda t_arr: np.array(time_to_float(t_arr, t_latest_start))
+    t_resampled = t - t_latest_start  # Interpolate relative to t_latest_start (better float precision than raw epochs)
     for plate_id, weight in weights.items():
         calib_info = weight_calib[plate_id]
-        weight_t = to_float(weight['t'])
-        valid_inds = np.hstack((True, np.logical_not(np.equal(weight_t[1:], weight_t[:-1]))))
-        w[calib_info['shelf_id']-1, calib_info['plate_num']-1, :] = interp1d(weight_t[valid_inds], weight['w'][valid_inds], kind='cubic', copy=False, assume_sorted=True)(to_float(t))
+        weight_t = weight['t'] - t_latest_start
+        w[calib_info['shelf_id']-1, calib_info['plate_num']-1, :] = resample_weight(weight_t, weight['w'], t_resampled, resample_mode)
 
     return t, w, weights
 
 
+def _select_window_segments(index, index_t_first, t_a, t_b):
+    """Index rows of the segments overlapping [t_a, t_b), plus each plate's closest segment on either side (so every plate has samples around the window,
+    even if it stopped sending data for a while)"""
+    selected = (index['t_latest'] >= t_a) & (index_t_first < t_b)
+    for plate_id in np.unique(index['plate_id']):
+        plate_inds = np.flatnonzero(index['plate_id'] == plate_id)
+        before = plate_inds[index['t_latest'][plate_inds] < t_a]
+        after = plate_inds[index_t_first[plate_inds] >= t_b]
+        if len(before) > 0: selected[before[np.argmax(index['t_latest'][before])]] = True
+        if len(after) > 0: selected[after[np.argmin(index_t_first[after])]] = True
+    return index[selected]
+
+
+def _read_weight_pack_parallel(pack_filename, index, pool=None, num_workers=1):
+    """Same as read_weight_pack(pack_filename, index=index), but splitting the segments among num_workers of pool"""
+    if pool is None or num_workers <= 1 or len(index) <= 1:
+        return read_weight_pack(pack_filename, index=index)
+    plates = {}
+    for chunk_plates in pool.starmap(read_weight_pack, [(pack_filename, None, chunk) for chunk in np.array_split(index, min(num_workers, len(index)))]):  # (Chunks in index order -> Same segment order as a serial read)
+        for plate_id, segments in chunk_plates:
+            plates.setdefault(plate_id, []).extend(segments)
+    return sorted(plates.items())
+
+
+def iter_resampled_weights(experiment_folder, calib_file="", F_samp=60, chunk_duration=60, overlap=2, do_tare=False, resample_mode="cubic", num_workers=1, use_threads=False):
+    """Streaming version of read_weights_data: yields (t, w, weights) for consecutive chunk_duration (in s) windows, so peak memory doesn't depend on the experiment length"""
+    # Each window also decodes overlap seconds on either side (and at least the closest segment of every plate on each side, in case there's a gap in its data)
+    # so the cubic spline is continuous across windows. weights only contains raw samples inside the window
+    weight_calib = parse_weight_calibration(calib_file)  # Load calibration file to figure out the plate and shelf arrangement
+    pack_filename = get_weight_pack_filename(experiment_folder)
+    if not os.path.exists(pack_filename) or is_weight_pack_stale(experiment_folder, pack_filename):  # Packing streams one segment at a time, and its index lets us seek straight to each window
+        pack_weight_segments(experiment_folder, pack_filename)
+    index = read_weight_pack_index(pack_filename)
+    if len(index) == 0:
+        raise IOError("No weight data found!")
+    index_t_first = index['t_latest'] - index['num_samples']/index['F_samp']  # Timestamp of the first sample in each segment
+
+    # Figure out the time span and shelf arrangement from the index alone (no need to decode anything)
+    plate_ids = np.unique(index['plate_id'])
+    shelves = {}  # Keys are shelf_id's, values are largest plate_id (number of plates in that shelf)
+    t_latest_start = -np.inf
+    t_earliest_end = np.inf
+    tare = {}
+    for plate_id in plate_ids:
+        plate_inds = np.flatnonzero(index['plate_id'] == plate_id)
+        t_latest_start = _max(index_t_first[plate_inds].min(), t_latest_start)
+        t_earliest_end = _min(index['t_latest'][plate_inds].max(), t_earliest_end)
+        shelf_id = weight_calib[plate_id]['shelf_id']
+        shelves[shelf_id] = _max(weight_calib[plate_id]['plate_num'], shelves.get(shelf_id, 0))
+        if do_tare:  # Tare using the first 60 samples of each plate (same as read_weight_data)
+            first_inds = plate_inds[np.argsort(index['t_latest'][plate_inds], kind='stable')]
+            first_inds = first_inds[:np.searchsorted(np.cumsum(index['num_samples'][first_inds]), 60)+1]
+            _, first_segments = read_weight_pack(pack_filename, index=index[np.sort(first_inds)])[0]
+            tare[plate_id] = merge_weight_segments(first_segments, int(plate_id), weight_calib, do_tare=False)[1][0:60].mean()
+
+    # Resampled timestamps are t_latest_start + n/F_samp (same as read_weights_data), split in windows of chunk_duration
+    N = len(date_range(t_latest_start, t_earliest_end, 1.0/F_samp))
+    t_raw_start = index_t_first.min()
+    t_raw_end = index['t_latest'].max()
+    num_chunks = int(np.floor((t_raw_end-t_raw_start)/chunk_duration)) + 1
+    pool = create_pool(num_workers, use_threads) if num_workers > 1 else None
+    try:  # (Decode each window's segments in parallel if num_workers > 1)
+        for k in range(num_chunks):
+            t_a = t_raw_start + k*chunk_duration if k > 0 else -np.inf  # First and last windows also contain any raw samples before/after the resampled range
+            t_b = t_raw_start + (k+1)*chunk_duration if k < num_chunks-1 else np.inf
+            n_a = int(np.clip(np.ceil((t_a-t_latest_start)*F_samp), 0, N))
+            n_b = int(np.clip(np.ceil((t_b-t_latest_start)*F_samp), 0, N))
+            t = t_latest_start + np.arange(n_a, n_b)/float(F_samp)
+            w = np.zeros((max(shelves.keys()), max(shelves.values()), len(t)), dtype=np.float32)
+            weights = {}
+
+            for plate_id, segments in _read_weight_pack_parallel(pack_filename, _select_window_segments(index, index_t_first, t_a-overlap, t_b+overlap), pool, num_workers):
+                weight_t, weight_data, _ = merge_weight_segments(segments, plate_id, weight_calib)
+                if do_tare:
+                    weight_data -= tare[plate_id].astype(weight_data.dtype)
+                in_window = (weight_t >= t_a) & (weight_t < t_b)
+                weights[plate_id] = {'t': weight_t[in_window], 'w': weight_data[in_window]}
+
+                if len(t) > 0:
+                    calib_info = weight_calib[plate_id]
+                    weight_t = weight_t - t_latest_start  # Interpolate relative to t_latest_start (better float precision than raw epochs)
+                    mode = resample_mode if resample_mode != "cubic" or len(np.unique(weight_t)) >= 4 else "linear"  # (Cubic splines need at least 4 samples)
+                    w[calib_info['shelf_id']-1, calib_info['plate_num']-1, :] = resample_weight(weight_t, weight_data, t - t_latest_start, mode)
+
+            yield t, w, weights
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
 def read_frame_data(frame_filename):
     from frames_proto.frames_pb2 import Frame
 
@@ -159,7 +452,7 @@ def read_frame_data(frame_filename):
 
 
 def visualize_weight(base_folder='2019-01-30_PoC/2019-01-30_02:07:40_AIM3S_PoC_rec1/sensors_1'):
-    sensor_t, sensor_data = read_weight_data(base_folder)
+    sensor_t, sensor_data, _ = read_weight_data(base_folder)
 
     # Visualize
     plt.plot(sensor_t, sensor_data)
@@ -0,0 +1,238 @@
+import cv2
+import numpy as np
+from aux_tools import JointEnum, datetime_to_epoch, epoch_to_str, save_datetime_to_h5, ensure_folder_exists, EXPERIMENT_DATETIME_STR_FORMAT
+from datetime import datetime
+import argparse
+import h5py
+import json
+import os
+
+
+SYNTHETIC_T_START = datetime(2019, 6, 24, 11, 29, 14)
+SYNTHETIC_PLATE_LOAD_RANGE = (200, 3000)  # (In g) Initial weight of the products on each plate
+SYNTHETIC_TOUCH_NOISE_STD = 300  # (In g) Noise on the plates while a customer is picking up/putting back items
+NUM_POSE_KEYPOINTS = len(JointEnum) - 1  # OpenPose's BODY_25 model (JointEnum also has BACKGND)
+
+# Stick-figure skeleton (pairs of JointEnum values) and neutral pose (in person-height units, wrt the neck) for the synthetic customer
+SYNTHETIC_SKELETON = [(0, 1), (1, 2), (2, 3), (3, 4), (1, 5), (5, 6), (6, 7), (1, 8), (8, 9), (9, 10), (10, 11), (8, 12), (12, 13), (13, 14)]
+SYNTHETIC_NEUTRAL_POSE = {0: (0, -0.12), 1: (0, 0), 2: (-0.1, 0), 3: (-0.12, 0.17), 4: (-0.12, 0.32), 5: (0.1, 0), 6: (0.12, 0.17), 7: (0.12, 0.32),
+                          8: (0, 0.35), 9: (-0.06, 0.35), 10: (-0.06, 0.6), 11: (-0.06, 0.85), 12: (0.06, 0.35), 13: (0.06, 0.6), 14: (0.06, 0.85)}
+
+
+def generate_synthetic_events(duration, t_start, events_per_minute=2.0, calib_file="", product_info_file="", min_event_duration=1.0, max_event_duration=5.0, seed=0):
+    """Random pickups/putbacks of the products in product_info_file. Returns (events, plate_loads): events sorted by time, plate_loads {(shelf_id, plate_num): initial weight in g}"""
+    from read_dataset import parse_weight_calibration, parse_product_info
+
+    rng = np.random.RandomState(seed)
+    plate_nums = set((calib_info['shelf_id'], calib_info['plate_num']) for calib_info in parse_weight_calibration(calib_file).values())
+    products = [p for p in parse_product_info(product_info_file) if all((a['shelf_id'], plate) in plate_nums for a in p['arrangement'] for plate in a['plate_ids'])]
+    plate_loads = dict((plate, rng.uniform(*SYNTHETIC_PLATE_LOAD_RANGE)) for plate in sorted(plate_nums))
+    stock = dict((p['id'], rng.randint(2, 10)) for p in products)
+
+    # Events can't overlap on the same shelf (the customer has to be done with one item before picking up the next one)
+    num_events = rng.poisson(events_per_minute*duration/60.0)
+    events = []
+    for t_event in np.sort(rng.uniform(2*max_event_duration, max(duration - 3*max_event_duration, 2*max_event_duration), num_events)):
+        product = products[rng.randint(len(products))]
+        arrangement = product['arrangement'][rng.randint(len(product['arrangement']))]
+        if any(e['shelf_id'] == arrangement['shelf_id'] and t_event < e['t_end'] - t_start + 2 for e in events): continue
+        is_pickup = (stock[product['id']] > 0) and (rng.uniform() < 0.6)
+        quantity = int(rng.randint(1, 3)) if is_pickup else int(rng.randint(1, 2))
+        quantity = min(quantity, stock[product['id']]) if is_pickup else quantity
+        stock[product['id']] += -quantity if is_pickup else quantity
+
+        # Split the weight change across the plates the product sits on
+        delta_w = (-1 if is_pickup else 1) * quantity * np.mean(product['weights'])
+        fractions = rng.dirichlet(np.ones(len(arrangement['plate_ids'])))
+        event_duration = rng.uniform(min_event_duration, max_event_duration)
+        events.append({
+            't_start': t_start + t_event,
+            't_end': t_start + t_event + event_duration,
+            't_step': t_start + t_event + rng.uniform(0.3, 0.7)*event_duration,  # When the item actually leaves/lands on the plates
+            'is_pickup': bool(is_pickup),
+            'item_id': product['id'],
+            'item_name': product['name'],
+            'quantity': quantity,
+            'shelf_id': arrangement['shelf_id'],
+            'delta_w': dict(((arrangement['shelf_id'], plate), delta_w*f) for plate, f in zip(arrangement['plate_ids'], fractions)),
+        })
+    return events, plate_loads
+
+
+def _synthetic_plate_weight(t, shelf_id, plate_num, events, plate_load):
+    """Ground truth weight (in g) of a plate at times t: initial load + steps at each event, plus noise while the shelf is being touched"""
+    w = np.full(len(t), plate_load, dtype=np.float64)
+    touch = np.zeros(len(t), dtype=bool)
+    for event in events:
+        if event['shelf_id'] != shelf_id: continue
+        w += event['delta_w'].get((shelf_id, plate_num), 0) * (t >= event['t_step'])
+        touch |= (t >= event['t_start']) & (t < event['t_end'])
+    return w, touch
+
+
+def write_synthetic_weight_segments(experiment_folder, calib_file="", duration=60, segment_duration=1.0, F_samp=60, noise_std=2.0, seed=0, t_start=None, events=(), plate_loads=None):
+    """Writes a sensors_<id> folder of SensorData protobuf segments for every plate in the calibration file"""
+    from sensing_proto.sensors_pb2 import SensorData, DataArray
+    from read_dataset import parse_weight_calibration
+
+    rng = np.random.RandomState(seed)
+    t_start = datetime_to_epoch(SYNTHETIC_T_START) if t_start is None else t_start
+    samples_per_segment = int(round(segment_duration*F_samp))
+    for plate_id, calib_info in parse_weight_calibration(calib_file).items():
+        sensor_folder = os.path.join(experiment_folder, "sensors_{}".format(plate_id))
+        os.makedirs(sensor_folder)
+        plate = (calib_info['shelf_id'], calib_info['plate_num'])
+        t_latest = t_start + rng.uniform(0, segment_duration)  # Plates don't start exactly at the same time
+        for i in range(int(np.ceil(duration/segment_duration))):
+            t = np.linspace(t_latest - samples_per_segment/float(F_samp), t_latest, samples_per_segment)  # Same timestamps read_dataset.unpack will assign
+            w, touch = _synthetic_plate_weight(t, plate[0], plate[1], events, (plate_loads or {}).get(plate, 0))
+            w += rng.normal(0, noise_std, samples_per_segment) + touch*rng.normal(0, SYNTHETIC_TOUCH_NOISE_STD, samples_per_segment)
+            raw = calib_info['offset'] + w/calib_info['slope']
+            data = SensorData()
+            data.values.type = DataArray.FLOAT32
+            data.values.data = raw.astype(np.float32).tobytes()
+            data.values.shape.extend([samples_per_segment])
+            data.t_latest.FromMilliseconds(int(1000*t_latest))
+            data.F_samp = F_samp
+            with open(os.path.join(sensor_folder, "{:.3f}".format(t_latest)), 'wb') as f:
+                f.write(data.SerializeToString())
+            t_latest += segment_duration
+
+
+def _synthetic_shelf_position(shelf_id, plate_num, cam_id, resolution, num_shelves=8, num_plates=12):
+    """(x, y) image coordinates of a plate as seen from camera cam_id (every camera sees the whole fixture, from a slightly different viewpoint)"""
+    w, h = resolution
+    x = (0.15 + 0.7*(plate_num-0.5)/num_plates + 0.03*(cam_id-2.5)) * w
+    y = (0.1 + 0.8*(shelf_id-0.5)/num_shelves) * h
+    return np.array([x, y])
+
+
+def _synthetic_pose(t, events, cam_id, resolution):
+    """OpenPose-style (NUM_POSE_KEYPOINTS, 3) keypoints of the customer in front of the shelf at time t (cam clock), or None if nobody's there"""
+    event = next((e for e in events if e['t_start']-1 <= t < e['t_end']+1), None)
+    if event is None:
+        return None
+
+    plate_num = int(np.mean([plate for _, plate in event['delta_w'].keys()]))
+    target = _synthetic_shelf_position(event['shelf_id'], plate_num, cam_id, resolution)
+    height = 0.8*resolution[1]
+    neck = np.array([target[0] + 0.15*height, 0.12*resolution[1]])
+    keypoints = np.zeros((NUM_POSE_KEYPOINTS, 3))
+    for joint, offset in SYNTHETIC_NEUTRAL_POSE.items():
+        keypoints[joint] = (neck[0] + offset[0]*height, neck[1] + offset[1]*height, 0.8)
+
+    # Reach for the shelf (right wrist goes from the hip to the plate and back during the event)
+    reach = np.clip(min(t - event['t_start'] + 1, event['t_end'] + 1 - t), 0, 1)
+    elbow, wrist = JointEnum.RELBOW.value, JointEnum.RWRIST.value
+    keypoints[wrist, 0:2] = (1-reach)*keypoints[wrist, 0:2] + reach*target
+    keypoints[elbow, 0:2] = (keypoints[JointEnum.RSHOULDER.value, 0:2] + keypoints[wrist, 0:2])/2
+    return keypoints
+
+
+def _synthetic_background(resolution, cam_id):
+    w, h = resolution
+    img = np.full((h, w, 3), 60 + 20*cam_id, dtype=np.uint8)
+    for shelf_id in range(1, 9):  # Draw the shelves and plates
+        for plate_num in range(1, 13):
+            x, y = _synthetic_shelf_position(shelf_id, plate_num, cam_id, resolution).astype(int)
+            cv2.rectangle(img, (x - w//40, y - h//40), (x + w//40, y + h//40), (40*(shelf_id % 4) + 60, 30*(plate_num % 6) + 60, 150), -1)
+    return img
+
+
+def write_synthetic_cameras(experiment_folder, t_start, duration, events, num_cams=4, fps=30, resolution=(640, 360), t_jitter=0.002, noise_std=3.0, seed=0):
+    """Writes camN_<t>.mp4 (+ .h5 with each frame's t/t_str, like record_cams.py) and camN_<t>_pose/ (one OpenPose json per frame) for every camera"""
+    rng = np.random.RandomState(seed)
+    t_experiment_start = os.path.basename(os.path.normpath(experiment_folder))
+    for cam_id in range(1, num_cams+1):
+        file_prefix = os.path.join(experiment_folder, "cam{}_{}".format(cam_id, t_experiment_start))
+        pose_folder = file_prefix + "_pose"
+        ensure_folder_exists(pose_folder)
+
+        # Cameras don't start at exactly the same time, and their frame rate isn't perfectly steady
+        num_frames = int(duration*fps)
+        t_frames = t_start + rng.uniform(0, 0.5) + np.arange(num_frames)/float(fps) + rng.normal(0, t_jitter, num_frames)
+        t_frames.sort()
+        with h5py.File(file_prefix + ".h5", 'w') as f_hdf5:
+            save_datetime_to_h5(t_frames, f_hdf5, "t")
+            config = f_hdf5.create_group("config")
+            config.attrs["cam_id"] = cam_id
+            config.attrs["out_filename"] = file_prefix + ".mp4"
+            config.attrs["synthetic"] = True
+
+        background = _synthetic_background(resolution, cam_id)
+        video_out = cv2.VideoWriter(file_prefix + ".mp4", cv2.VideoWriter_fourcc(*'mp4v'), fps, resolution)
+        for n, t in enumerate(t_frames):
+            img = background.copy()
+            keypoints = _synthetic_pose(t, events, cam_id, resolution)
+            people = []
+            if keypoints is not None:
+                for a, b in SYNTHETIC_SKELETON:
+                    cv2.line(img, tuple(keypoints[a, 0:2].astype(int)), tuple(keypoints[b, 0:2].astype(int)), (230, 200, 180), max(resolution[0]//100, 2))
+                keypoints[:, 0:2] += rng.normal(0, 1.5, (NUM_POSE_KEYPOINTS, 2))  # Keypoint detection noise
+                people.append({"person_id": [-1], "pose_keypoints_2d": keypoints.ravel().round(3).tolist(), "face_keypoints_2d": [], "hand_left_keypoints_2d": [], "hand_right_keypoints_2d": []})
+            if noise_std > 0:
+                img = np.clip(img + rng.normal(0, noise_std, img.shape), 0, 255).astype(np.uint8)
+            video_out.write(img)
+
+            with open(os.path.join(pose_folder, "{}_{:012d}_keypoints.json".format(os.path.basename(file_prefix), n)), 'w') as f_json:
+                json.dump({"version": 1.3, "people": people}, f_json)
+        video_out.release()
+        print("Wrote synthetic camera {} ({} frames) as '{}'".format(cam_id, num_frames, file_prefix + ".mp4"))
+
+
+def write_synthetic_ground_truth(experiment_folder, events, t_weight_start, t_end, cam_clock_offset=0):
+    """Writes ground_truth.json in the same format as ground_truth_labeler.py (times in the cameras' clock)"""
+    to_str = lambda t: epoch_to_str([t])[0].decode('utf8')
+    with open(os.path.join(experiment_folder, "ground_truth.json"), 'w') as f_gt:
+        json.dump({
+            'ground_truth': [{
+                "t_start": to_str(e['t_start'] + cam_clock_offset),
+                "t_end": to_str(e['t_end'] + cam_clock_offset),
+                "is_pickup": e['is_pickup'],
+                "item_id": e['item_id'],
+                "item_name": e['item_name'],
+                "quantity": e['quantity'],
+            } for e in events],
+            'weight_to_cam_t_offset': to_str(t_weight_start + cam_clock_offset),
+            'weight_to_cam_t_offset_float': -cam_clock_offset,
+            't_exit_store': to_str(t_end + cam_clock_offset),
+        }, f_gt, indent=2)
+
+
+def generate_synthetic_experiment(main_folder, t_start=SYNTHETIC_T_START, duration=60, num_cams=4, fps=30, resolution=(640, 360), F_samp=60, events_per_minute=2.0,
+                                  weight_noise_std=2.0, video_noise_std=3.0, cam_clock_offset=0, do_video=True, calib_file="", product_info_file="", seed=0):
+    """Writes a fake experiment (same layout as a real recording) in main_folder/<t_start>, so the whole pipeline can be run and load-tested offline. Returns its folder"""
+    experiment_folder = os.path.join(main_folder, t_start.strftime(EXPERIMENT_DATETIME_STR_FORMAT))
+    os.makedirs(experiment_folder)
+    t_start = datetime_to_epoch(t_start)
+
+    events, plate_loads = generate_synthetic_events(duration, t_start, events_per_minute, calib_file, product_info_file, seed=seed)
+    print("Writing {}s of synthetic weight data ({} events) to '{}'...".format(duration, len(events), experiment_folder))
+    write_synthetic_weight_segments(experiment_folder, calib_file, duration, F_samp=F_samp, noise_std=weight_noise_std, seed=seed, t_start=t_start, events=events, plate_loads=plate_loads)
+    if do_video:
+        cam_events = [dict(e, t_start=e['t_start']+cam_clock_offset, t_end=e['t_end']+cam_clock_offset) for e in events]
+        write_synthetic_cameras(experiment_folder, t_start+cam_clock_offset, duration, cam_events, num_cams, fps, resolution, noise_std=video_noise_std, seed=seed)
+    write_synthetic_ground_truth(experiment_folder, events, t_start, t_start+duration, cam_clock_offset)
+    print("Done generating synthetic experiment '{}'!".format(experiment_folder))
+    return experiment_folder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", help="Folder where to create the synthetic experiment (in a subfolder named after its start datetime)")
+    parser.add_argument('-t', "--start-datetime", default=SYNTHETIC_T_START.strftime(EXPERIMENT_DATETIME_STR_FORMAT), help="Start datetime of the experiment (format: {})".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument('-d', "--duration", default=60, type=float, help="Duration (in s) of the experiment")
+    parser.add_argument('-c', "--num-cams", default=4, type=int, help="Number of cameras")
+    parser.add_argument('-f', "--fps", default=30, type=int, help="Camera frame rate")
+    parser.add_argument('-r', "--resolution", nargs=2, default=[640, 360], type=int, help="Camera resolution (width height)")
+    parser.add_argument('-w', "--weight-fps", default=60, type=int, help="Load cell sampling rate")
+    parser.add_argument('-e', "--events-per-minute", default=2.0, type=float, help="Average number of pickups/putbacks per minute")
+    parser.add_argument('-n', "--weight-noise", default=2.0, type=float, help="Std (in g) of the load cell noise")
+    parser.add_argument('-vn', "--video-noise", default=3.0, type=float, help="Std (in intensity levels) of the camera noise")
+    parser.add_argument('-o', "--cam-clock-offset", default=0, type=float, help="How far (in s) the cameras' clock is ahead of the load cells'")
+    parser.add_argument('-nv', "--no-video", default=False, action="store_true", help="Add this flag to only generate weight data and ground truth")
+    parser.add_argument('-s', "--seed", default=0, type=int, help="Random seed")
+    args = parser.parse_args()
+
+    generate_synthetic_experiment(args.folder, datetime.strptime(args.start_datetime, EXPERIMENT_DATETIME_STR_FORMAT), args.duration, args.num_cams, args.fps, tuple(args.resolution),
+                                  args.weight_fps, args.events_per_minute, args.weight_noise, args.video_noise, args.cam_clock_offset, not args.no_video, seed=args.seed)
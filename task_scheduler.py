@@ -0,0 +1,192 @@
+import os
+import queue
+import time
+import traceback
+
+
+DEFAULT_SUMMARY_INTERVAL = 30  # Seconds between progress summaries
+DEFAULT_MAX_RETRIES = 1
+
+
+def get_total_memory():
+    """Physical memory of this machine, in bytes"""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class Task:
+    """A unit of work for TaskScheduler: fn(*args, **kwds), run on one of the scheduler's executors.
+     - inputs: files it needs. If another task outputs them, it only starts once that task succeeded (and is skipped if it failed for good)
+     - optional_inputs: same, but it still runs if the task producing them failed (e.g. it'd only use them to save work)
+     - outputs: files it creates
+     - resources: how much of every scheduler resource it holds while running (e.g. {"cpu": 2, "memory": 4e9})
+     - device: if set (e.g. "gpu"), it also holds one slot of the least busy <device>N resource, runs on executor <executor>N and gets kwds[device_kwd] = N"""
+
+    def __init__(self, name, fn, args=(), kwds=None, executor="default", inputs=(), optional_inputs=(), outputs=(), resources=None, device=None, device_kwd="gpu_id", priority=0):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwds = kwds or {}
+        self.executor = executor
+        self.inputs = [os.path.abspath(f) for f in inputs]
+        self.optional_inputs = [os.path.abspath(f) for f in optional_inputs]
+        self.outputs = [os.path.abspath(f) for f in outputs]
+        self.resources = resources or {}
+        self.device = device
+        self.device_kwd = device_kwd
+        self.priority = priority
+        self.deps = []  # (task, is_optional) this task waits for (see TaskScheduler._resolve_dependencies)
+        self.dependents = []
+        self.state = "waiting"  # waiting -> ready -> running -> done/failed (or back to ready, if retried)
+        self.attempts = 0
+        self.held = None  # Resources held while running
+        self.t_start = None
+
+
+class TaskScheduler:
+    """Runs a DAG of Tasks on long-lived executors (e.g. multiprocessing Pools, which keep their models loaded between tasks): every task starts as soon as
+    its dependencies are done and the resources it needs are free (ready tasks that unblock the most other tasks go first, smaller ones fill in the gaps).
+    resources: {name: capacity}. executors: {name: (pool, num_processes)}, every executor is also a resource (at most num_processes of its tasks run at once).
+    Failed tasks are retried up to max_retries times. Every summary_interval seconds (and at the end), prints queue depths and resource utilization"""
+
+    def __init__(self, resources, executors, max_retries=DEFAULT_MAX_RETRIES, summary_interval=DEFAULT_SUMMARY_INTERVAL):
+        self.executors = {name: pool for name, (pool, _) in executors.items()}
+        self.capacity = dict(resources)
+        self.capacity.update({"executor:" + name: num_processes for name, (_, num_processes) in executors.items()})
+        self.used = {name: 0 for name in self.capacity}
+        self.busy_time = {name: 0.0 for name in self.capacity}  # Integral of used over time (-> average utilization)
+        self.max_retries = max_retries
+        self.summary_interval = summary_interval
+        self.tasks = []
+        self.events = queue.Queue()  # (task, error) as tasks finish (error is None if they succeeded), put from the executors' result threads
+
+    def add(self, task):
+        self.tasks.append(task)
+        return task
+
+    def _resolve_dependencies(self):
+        producers = {}
+        for task in self.tasks:
+            for output in task.outputs:
+                if output in producers:
+                    raise ValueError("Both tasks '{}' and '{}' output '{}'".format(producers[output].name, task.name, output))
+                producers[output] = task
+        for task in self.tasks:  # (Inputs no task produces must already exist)
+            for inputs, is_optional in ((task.inputs, False), (task.optional_inputs, True)):
+                for producer in {producers[f] for f in inputs if f in producers and producers[f] is not task}:
+                    task.deps.append((producer, is_optional))
+                    producer.dependents.append(task)
+
+    def _count_descendants(self):
+        """Number of tasks (directly or indirectly) waiting for each task"""
+        descendants = {}
+        def get_descendants(task):
+            if task not in descendants:
+                descendants[task] = set()  # (In case of a dependency cycle)
+                descendants[task] = set(task.dependents).union(*(get_descendants(d) for d in task.dependents))
+            return descendants[task]
+        return {task: len(get_descendants(task)) for task in self.tasks}
+
+    def _needs(self, task, device_id=None):
+        needs = {name: min(amount, self.capacity.get(name, amount)) for name, amount in task.resources.items()}  # (A task needing more than there is runs alone)
+        needs["executor:" + self._executor_name(task, device_id)] = 1
+        if task.device is not None:
+            needs[task.device + str(device_id)] = 1
+        return needs
+
+    def _executor_name(self, task, device_id=None):
+        return task.executor if task.device is None else task.executor + str(device_id)
+
+    def _fits(self, needs):
+        return all(self.used.get(name, 0) + amount <= self.capacity.get(name, 0) for name, amount in needs.items())
+
+    def _pick_device(self, task):
+        """Least busy device (of task.device's kind) that has room for the task, None if none does"""
+        devices = sorted((self.used[name]/max(self.capacity[name], 1), int(name[len(task.device):])) for name in self.capacity if name.startswith(task.device) and name[len(task.device):].isdigit())
+        return next((device_id for _, device_id in devices if self._fits(self._needs(task, device_id))), None)
+
+    def _start(self, task):
+        device_id = None
+        if task.device is not None:
+            device_id = self._pick_device(task)
+            if device_id is None: return False
+        needs = self._needs(task, device_id)
+        if not self._fits(needs): return False
+
+        for name, amount in needs.items():
+            self.used[name] += amount
+        task.held = needs
+        task.state = "running"
+        task.attempts += 1
+        task.t_start = time.time()
+        kwds = dict(task.kwds, **({task.device_kwd: device_id} if task.device is not None else {}))
+        self.executors[self._executor_name(task, device_id)].apply_async(task.fn, task.args, kwds, callback=lambda _: self.events.put((task, None)), error_callback=lambda e: self.events.put((task, e)))
+        return True
+
+    def _finish(self, task, error):
+        for name, amount in task.held.items():
+            self.used[name] -= amount
+        task.held = None
+        duration = time.time() - task.t_start
+        if error is None:
+            task.state = "done"
+            print("Task '{}' done in {:.1f}s".format(task.name, duration))
+        elif task.attempts <= self.max_retries:
+            task.state = "ready"
+            print("Task '{}' failed after {:.1f}s (attempt {}/{}), retrying: {!r}".format(task.name, duration, task.attempts, self.max_retries+1, error))
+        else:
+            task.state = "failed"
+            traceback.print_exception(type(error), error, error.__traceback__)
+            print("Task '{}' failed after {:.1f}s (attempt {}/{}), giving up!".format(task.name, duration, task.attempts, self.max_retries+1))
+
+    def _update_waiting(self):
+        """Moves waiting tasks whose dependencies are over to ready (or failed, if a dependency they need failed)"""
+        for task in self.tasks:
+            if task.state != "waiting": continue
+            if any(dep.state == "failed" and not is_optional for dep, is_optional in task.deps):
+                task.state = "failed"
+                print("Task '{}' won't run: {} failed".format(task.name, ", ".join("'{}'".format(dep.name) for dep, is_optional in task.deps if dep.state == "failed" and not is_optional)))
+            elif all(dep.state in ("done", "failed") for dep, _ in task.deps):
+                task.state = "ready"
+
+    def print_summary(self, t_elapsed):
+        count = lambda state: sum(task.state == state for task in self.tasks)
+        print("[Scheduler, {:.0f}s] {} tasks: {} waiting for dependencies, {} ready, {} running, {} done, {} failed".format(t_elapsed, len(self.tasks), count("waiting"), count("ready"), count("running"), count("done"), count("failed")))
+        for name in sorted(self.capacity):
+            capacity = self.capacity[name]
+            fmt = (lambda x: "{:.1f}GB".format(x/1e9)) if name == "memory" else (lambda x: "{:g}".format(x))
+            print("\t{}: {}/{} in use now, {:.0f}% utilization on average".format(name, fmt(self.used[name]), fmt(capacity), 100*self.busy_time[name]/max(capacity*t_elapsed, 1e-9)))
+
+    def run(self):
+        """Runs every task added so far and waits for all of them. Returns the list of tasks that failed"""
+        self._resolve_dependencies()
+        num_descendants = self._count_descendants()
+        order = {task: (-task.priority, -num_descendants[task], i) for i, task in enumerate(self.tasks)}
+        t_start = t_last = t_last_summary = time.time()
+        while True:
+            self._update_waiting()
+            for task in sorted((task for task in self.tasks if task.state == "ready"), key=order.get):  # Start everything that fits, most important first
+                self._start(task)
+            num_running = sum(task.state == "running" for task in self.tasks)
+            if num_running == 0:
+                stuck = [task for task in self.tasks if task.state in ("waiting", "ready")]
+                for task in stuck:  # Dependency cycle, or needs resources/executors that don't exist
+                    task.state = "failed"
+                    print("Task '{}' can never run (dependency cycle or missing resources: {})!".format(task.name, self._needs(task, 0)))
+                break
+
+            try:
+                task, error = self.events.get(timeout=max(t_last_summary + self.summary_interval - time.time(), 0.01))
+            except queue.Empty:
+                task = None
+            t = time.time()
+            for name in self.used:
+                self.busy_time[name] += self.used[name] * (t - t_last)
+            t_last = t
+            if task is not None:
+                self._finish(task, error)
+            if t - t_last_summary >= self.summary_interval:
+                self.print_summary(t - t_start)
+                t_last_summary = t
+
+        self.print_summary(time.time() - t_start)
+        return [task for task in self.tasks if task.state == "failed"]
@@ -0,0 +1,310 @@
+from aux_tools import str_to_datetime, datetime_to_epoch
+import numpy as np
+import cv2
+import h5py
+import threading
+import queue
+import time
+
+
+DEFAULT_GOP_SIZE = 250  # Max distance between keyframes (ffmpeg/x264's default keyint). Seeking costs up to this many decoded frames
+DEFAULT_STAGE_QUEUE_SIZE = 16  # Max decoded frames waiting for each FrameStage (bounds memory: the decoder blocks when the slowest stage falls behind)
+
+
+def _put_unless_stopped(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get_unless_stopped(q, stop):
+    """Counterpart of _put_unless_stopped: returns (True, item), or (False, None) if stop gets set before an item arrives (so a consumer can't block forever on a producer that bailed out)"""
+    while not stop.is_set():
+        try:
+            return True, q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return False, None
+
+
+def load_camera_timestamps(camera_h5_filename):
+    """Returns the float epoch timestamp of every frame of a camera, from its .h5's numeric t (seconds since the first frame) and a single parsed t_str (the first one)"""
+    with h5py.File(camera_h5_filename, 'r') as camera_info:
+        return datetime_to_epoch(str_to_datetime(camera_info["t_str"][0])) + camera_info["t"][:]
+
+
+def load_multicam_timestamps(multicam_h5_filename):
+    """Returns the float epoch timestamp of every frame of a multi-cam video (constant fps), from the timing params generate_multicam_video saves in its .h5"""
+    with h5py.File(multicam_h5_filename, 'r') as h5_cam:
+        return datetime_to_epoch(str_to_datetime(h5_cam.attrs['t_start'])) + np.arange(h5_cam['frame_nums'].shape[-1])/float(h5_cam.attrs['fps'])
+
+
+def nearest_frame_nums(t_frames, t):
+    """Index of the frame (t_frames must be sorted) closest to each timestamp in t. Same as interp1d(t_frames, range(len(t_frames)), kind='nearest')(t) (ties go to the earlier frame)"""
+    t_frames = np.asarray(t_frames)
+    return np.searchsorted((t_frames[1:]+t_frames[:-1])/2, t, side='left')
+
+
+class SequentialVideoReader:
+    """Forward-only frame reader: read(n) decodes the video sequentially, repeating the last frame or dropping frames as needed to return frame n.
+    It only seeks when n is behind the current position or further ahead than a whole GOP (seeking decodes from the previous keyframe, so it's only worth it then)"""
+
+    def __init__(self, video_filename, gop_size=DEFAULT_GOP_SIZE, num_threads=None):
+        self.video_filename = video_filename
+        self.video = cv2.VideoCapture(video_filename) if num_threads is None else cv2.VideoCapture(video_filename, cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, num_threads])  # None: let ffmpeg decide (usually 1 thread per core)
+        self.gop_size = gop_size
+        self.next_frame_num = 0  # Frame number the next video.read() would return
+        self.frame_num = -1  # Frame number of self.frame
+        self.frame = None
+        self.num_decoded = 0  # Stats (how much work we did)
+        self.num_seeks = 0
+
+    def get(self, prop_id):
+        return self.video.get(prop_id)
+
+    def read(self, frame_num=None, image=None):
+        """Same as cv2.VideoCapture.read() (returns (ok, img)), but for frame frame_num (None for the next one). If image is given, the frame is copied into it"""
+        if frame_num is None:
+            frame_num = self.next_frame_num
+        if frame_num != self.frame_num:
+            if frame_num < self.next_frame_num or frame_num - self.next_frame_num > self.gop_size:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+                self.next_frame_num = frame_num
+                self.num_seeks += 1
+            while self.next_frame_num < frame_num:  # Drop frames (grab() skips the color conversion)
+                if not self.video.grab():
+                    return False, image
+                self.next_frame_num += 1
+                self.num_decoded += 1
+            ok, frame = self.video.read(self.frame)
+            if not ok:
+                return False, image
+            self.frame = frame
+            self.frame_num = frame_num
+            self.next_frame_num += 1
+            self.num_decoded += 1
+
+        if image is None:
+            return True, self.frame
+        image[...] = self.frame
+        return True, image
+
+    def release(self):
+        self.video.release()
+
+
+def split_frames_into_shards(num_frames, num_shards, gop_size=DEFAULT_GOP_SIZE):
+    """Splits frames [0, num_frames) into (at most) num_shards contiguous (n_start, n_end) ranges of similar length, cut at multiples of gop_size (keyframes)
+    so whoever renders each range can seek straight to its first frame"""
+    cuts = sorted(set(min(int(round(float(k)*num_frames/(num_shards*gop_size)))*gop_size, num_frames) for k in range(num_shards+1)) | {0, num_frames})
+    return [(n_start, n_end) for n_start, n_end in zip(cuts[:-1], cuts[1:]) if n_end > n_start]
+
+
+def concat_videos(video_filenames, video_out_filename, video_fps, codec='avc1'):
+    """Decodes video_filenames in order and encodes all their frames into a single video_out_filename (returns the number of frames written)"""
+    video_out = None
+    num_frames = 0
+    for video_filename in video_filenames:
+        video_in = cv2.VideoCapture(video_filename)
+        ok, frame = video_in.read()
+        while ok:
+            if video_out is None:
+                video_out = cv2.VideoWriter(video_out_filename, cv2.VideoWriter_fourcc(*codec), video_fps, (frame.shape[1], frame.shape[0]))
+            video_out.write(frame)
+            num_frames += 1
+            ok, frame = video_in.read(frame)
+        video_in.release()
+    if video_out is not None:
+        video_out.release()
+    return num_frames
+
+
+def get_video_info(video_in, video_filename):
+    """Dict with the video's 'filename', 'fps', 'width', 'height' and 'num_frames' (video_in: an open cv2.VideoCapture)"""
+    return {'filename': video_filename, 'fps': video_in.get(cv2.CAP_PROP_FPS), 'num_frames': int(video_in.get(cv2.CAP_PROP_FRAME_COUNT)),
+            'width': int(video_in.get(cv2.CAP_PROP_FRAME_WIDTH)), 'height': int(video_in.get(cv2.CAP_PROP_FRAME_HEIGHT))}
+
+
+class FrameStage:
+    """A consumer of FanOutFrameSource: process() is called (from the stage's own thread) with every decoded frame, in order.
+    Frames are shared by all stages -> Don't modify them in place. Subclasses own their outputs (open them in start(), close them in finish())"""
+    name = "stage"
+    queue_size = DEFAULT_STAGE_QUEUE_SIZE
+
+    def start(self, video_info):
+        """video_info: see get_video_info"""
+        pass
+
+    def process(self, frame_num, frame):
+        raise NotImplementedError
+
+    def skip(self, frame_num, frame):
+        """Called instead of process() for the frames FanOutFrameSource's selector left out. Stages that don't care about selection process them anyway"""
+        self.process(frame_num, frame)
+
+    def flush(self):
+        """Called after the last frame (only if nothing failed), e.g. to process a partial batch"""
+        pass
+
+    def finish(self):
+        """Called once the stage is done (also if something failed, so outputs are always closed)"""
+        pass
+
+
+class FanOutFrameSource:
+    """Decodes a video once and fans every frame out to several FrameStages, each running in its own thread behind its own bounded queue
+    (a slow stage only makes the decoder wait once its queue is full, the rest keep working on what's already been decoded).
+    If given a selector (see frame_selection.FrameSelector), frames it doesn't select are passed to the stages' skip() instead of process()"""
+
+    def __init__(self, video_filename, stages, selector=None):
+        self.video_filename = video_filename
+        self.stages = stages
+        self.selector = selector
+        self.stats = {}  # Per-stage counters (see print_stats)
+
+    def run(self):
+        video_in = cv2.VideoCapture(self.video_filename)
+        video_info = get_video_info(video_in, self.video_filename)
+        stop = threading.Event()
+        stage_queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        errors = []
+        self.stats = {stage.name: {'frames': 0, 't_busy': 0.0, 't_backpressure': 0.0} for stage in self.stages}
+        self.t_selection = 0.0
+        if self.selector is not None:
+            self.selector.start(video_info)
+
+        def consume(stage, q):
+            stats = self.stats[stage.name]
+            try:
+                stage.start(video_info)
+                while True:
+                    try:
+                        item = q.get(timeout=0.1)
+                    except queue.Empty:
+                        if stop.is_set(): break  # Another stage failed
+                        continue
+                    if item is None: break
+                    frame_num, frame, selected = item
+                    t = time.time()
+                    if selected:
+                        stage.process(frame_num, frame)
+                    else:
+                        stage.skip(frame_num, frame)
+                    stats['t_busy'] += time.time()-t
+                    stats['frames'] += 1
+                if not stop.is_set():
+                    t = time.time()
+                    stage.flush()
+                    stats['t_busy'] += time.time()-t
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                stage.finish()
+
+        threads = [threading.Thread(target=consume, args=(stage, q), name=stage.name) for stage, q in zip(self.stages, stage_queues)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        def fan_out(items):
+            for item in items:
+                for stage, q in zip(self.stages, stage_queues):
+                    t = time.time()
+                    if not _put_unless_stopped(q, item, stop): return
+                    self.stats[stage.name]['t_backpressure'] += time.time()-t
+
+        def select(frame_num, frame):
+            if self.selector is None:
+                return [(frame_num, frame, True)]
+            t = time.time()
+            items = self.selector.push(frame_num, frame) if frame is not None else self.selector.finish()
+            self.t_selection += time.time()-t
+            return items
+
+        t_start = time.time()
+        num_frames = 0
+        try:
+            while not stop.is_set():
+                ok, frame = video_in.read()
+                if not ok: break
+                fan_out(select(num_frames, frame))
+                num_frames += 1
+            if self.selector is not None and not stop.is_set():
+                fan_out(select(num_frames, None))  # Frames the selector was still holding on to
+        except BaseException:
+            stop.set()  # Don't let the stages flush a partial video
+            raise
+        finally:
+            for q in stage_queues: _put_unless_stopped(q, None, stop)
+            for thread in threads: thread.join()
+            video_in.release()
+        if len(errors) > 0:
+            raise errors[0]
+        self.print_stats(num_frames, time.time()-t_start)
+        return num_frames
+
+    def print_stats(self, num_frames, t_total):
+        print("Decoded {} frames of '{}' once for {} stages in {:.2f}s ({:.1f} fps)".format(num_frames, self.video_filename, len(self.stages), t_total, num_frames/max(t_total, 1e-9)))
+        for name, stats in self.stats.items():
+            print("\t{}: {} frames, {:.1f} fps while busy, {:.0f}% busy, decoder blocked on it for {:.2f}s".format(name, stats['frames'], stats['frames']/max(stats['t_busy'], 1e-9), 100*stats['t_busy']/max(t_total, 1e-9), stats['t_backpressure']))
+        if self.selector is not None:
+            print("\tframe selection: {}/{} frames selected ({:.1f}%) in {:.2f}s ({})".format(self.selector.num_selected, self.selector.num_frames, 100.*self.selector.num_selected/max(self.selector.num_frames, 1), self.t_selection, self.selector.describe()))
+
+
+class BackgroundWorker:
+    """Calls fn(*item) on every item put() in it, in order, from a background thread behind a bounded queue (e.g. so writing a stage's outputs overlaps with
+    its computations). put() raises any error the thread ran into, close() waits for every queued item (and raises), abort() drops them"""
+
+    def __init__(self, fn, queue_size=DEFAULT_STAGE_QUEUE_SIZE, name="worker"):
+        self.fn = fn
+        self.name = name
+        self.error = None
+        self.stats = {'items': 0, 't_busy': 0.0, 't_backpressure': 0.0}  # t_backpressure: how long put() waited for room in the queue
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    if self.stop.is_set(): break  # Aborted
+                    continue
+                if item is None or self.stop.is_set(): break  # Done, or aborted (the rest of the queue is dropped)
+                t = time.time()
+                self.fn(*item)
+                self.stats['t_busy'] += time.time()-t
+                self.stats['items'] += 1
+        except Exception as e:
+            self.error = e
+            self.stop.set()
+
+    def put(self, *item):
+        t = time.time()
+        if not _put_unless_stopped(self.queue, item, self.stop):
+            raise self.error if self.error is not None else RuntimeError("Background worker '{}' was aborted!".format(self.name))
+        self.stats['t_backpressure'] += time.time()-t
+
+    def close(self):
+        """Waits until every queued item has been processed"""
+        if self.thread is None: return
+        _put_unless_stopped(self.queue, None, self.stop)
+        self.thread.join()
+        self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        """Stops without processing the items still queued (e.g. something else failed)"""
+        if self.thread is None: return
+        self.stop.set()
+        self.thread.join()
+        self.thread = None
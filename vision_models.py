@@ -0,0 +1,158 @@
+import numpy as np
+from aux_tools import JointEnum
+import traceback
+import inspect
+import time
+import cv2
+
+
+# Models are loaded once per process and reused by every video that process handles (see get_resident_model), so long-lived worker processes
+# (e.g. ExperimentPreProcessor's per-GPU pools, which call init_model_worker when they start) only pay the model startup cost once
+_resident_models = {}
+
+
+class DetectionModel:
+    """Object detector interface. Constructors take (gpu_id, config_file, confidence_thresh, categories_file) (implementations may ignore some of them)"""
+
+    def predict(self, images, render=False):
+        """Returns (detections, rendered): detections of every image as a (# detections, 4+# classes) float32 array (box, then the score of every class)
+        and, if render, a copy of every image with its detections drawn on top (otherwise None). Images must not be modified"""
+        raise NotImplementedError
+
+
+class PoseModel:
+    """Pose estimator interface. Constructors take (model_folder, gpu_id) (implementations may ignore some of them)"""
+
+    def predict(self, image):
+        """Returns (people_keypoints, rendered): (# people, # keypoints, 3) [x, y, confidence] keypoints of everyone found in image and a copy of image
+        with their poses drawn on top. image must not be modified"""
+        raise NotImplementedError
+
+
+class MaskRCNNDetector(DetectionModel):
+    def __init__(self, gpu_id=0, config_file="configs/aim3s.yaml", confidence_thresh=0.1, categories_file="../aim3s_dataset/aim3s.names"):
+        from maskrcnn_benchmark.config import cfg
+        from predictor_skus import SKUsDemo
+
+        # Load MaskRCNN config
+        cfg.merge_from_file(config_file)
+        cfg.MODEL.DEVICE = gpu_id  # Run the model on the specified gpu
+        #cfg.freeze()
+
+        # Load category names
+        with open(categories_file) as f:
+            categories = f.readlines()
+
+        # Prepare object that handles inference plus adds predictions on top of image
+        self.model = SKUsDemo(
+            cfg,
+            categories=categories,
+            confidence_threshold=confidence_thresh,
+        )
+
+    def predict(self, images, render=False):
+        detections, rendered = [], [] if render else None
+        for image, predictions in zip(images, self.model.compute_prediction_list(images)):
+            predictions = self.model.select_top_predictions(predictions)
+            detections.append(predictions.get_field("scores_all").numpy())
+            if render:
+                img = self.model.overlay_boxes(image.copy(), predictions)
+                rendered.append(self.model.overlay_class_names(img, predictions))
+        return detections, rendered
+
+
+class OpenPoseModel(PoseModel):
+    def __init__(self, model_folder="openpose-models/", gpu_id=None):
+        from openpose import pyopenpose as op
+        self.op = op
+        openpose_params = {
+            "model_folder": model_folder,
+            "display": 0,
+            "render_pose": 1,  # 1 for CPU (slightly faster), 2 for GPU
+        }
+        if gpu_id is not None:
+            openpose_params.update({"num_gpu": 1, "num_gpu_start": gpu_id})
+        self.openpose_wrapper = op.WrapperPython()
+        self.openpose_wrapper.configure(openpose_params)
+        self.openpose_wrapper.start()
+
+    def predict(self, image):
+        datum = self.op.Datum()
+        datum.cvInputData = image
+        self.openpose_wrapper.emplaceAndPop(self.op.VectorDatum([datum]) if hasattr(self.op, "VectorDatum") else [datum])  # OpenPose >= 1.7 needs a VectorDatum
+        people_keypoints = datum.poseKeypoints if datum.poseKeypoints is not None and np.ndim(datum.poseKeypoints) == 3 else []
+        return people_keypoints, datum.cvOutputData
+
+
+class StubDetector(DetectionModel):
+    """Lightweight CPU stand-in for MaskRCNN (e.g. to test the pipeline without a GPU): "detects" the largest bright blobs of every image,
+    with made-up (but deterministic) class scores"""
+    STUB_NUM_CLASSES = 10
+    STUB_MAX_DETECTIONS = 5
+    STUB_SCALE = 0.25  # Look for blobs on downscaled images (it's just a stub, it should be fast)
+
+    def __init__(self, gpu_id=0, config_file="configs/aim3s.yaml", confidence_thresh=0.1, categories_file="../aim3s_dataset/aim3s.names"):  # (Same defaults as MaskRCNNDetector, so get_resident_model sees the same arguments)
+        pass
+
+    def predict(self, images, render=False):
+        detections, rendered = [], [] if render else None
+        for image in images:
+            gray = cv2.cvtColor(cv2.resize(image, None, fx=self.STUB_SCALE, fy=self.STUB_SCALE, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+            _, blobs = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            _, labels, stats, _ = cv2.connectedComponentsWithStats(blobs)
+            biggest = 1 + np.argsort(-stats[1:, cv2.CC_STAT_AREA])[:self.STUB_MAX_DETECTIONS]  # (Label 0 is the background)
+            boxes = np.column_stack((stats[biggest, cv2.CC_STAT_LEFT], stats[biggest, cv2.CC_STAT_TOP], stats[biggest, cv2.CC_STAT_LEFT] + stats[biggest, cv2.CC_STAT_WIDTH], stats[biggest, cv2.CC_STAT_TOP] + stats[biggest, cv2.CC_STAT_HEIGHT])) / self.STUB_SCALE
+            scores = np.full((len(biggest), self.STUB_NUM_CLASSES), 0.1/self.STUB_NUM_CLASSES)
+            scores[np.arange(len(biggest)), biggest % self.STUB_NUM_CLASSES] += 0.9
+            detections.append(np.hstack((boxes, scores)).astype(np.float32))
+            if render:
+                img = image.copy()
+                for box in boxes.astype(int):
+                    cv2.rectangle(img, tuple(box[:2]), tuple(box[2:]), (0, 255, 0), 2)
+                rendered.append(img)
+        return detections, rendered
+
+
+class StubPoseModel(PoseModel):
+    """Lightweight CPU stand-in for OpenPose: "finds" one person (every keypoint, wrists included, at the image's brightest spot) in every image that isn't black"""
+
+    def __init__(self, model_folder=None, gpu_id=None):
+        self.num_keypoints = len(JointEnum) - 1  # BODY_25 (JointEnum also has BACKGND)
+
+    def predict(self, image):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        _, max_val, _, max_loc = cv2.minMaxLoc(gray)
+        if max_val == 0:
+            return np.zeros((0, self.num_keypoints, 3), dtype=np.float32), image.copy()
+        people_keypoints = np.tile(np.array((max_loc[0], max_loc[1], max_val/255.0), dtype=np.float32), (1, self.num_keypoints, 1))
+        rendered = image.copy()
+        cv2.circle(rendered, max_loc, 5, (0, 0, 255), -1)
+        return people_keypoints, rendered
+
+
+DETECTION_MODELS = {"maskrcnn": MaskRCNNDetector, "stub": StubDetector}
+POSE_MODELS = {"openpose": OpenPoseModel, "stub": StubPoseModel}
+MODELS = {"detector": DETECTION_MODELS, "pose": POSE_MODELS}
+
+
+def get_resident_model(kind, name, **kwargs):
+    """Returns MODELS[kind][name](**kwargs), only creating (loading) it the first time this process asks for it with the same arguments"""
+    model_class = MODELS[kind][name]
+    model_args = inspect.signature(model_class).bind(**kwargs)
+    model_args.apply_defaults()  # So asking for the same model with and without its default arguments returns the same instance
+    key = (kind, name, tuple(sorted(model_args.arguments.items())))
+    if key not in _resident_models:
+        t = time.time()
+        _resident_models[key] = model_class(**kwargs)
+        print("Loaded {} model '{}' ({}) in {:.2f}s".format(kind, name, ", ".join("{}={}".format(k, v) for k, v in key[2]), time.time()-t))
+    return _resident_models[key]
+
+
+def init_model_worker(model_specs):
+    """Pool initializer: loads every (kind, name, kwargs) in model_specs, so the worker's first video doesn't have to wait for them"""
+    for kind, name, kwargs in model_specs:
+        try:
+            get_resident_model(kind, name, **kwargs)
+        except Exception:  # Don't kill the worker (the pool would keep respawning it), the model will be loaded again (and fail properly) if a video needs it
+            traceback.print_exc()
+            print("Couldn't preload {} model '{}', will try again when a video needs it".format(kind, name))
@@ -1,7 +1,7 @@
 from generate_video import generate_multicam_video
 from aux_tools import ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
 from read_dataset import parse_product_info
-from preprocess_experiments import HDF5_FRAME_NAME_FORMAT
+from objdet_h5 import ObjdetH5Reader
 from queue import Queue
 from datetime import datetime
 from matplotlib import pyplot as plt
@@ -154,14 +154,8 @@ class ProductPredictionVisualizer(tk.Tk):
         self.do_skip_frames = False
         self.is_paused = False
 
-        # Preprocess all coords if multicam to adjust position
-        for cam, pred_frames in self.visual_predictions.items():
-            # Compute horiz. and vert. offset for this camera [e.g. cam 2 is in the bottom left corner -> (0, halfH)]
-            xy_offset = (self.halfW if int(cam)>2 else 0, self.halfH if (int(cam) % 2)==0 else 0)
-
-            # Iterate all frames where products where found and modify the coordinates of the bounding boxes
-            for products_found in pred_frames.values():
-                products_found[:, :4] = products_found[:, :4]/2 + np.tile(np.tile(xy_offset, 2), (products_found.shape[0], 1))
+        # Compute horiz. and vert. offset for each camera [e.g. cam 2 is in the bottom left corner -> (0, halfH)] to adjust the coords of every bounding box found in it (as frames are read)
+        self.xy_offsets = {cam: np.tile((self.halfW if int(cam)>2 else 0, self.halfH if (int(cam) % 2)==0 else 0), 2) for cam in self.visual_predictions.keys()}
 
         # Setup ui
         self.title("Visual product prediction for video {}".format(os.path.basename(video_filename)))
@@ -211,8 +205,9 @@ class ProductPredictionVisualizer(tk.Tk):
                 print("Read frame {:4d}/{} ({:.2f}%)".format(self.n_frame, self.N_frames, 100.*self.n_frame/self.N_frames))
 
                 # Process products found in this frame
-                for cam, pred_frames in self.visual_predictions.items():
-                    products_found = pred_frames.get(HDF5_FRAME_NAME_FORMAT.format(self.frame_nums[cam-1, self.n_frame-1]), ())
+                for cam, pred_reader in self.visual_predictions.items():
+                    products_found = pred_reader.read_frame(self.frame_nums[cam-1, self.n_frame-1] - 1)  # frame_nums are 1-based frame names (HDF5_FRAME_NAME_FORMAT), the reader is 0-based
+                    products_found[:, :4] = products_found[:, :4]/2 + self.xy_offsets[cam]
                     self.items_in_frame_manager.add(products_found)
 
             # Visualize results
@@ -312,16 +307,16 @@ class ProductPredictionExperimentsVisualizer(ExperimentTraverser):
         with h5py.File(os.path.join(experiment_folder, "multicam_{}.h5".format(f)), 'r') as f_hdf5:
             frame_nums = f_hdf5['frame_nums'][:]
 
-        # Load predictions for each cam
-        visual_predictions = {}
-        for cam in cams:
-            with h5py.File(os.path.join(experiment_folder, "product_prediction_cam{}_{}.h5".format(cam, f)), 'r') as f_hdf5:
-                visual_predictions[int(cam)] = dict([(frame_num, prods[:]) for frame_num, prods in f_hdf5.items()])
-            print("Loaded visual product predictions from cam {}...".format(cam))
+        # Open predictions for each cam (each frame's predictions are read as the video plays)
+        visual_predictions = {int(cam): ObjdetH5Reader(os.path.join(experiment_folder, "product_prediction_cam{}_{}.h5".format(cam, f))) for cam in cams}
 
         # Visualize video
-        for video_filename in cam_video_filenames:
-            ProductPredictionVisualizer(video_filename, visual_predictions, frame_nums, self.is_multicam).run()
+        try:
+            for video_filename in cam_video_filenames:
+                ProductPredictionVisualizer(video_filename, visual_predictions, frame_nums, self.is_multicam).run()
+        finally:
+            for pred_reader in visual_predictions.values():
+                pred_reader.close()
 
 
 if __name__ == "__main__":
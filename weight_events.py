@@ -0,0 +1,317 @@
+import numpy as np
+from aux_tools import epoch_to_datetime
+import argparse
+
+
+# Same defaults as systemParams in "Experiment postprocessing/loadCommonConstants.m"
+DEFAULT_SYSTEM_PARAMS = {'movAvgWindowInSamples': 60, 'epsVar': 500, 'epsMeanShelf': 10, 'epsMeanPlate': 5, 'N_high': 30, 'N_low': 30}
+DEFAULT_BIN_WIDTHS = (1, 2, 3, 4, 6)
+
+
+class MovingWindowSums:
+    """Streaming sums over a centered window of `window` samples (shrunk at the edges, like MATLAB's movmean/movvar), in O(1) per sample"""
+
+    def __init__(self, window):
+        self.before = window//2  # Even windows are centered about the current and previous samples (same as MATLAB)
+        self.after = window-1 - self.before
+        self.n_in = 0  # Number of samples pushed so far
+        self.n_out = 0  # Number of window sums returned so far
+        self.cumsum = None  # Running cumulative sum of the last few samples (enough to compute the next window sums)
+        self.cumsum_start = 0  # Global index of cumsum[0]
+
+    def push(self, x, is_last=False):
+        """Adds samples x (shape (n, ...)) and returns (sums, counts) for every sample whose window is now complete (all remaining ones if is_last)"""
+        if self.cumsum is None:
+            self.cumsum = np.zeros((0,) + x.shape[1:])
+        if len(x) > 0:
+            # NOTE: np.cumsum adds sequentially, so carrying over the last value gives the exact same result no matter how the input is split in chunks
+            carry = self.cumsum[-1:] if len(self.cumsum) > 0 else np.zeros((1,) + x.shape[1:])
+            self.cumsum = np.concatenate((self.cumsum, np.cumsum(np.concatenate((carry, x)), axis=0)[1:]))
+            self.n_in += len(x)
+
+        n = np.arange(self.n_out, self.n_in if is_last else max(self.n_in-self.after, self.n_out))
+        hi = np.minimum(n + self.after, self.n_in-1)
+        lo = n - self.before-1
+        sums = self.cumsum[hi - self.cumsum_start]
+        sums[lo >= 0] -= self.cumsum[lo[lo >= 0] - self.cumsum_start]
+        counts = hi - np.maximum(lo, -1)
+
+        # Forget whatever the next window sums won't need
+        self.n_out += len(n)
+        keep_from = max(self.n_out - self.before-1, 0)
+        self.cumsum = self.cumsum[keep_from - self.cumsum_start:]
+        self.cumsum_start = keep_from
+        return sums, counts
+
+
+class MovingMean:
+    """Streaming equivalent of MATLAB's movmean(w, window) along the 1st dimension"""
+
+    def __init__(self, window):
+        self.sums = MovingWindowSums(window)
+        self.w_ref = None  # Sums are computed relative to the first sample for better float precision
+
+    @property
+    def n_out(self):
+        return self.sums.n_out
+
+    def push(self, w, is_last=False):
+        """Adds samples w (shape (n, ...)) and returns the mean of every sample whose window is now complete (all remaining ones if is_last)"""
+        w = np.asarray(w, dtype=np.float64)
+        if self.w_ref is None:
+            if len(w) == 0:
+                return w
+            self.w_ref = w[0].copy()
+        sums, counts = self.sums.push(w - self.w_ref, is_last)
+        return self.w_ref + sums/counts.reshape((-1,) + (1,)*(w.ndim-1))
+
+
+class MovingMeanAndVar:
+    """Streaming equivalent of computeWeightMeanAndVar.m along the 1st dimension: wMean = movmean(w, window), wVar = movvar(wMean, window)"""
+
+    def __init__(self, window):
+        self.mean = MovingMean(window)
+        self.var_sums = MovingWindowSums(window)
+        self.mean_ref = None
+
+    def push(self, w, is_last=False):
+        """Adds samples w (shape (n, C)) and returns (w_mean, w_var): w_mean of every sample whose mean is now known, w_var of every sample whose var is now known.
+        The var lags behind the mean (it needs the means of the next window/2 samples), so w_var is usually shorter than w_mean"""
+        w_mean = self.mean.push(w, is_last)
+        if self.mean_ref is None:
+            if len(w_mean) == 0:
+                return w_mean, w_mean
+            self.mean_ref = w_mean[0].copy()
+        d = w_mean - self.mean_ref  # Relative to the first mean for better float precision
+        sums, counts = self.var_sums.push(np.concatenate((d, d**2), axis=1), is_last)
+        s, s2 = np.split(sums, 2, axis=1)
+        counts = counts.reshape(-1, 1)
+        w_var = np.maximum(s2 - s**2/counts, 0) / np.maximum(counts-1, 1)  # Unbiased (N-1) variance, 0 for a single sample (same as MATLAB's var)
+        return w_mean, w_var
+
+
+def aggregate_weights_into_bins(w, bin_widths=DEFAULT_BIN_WIDTHS):
+    """Python version of aggregateWeightsIntoBins.m (w has shape (N, shelves, plates)): returns the total weight per shelf (N, shelves) and a list of (N, shelves, plates/bin_width) weight per bin of contiguous plates"""
+    w = np.ascontiguousarray(w, dtype=np.float64)  # Contiguous so each sum is always added up in the same order (results don't depend on how samples are split in chunks)
+    num_plates = w.shape[2]
+    for bin_width in bin_widths:
+        if num_plates % bin_width != 0:
+            raise ValueError("Can't split {} plates in bins of {} plates!".format(num_plates, bin_width))
+    return w.sum(axis=2), [w.reshape(w.shape[:2] + (num_plates//bin_width, bin_width)).sum(axis=3) for bin_width in bin_widths]
+
+
+class WeightBinPyramid:
+    """Per-bin weight and moving mean/var of every bin width, from a single 2D cumulative sum (over plates and time) of w (shelves, plates, N), as returned by read_weights_data.
+    Every output element costs O(1), no matter the bin width or the window. The moving var of each bin width needs its own cumulative sum of the means: those levels are cached"""
+
+    def __init__(self, w, window=DEFAULT_SYSTEM_PARAMS['movAvgWindowInSamples']):
+        w = np.asarray(w, dtype=np.float64)
+        self.num_shelves, self.num_plates, self.N = w.shape
+        self.before = window//2  # Same (centered, shrunk at the edges) window as MovingWindowSums
+        self.after = window-1 - self.before
+        self.levels = {}  # Cached cumulative sums of the moving mean (and its square) of each bin width
+
+        # cumsum[s, p, n] = sum(w[s, :p, :n]). Sums are relative to the first sample of each plate for better float precision
+        self.w_ref = w[:, :, 0] if self.N > 0 else np.zeros(w.shape[:2])
+        self.ref_cumsum = np.concatenate((np.zeros((self.num_shelves, 1)), np.cumsum(self.w_ref, axis=1)), axis=1)
+        self.cumsum = np.zeros((self.num_shelves, self.num_plates+1, self.N+1))
+        self.cumsum[:, 1:, 1:] = np.cumsum(np.cumsum(w - self.w_ref[:, :, None], axis=2), axis=1)
+
+    def _bin_edges(self, bin_width):
+        bin_width = bin_width or self.num_plates  # None -> Whole shelf
+        if self.num_plates % bin_width != 0:
+            raise ValueError("Can't split {} plates in bins of {} plates!".format(self.num_plates, bin_width))
+        return np.arange(0, self.num_plates+1, bin_width)
+
+    def _box_sum(self, bin_edges, n_lo, n_hi):
+        """Sum of w over each bin and each time range [n_lo, n_hi) -> (shelves, bins, len(n_lo))"""
+        c_hi = self.cumsum[:, bin_edges[:, None], n_hi[None, :]]
+        c_lo = self.cumsum[:, bin_edges[:, None], n_lo[None, :]]
+        ref = np.diff(self.ref_cumsum[:, bin_edges], axis=1)[:, :, None] * (n_hi-n_lo)
+        return np.diff(c_hi - c_lo, axis=1) + ref
+
+    def _window(self, n_a, n_b):
+        n = np.arange(n_a, self.N if n_b is None else n_b)
+        return np.maximum(n-self.before, 0), np.minimum(n+self.after+1, self.N)
+
+    def get_weight(self, bin_width=None, n_a=0, n_b=None):
+        """Total weight of each bin of bin_width plates (None for the whole shelf) at samples [n_a, n_b) -> (shelves, bins, n_b-n_a)"""
+        n = np.arange(n_a, self.N if n_b is None else n_b)
+        return self._box_sum(self._bin_edges(bin_width), n, n+1)
+
+    def get_mean(self, bin_width=None, n_a=0, n_b=None):
+        """Same as movmean(get_weight(bin_width), window) at samples [n_a, n_b)"""
+        n_lo, n_hi = self._window(n_a, n_b)
+        return self._box_sum(self._bin_edges(bin_width), n_lo, n_hi) / (n_hi-n_lo)
+
+    def _get_level(self, bin_width):
+        bin_width = bin_width or self.num_plates
+        if bin_width not in self.levels:
+            w_mean = self.get_mean(bin_width)
+            d = w_mean - w_mean[:, :, :1]  # Relative to the first mean for better float precision
+            level = np.zeros(w_mean.shape[:2] + (2, self.N+1))
+            level[:, :, 0, 1:] = np.cumsum(d, axis=2)
+            level[:, :, 1, 1:] = np.cumsum(d**2, axis=2)
+            self.levels[bin_width] = level
+        return self.levels[bin_width]
+
+    def get_mean_and_var(self, bin_width=None, n_a=0, n_b=None):
+        """Same as computeWeightMeanAndVar.m on get_weight(bin_width) at samples [n_a, n_b): (movmean(w, window), movvar(movmean(w, window), window))"""
+        level = self._get_level(bin_width)
+        n_lo, n_hi = self._window(n_a, n_b)
+        s, s2 = np.moveaxis(level[:, :, :, n_hi] - level[:, :, :, n_lo], 2, 0)
+        counts = n_hi-n_lo
+        return self.get_mean(bin_width, n_a, n_b), np.maximum(s2 - s**2/counts, 0) / np.maximum(counts-1, 1)
+
+    def clear_cache(self):
+        self.levels = {}
+
+
+def _new_event(t, n_B, n_E, w_shelf_B, w_shelf_E, w_bins_B, w_bins_E, shelf, eps_mean_plate):
+    return {
+        'tB': t[0], 'tE': t[1], 'nB': n_B, 'nE': n_E, 'deltaW': w_shelf_E - w_shelf_B, 'shelf': shelf,
+        'bins': [np.flatnonzero(np.abs(w_E - w_B) > eps_mean_plate) for w_B, w_E in zip(w_bins_B, w_bins_E)],  # Contributing bins (for each bin width)
+    }
+
+
+def detect_weight_events(t, w, bin_widths=DEFAULT_BIN_WIDTHS, system_params=None):
+    """Python version of detectWeightEvents.m, on the output of read_weights_data (t: (N,) float epochs, w: (shelves, plates, N)).
+    Returns a list of events (dicts with the same fields as in MATLAB, but indices nB, nE, shelf and bins start at 0), sorted by shelf then time"""
+    system_params = dict(DEFAULT_SYSTEM_PARAMS, **(system_params or {}))
+    N_high, N_low = system_params['N_high'], system_params['N_low']
+    w_shelf, w_bins = aggregate_weights_into_bins(np.moveaxis(w, -1, 0), bin_widths)
+    num_shelves = w_shelf.shape[1]
+    w_shelf_mean, w_shelf_var = MovingMeanAndVar(system_params['movAvgWindowInSamples']).push(w_shelf, is_last=True)
+    w_bins_mean = [MovingMean(system_params['movAvgWindowInSamples']).push(w_b, is_last=True) for w_b in w_bins]
+
+    events = []
+    w_var_is_active = (w_shelf_var > system_params['epsVar'])
+    for shelf in range(num_shelves):
+        state_change_inds = np.flatnonzero(np.diff(w_var_is_active[:, shelf]))  # Interval k+1 starts at state_change_inds[k]+1
+        interval_starts = np.concatenate(([0], state_change_inds+1))
+        interval_lengths = np.diff(np.concatenate((interval_starts, [len(w_var_is_active)])))
+        # Same convention as MATLAB: the 1st interval (k=0) is assumed to be stable, so odd intervals are active and even ones are stable
+        valid_active = [k for k in range(1, len(interval_lengths), 2) if interval_lengths[k] > N_high]
+        valid_stable = [k for k in range(2, len(interval_lengths), 2) if interval_lengths[k] > N_low]
+        min_next_active = -1
+        for k_active in valid_active:
+            if k_active <= min_next_active: continue  # Active, then stable for not long enough, then active again -> Still part of the same event
+            k_stable = next((k for k in valid_stable if k > k_active), None)  # Find the end of the event
+            if k_stable is None: break  # No more events
+
+            # Determine the event timing
+            n_B = max(interval_starts[k_active]-1 - N_low, 0)  # Last point with variance below threshold - N_low samples
+            n_E = interval_starts[k_stable] + N_low  # First point with variance below threshold + N_low samples
+            if abs(w_shelf_mean[n_E, shelf] - w_shelf_mean[n_B, shelf]) > system_params['epsMeanShelf']:  # Keep the event if the weight change is larger than epsMeanShelf
+                events.append(_new_event((t[n_B], t[n_E]), n_B, n_E, w_shelf_mean[n_B, shelf], w_shelf_mean[n_E, shelf],
+                                         [w_b[n_B, shelf] for w_b in w_bins_mean], [w_b[n_E, shelf] for w_b in w_bins_mean], shelf, system_params['epsMeanPlate']))
+            min_next_active = k_stable
+
+    return events
+
+
+class WeightEventDetector:
+    """Streaming version of detect_weight_events: push() chunks of (t, w) as they arrive (e.g. from iter_resampled_weights) and get the events they complete.
+    Each sample is only processed once (O(1) rolling mean and var), and the resulting events are identical to detect_weight_events on the whole experiment"""
+
+    def __init__(self, bin_widths=DEFAULT_BIN_WIDTHS, system_params=None):
+        self.bin_widths = bin_widths
+        self.system_params = dict(DEFAULT_SYSTEM_PARAMS, **(system_params or {}))
+        self.shelf_stats = MovingMeanAndVar(self.system_params['movAvgWindowInSamples'])
+        self.bin_stats = MovingMean(self.system_params['movAvgWindowInSamples'])  # Only need the means of the bins (all bin widths concatenated along the last axis)
+        self.bin_sizes = None
+        self.w_shape = None
+        self.n_var = 0  # Number of samples whose variance has already been thresholded
+
+        # Recent history of t and (shelf and bin) means, enough to look up where the next event begins. All start at sample hist_start (t is known further ahead)
+        self.hist_start = 0
+        self.hist_t = np.zeros(0)
+        self.hist_shelf_mean = None
+        self.hist_bins_mean = None
+
+        # Per-shelf state of the interval walk in detect_weight_events
+        self.shelf_states = None
+
+    def _snapshot(self, n, shelf):
+        i = n - self.hist_start
+        return n, self.hist_t[i], self.hist_shelf_mean[i, shelf], np.split(self.hist_bins_mean[i, shelf], np.cumsum(self.bin_sizes)[:-1])
+
+    def _process_interval(self, state, shelf, end):
+        """Same logic as the loop over valid intervals in detect_weight_events, evaluated as soon as the current interval is long enough"""
+        k, length = state['k'], end - state['start']
+        if k % 2 == 1 and state['pending'] is None and length > self.system_params['N_high']:  # Valid active interval -> Event begins
+            state['pending'] = state['candidate']
+        elif k % 2 == 0 and k >= 2 and state['pending'] is not None and length > self.system_params['N_low']:  # Valid stable interval -> Event ends
+            n_B, t_B, w_shelf_B, w_bins_B = state['pending']
+            n_E, t_E, w_shelf_E, w_bins_E = self._snapshot(state['start'] + self.system_params['N_low'], shelf)
+            state['pending'] = None
+            if abs(w_shelf_E - w_shelf_B) > self.system_params['epsMeanShelf']:
+                return _new_event((t_B, t_E), n_B, n_E, w_shelf_B, w_shelf_E, w_bins_B, w_bins_E, shelf, self.system_params['epsMeanPlate'])
+        return None
+
+    def push(self, t, w, is_last=False):
+        """Adds a chunk of samples (t: (n,) float epochs, w: (shelves, plates, n), same as read_weights_data) and returns the list of events completed by it"""
+        self.w_shape = w.shape[:-1]
+        w_shelf, w_bins = aggregate_weights_into_bins(np.moveaxis(w, -1, 0), self.bin_widths)
+        self.bin_sizes = [w_b.shape[2] for w_b in w_bins]
+        w_bins_mean = self.bin_stats.push(np.concatenate(w_bins, axis=2), is_last)
+        w_shelf_mean, w_shelf_var = self.shelf_stats.push(w_shelf, is_last)
+        if self.hist_shelf_mean is None:
+            self.hist_shelf_mean, self.hist_bins_mean = w_shelf_mean[:0], w_bins_mean[:0]
+        self.hist_t = np.concatenate((self.hist_t, t))
+        self.hist_shelf_mean = np.concatenate((self.hist_shelf_mean, w_shelf_mean))
+        self.hist_bins_mean = np.concatenate((self.hist_bins_mean, w_bins_mean))
+        if len(w_shelf_var) == 0:
+            return []
+
+        events = []
+        w_var_is_active = (w_shelf_var > self.system_params['epsVar'])
+        if self.shelf_states is None:  # Same convention as detect_weight_events: the 1st interval (k=0) is stable, odd intervals are active, even ones are stable
+            self.shelf_states = [{'k': 0, 'start': 0, 'is_active': w_var_is_active[0, shelf], 'pending': None, 'candidate': None} for shelf in range(w_var_is_active.shape[1])]
+        n_end = self.n_var + len(w_var_is_active)
+        for shelf, state in enumerate(self.shelf_states):
+            is_active = w_var_is_active[:, shelf]
+            for n_start in self.n_var + np.flatnonzero(np.diff(np.concatenate(([state['is_active']], is_active)))):  # Start of each new interval
+                event = self._process_interval(state, shelf, n_start)  # Previous interval is over
+                if event is not None: events.append(event)
+                state['k'] += 1
+                state['start'] = n_start
+                if state['k'] % 2 == 1 and state['pending'] is None:  # Active interval starts -> Remember where the event would begin
+                    state['candidate'] = self._snapshot(max(n_start-1 - self.system_params['N_low'], 0), shelf)
+            event = self._process_interval(state, shelf, n_end)  # Current interval (so far)
+            if event is not None: events.append(event)
+            state['is_active'] = is_active[-1]
+        self.n_var = n_end
+
+        # Forget whatever history no future event can refer to
+        keep_from = max(self.n_var-1 - self.system_params['N_low'], 0)
+        self.hist_t = self.hist_t[keep_from-self.hist_start:]
+        self.hist_shelf_mean = self.hist_shelf_mean[keep_from-self.hist_start:]
+        self.hist_bins_mean = self.hist_bins_mean[keep_from-self.hist_start:]
+        self.hist_start = keep_from
+        return events
+
+    def finish(self):
+        """Flushes the last samples (whose moving window is shrunk at the end, same as the batch version). Returns the list of events completed by them"""
+        if self.w_shape is None:
+            return []
+        return self.push(np.zeros(0), np.zeros(self.w_shape + (0,)), is_last=True)
+
+
+if __name__ == "__main__":
+    from read_dataset import iter_resampled_weights
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", help="Experiment folder (containing the sensors_<id> folders) whose weight events to detect")
+    parser.add_argument('-c', "--chunk-duration", default=60, type=float, help="Duration (in s) of each chunk of weight data streamed through the detector")
+    parser.add_argument('-b', "--bin-widths", nargs='+', default=list(DEFAULT_BIN_WIDTHS), type=int, help="Number of plates aggregated in each bin")
+    args = parser.parse_args()
+
+    detector = WeightEventDetector(args.bin_widths)
+    events = []
+    for t, w, _ in iter_resampled_weights(args.folder, chunk_duration=args.chunk_duration):
+        events.extend(detector.push(t, w))
+    events.extend(detector.finish())
+    for event in events:
+        print("Shelf {}: {:+.1f}g from {} to {} (bins: {})".format(event['shelf']+1, event['deltaW'], epoch_to_datetime(event['tB']), epoch_to_datetime(event['tE']), [list(b) for b in event['bins']]))
+    print("Detected {} weight events".format(len(events)))
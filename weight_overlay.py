@@ -0,0 +1,120 @@
+from aux_tools import plt_fig_to_cv2_img
+from matplotlib.colors import to_rgb
+from matplotlib import rcParams
+import numpy as np
+import cv2
+
+
+OVERLAY_TILE_DURATION = 30  # Seconds of weight curve rasterized at once (per axis)
+OVERLAY_MAX_CACHED_TILES = 3  # The window only moves forward (or is scrubbed around a bit) -> A few tiles are enough
+OVERLAY_SUBPIXEL_BITS = 4  # cv2 drawing 'shift': curve vertices are placed with 1/16px precision
+CV2_FONT_PX_PER_SCALE = 26.0  # FONT_HERSHEY_SIMPLEX at scale 1 looks about as big as matplotlib's default font at 26px
+CV2_TICK_LABEL_RAISE = 3  # Pixels to raise cv2's tick labels so they line up with matplotlib's
+
+
+def _to_bgr(color):
+    return tuple(int(round(255*c)) for c in to_rgb(color)[::-1])
+
+
+class WeightOverlayRenderer:
+    """Renders generate_video's weight plot (fig with one curve + one dashed cursor line per axes) for any curr_t without redrawing it with matplotlib.
+    The static parts of the figure (titles, y axes, spines...) are rendered once, each curve is rasterized once (in tiles of OVERLAY_TILE_DURATION seconds, at the
+    axes' pixels-per-second scale) and every frame only copies the sliding [curr_t-t_lims, curr_t+t_lims] window and draws the cursor and x ticks with cv2"""
+
+    def __init__(self, fig, ax, t_lims):
+        self.t_lims = t_lims
+        self.axes = list(ax[:,0])
+        self.curves = [(np.asarray(a.lines[0].get_xdata(), dtype=np.float64), np.asarray(a.lines[0].get_ydata(), dtype=np.float64)) for a in self.axes]
+        self.curve_color = _to_bgr(self.axes[0].lines[0].get_color())
+        self.cursor_color = _to_bgr(self.axes[0].lines[1].get_color())
+        px_per_pt = fig.dpi/72.0
+        self.curve_thickness = max(int(round(self.axes[0].lines[0].get_linewidth()*px_per_pt))-1, 1)  # cv2's anti-aliased lines come out ~1px wider than their thickness
+        self.cursor_dashes = [max(int(round(d*self.axes[0].lines[1].get_linewidth()*px_per_pt)), 1) for d in rcParams['lines.dashed_pattern']]
+        self.tick_length = int(round(self.axes[-1].xaxis.get_major_ticks()[0].tick1line.get_markersize()*px_per_pt))
+        self.tick_pad = int(round(self.axes[-1].xaxis.get_major_ticks()[0].get_pad()*px_per_pt))
+        self.tick_label_scale = self.axes[-1].xaxis.get_major_ticks()[0].label1.get_fontsize()*px_per_pt/CV2_FONT_PX_PER_SCALE
+        self.tick_formatter = self.axes[-1].xaxis.get_major_formatter()
+
+        # Let matplotlib pick the tick spacing once (the window's width never changes), then render everything that doesn't move with curr_t
+        self.axes[-1].set_xlim(-t_lims, t_lims)
+        fig.canvas.draw()
+        ticks = self.axes[-1].get_xticks()
+        self.tick_spacing = ticks[1]-ticks[0]
+        visible_before = [(l, l.get_visible()) for a in self.axes for l in a.lines]
+        for a in self.axes:
+            for l in a.lines: l.set_visible(False)
+            a.tick_params(axis='x', which='both', bottom=False, labelbottom=False)
+        fig.canvas.draw()
+        self.background = plt_fig_to_cv2_img(fig)
+        for l, visible in visible_before: l.set_visible(visible)
+        for a in self.axes: a.tick_params(axis='x', which='both', bottom=True)
+        self.axes[-1].tick_params(axis='x', which='both', labelbottom=True)
+
+        # Pixel geometry of each axes (inside its spines) and the mapping weight -> row
+        fig_height = self.background.shape[0]
+        self.boxes = []
+        for a in self.axes:
+            bbox = a.get_window_extent()
+            row_top, row_bottom = fig_height - int(round(bbox.y1)), fig_height - int(round(bbox.y0))
+            col_left, col_right = int(round(bbox.x0)), int(round(bbox.x1))
+            y_lims = a.get_ylim()
+            self.boxes.append((row_top+1, row_bottom, col_left+1, col_right, (fig_height-bbox.y0-(row_top+1), -bbox.height/(y_lims[1]-y_lims[0]), y_lims[0])))
+        self.px_per_s = self.axes[-1].get_window_extent().width/(2.0*t_lims)
+        self.col_origin = self.axes[-1].get_window_extent().x0  # Figure column of curr_t-t_lims
+        self.tile_width = int(np.ceil(OVERLAY_TILE_DURATION*self.px_per_s))
+        self.tiles = {}
+        self.out = np.empty_like(self.background)
+
+    def _render_tile(self, k):
+        """Rasterizes columns [k*tile_width, (k+1)*tile_width) of every curve (column c <-> t = c/px_per_s)"""
+        tiles = []
+        for (row_top, row_bottom, _, _, (row_offset, row_per_w, w_min)), (t, w) in zip(self.boxes, self.curves):
+            tile = np.full((row_bottom-row_top, self.tile_width, 3), 255, dtype=np.uint8)
+            t_tile_start, t_tile_end = k*self.tile_width/self.px_per_s, (k+1)*self.tile_width/self.px_per_s
+            i_start, i_end = max(np.searchsorted(t, t_tile_start)-1, 0), min(np.searchsorted(t, t_tile_end)+1, len(t))  # Include 1 sample on each side so the curve is continuous across tiles
+            if i_end - i_start > 1:
+                pts = np.column_stack(((t[i_start:i_end]*self.px_per_s - k*self.tile_width), row_offset + (w[i_start:i_end]-w_min)*row_per_w))
+                cv2.polylines(tile, [np.round(pts*(1 << OVERLAY_SUBPIXEL_BITS)).astype(np.int32)], False, self.curve_color, self.curve_thickness, cv2.LINE_AA, OVERLAY_SUBPIXEL_BITS)
+            tiles.append(tile)
+        return tiles
+
+    def _get_tiles(self, k):
+        if k not in self.tiles:
+            if len(self.tiles) >= OVERLAY_MAX_CACHED_TILES:
+                del self.tiles[next(iter(self.tiles))]  # Evict the oldest one
+            self.tiles[k] = self._render_tile(k)
+        return self.tiles[k]
+
+    def render(self, curr_t):
+        """Returns the weight plot image (BGR, same size as plt_fig_to_cv2_img(fig)) centered at curr_t. The returned buffer is reused by the next call"""
+        np.copyto(self.out, self.background)
+        col_offset = int(round((curr_t-self.t_lims)*self.px_per_s - self.col_origin))  # Curve column shown at figure column j: j + col_offset
+
+        # Copy the visible window of every curve, tile by tile
+        for i, (row_top, row_bottom, col_left, col_right, _) in enumerate(self.boxes):
+            c = col_left + col_offset
+            while c < col_right + col_offset:
+                k = c // self.tile_width
+                c_end = min((k+1)*self.tile_width, col_right + col_offset)
+                out_window = self.out[row_top:row_bottom, c-col_offset:c_end-col_offset, :]  # Darkest wins: the curve goes under whatever overlaps the axes (e.g. the title of the axes below)
+                np.minimum(out_window, self._get_tiles(k)[i][:, c-k*self.tile_width:c_end-k*self.tile_width, :], out=out_window)
+                c = c_end
+
+        # Dashed cursor (always at the center), tick marks below every axes and tick labels below the last one
+        col_cursor = int(round(self.col_origin + self.t_lims*self.px_per_s))
+        ticks = self.tick_spacing*np.arange(np.ceil((curr_t-self.t_lims)/self.tick_spacing), np.floor((curr_t+self.t_lims)/self.tick_spacing)+1)
+        for row_top, row_bottom, _, _, _ in self.boxes:
+            row = row_top
+            while row < row_bottom:
+                cv2.line(self.out, (col_cursor, row), (col_cursor, min(row+self.cursor_dashes[0], row_bottom)-1), self.cursor_color, 1)
+                row += sum(self.cursor_dashes)
+            for t_tick in ticks:
+                col = int(round(self.col_origin + (t_tick-curr_t+self.t_lims)*self.px_per_s))
+                cv2.line(self.out, (col, row_bottom), (col, row_bottom+self.tick_length-1), (0, 0, 0), 1)
+        row_labels = self.boxes[-1][1] + self.tick_length + self.tick_pad - CV2_TICK_LABEL_RAISE
+        for t_tick in ticks:
+            label = self.tick_formatter(t_tick, None)
+            (label_width, label_height), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, self.tick_label_scale, 1)
+            col = int(round(self.col_origin + (t_tick-curr_t+self.t_lims)*self.px_per_s))
+            cv2.putText(self.out, label, (col - label_width//2, row_labels + label_height), cv2.FONT_HERSHEY_SIMPLEX, self.tick_label_scale, (0, 0, 0), 1, cv2.LINE_AA)
+        return self.out
@@ -0,0 +1,240 @@
+import numpy as np
+from preprocess_experiments import HDF5_ORIG_WEIGHT_GROUP_NAME, HDF5_WEIGHT_GROUP_NAME, HDF5_WEIGHT_T_NAME, HDF5_WEIGHT_DATA_NAME
+from aux_tools import str_to_datetime, datetime_to_epoch, ExperimentTraverser, EXPERIMENT_DATETIME_STR_FORMAT
+from datetime import datetime
+import argparse
+import h5py
+import os
+
+
+# weights_<t>.h5 v2 layout:
+#  - attrs: version=2, t0 (float epoch of the first resampled sample), F_samp (fixed sample rate), plus any attrs from v1 (resample_mode...)
+#  - w: (shelves, plates, N) float32, chunked along time and compressed. Sample n was taken at t0 + n/F_samp (no timestamps stored)
+#  - orig_weights/weight_<id>/t_ns: int64 epoch nanoseconds of each raw sample (chunked, compressed)
+#  - orig_weights/weight_<id>/w: raw (calibrated) weight of each sample (chunked, compressed)
+#  - orig_weights/weight_<id>/t_index: coarse time index, t_ns of every WEIGHTS_H5_INDEX_STRIDE-th sample (so time windows can be located without reading t_ns)
+WEIGHTS_H5_VERSION = 2
+WEIGHTS_H5_CHUNK_LEN = 4096
+WEIGHTS_H5_INDEX_STRIDE = WEIGHTS_H5_CHUNK_LEN  # One index entry per chunk
+HDF5_WEIGHT_T_NS_NAME = "t_ns"
+HDF5_WEIGHT_T_INDEX_NAME = "t_index"
+WEIGHTS_H5_T_TOLERANCE = 1e-3  # (In samples) Float epochs are only accurate to ~0.25us, so samples within this distance of t are considered to be at t
+
+
+def _epoch_to_ns(t):
+    return np.round(np.asarray(t, dtype=np.float64)*1e9).astype(np.int64)
+
+
+def _chunks(shape):
+    return shape[:-1] + (max(min(shape[-1], WEIGHTS_H5_CHUNK_LEN), 1),)
+
+
+def save_weights_h5_v2(h5_filename, t0, F_samp, w, weights_orig, attrs=None, compression="gzip"):
+    """Writes resampled weights w (sampled at t0 + n/F_samp) and the raw weights_orig ({plate_id: {'t': float epochs, 'w': values}}) in the v2 layout"""
+    # NOTE: MATLAB can only read gzip-compressed datasets (lzf is faster, but Python only)
+    with h5py.File(h5_filename, 'w') as f_hdf5:
+        f_hdf5.attrs.update(attrs or {})
+        f_hdf5.attrs['version'] = WEIGHTS_H5_VERSION
+        f_hdf5.attrs['t0'] = t0
+        f_hdf5.attrs['F_samp'] = F_samp
+        f_hdf5.create_dataset(HDF5_WEIGHT_DATA_NAME, data=w, chunks=_chunks(w.shape), compression=compression)
+
+        orig_weights_group = f_hdf5.create_group(HDF5_ORIG_WEIGHT_GROUP_NAME)
+        for weight_id, weight_info in weights_orig.items():
+            orig_weight = orig_weights_group.create_group(HDF5_WEIGHT_GROUP_NAME.format(weight_id))
+            t_ns = _epoch_to_ns(weight_info['t'])
+            orig_weight.create_dataset(HDF5_WEIGHT_T_NS_NAME, data=t_ns, chunks=_chunks(t_ns.shape), compression=compression)
+            orig_weight.create_dataset(HDF5_WEIGHT_T_INDEX_NAME, data=t_ns[::WEIGHTS_H5_INDEX_STRIDE])
+            orig_weight.create_dataset(HDF5_WEIGHT_DATA_NAME, data=weight_info['w'], chunks=_chunks(weight_info['w'].shape), compression=compression)
+
+
+class WeightsH5V2Writer:
+    """Writes a v2 weights_<t>.h5 one window at a time (e.g. read_dataset.iter_resampled_weights'), so peak memory only depends on the window size.
+    Windows must be consecutive: the first resampled sample appended is at t0, and sample n at t0 + n/F_samp"""
+
+    def __init__(self, h5_filename, F_samp, attrs=None, compression="gzip"):
+        self.h5_filename = h5_filename
+        self.F_samp = F_samp
+        self.compression = compression
+        self.f_hdf5 = h5py.File(h5_filename, 'w')
+        self.f_hdf5.attrs.update(attrs or {})
+        self.f_hdf5.attrs['version'] = WEIGHTS_H5_VERSION
+        self.f_hdf5.attrs['F_samp'] = F_samp
+        self.orig_weights_group = self.f_hdf5.create_group(HDF5_ORIG_WEIGHT_GROUP_NAME)
+        self.num_samples = 0
+        self.t0 = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _append(self, group, name, data, compression=None):
+        """Appends data along its last axis to a resizable group[name] (created the first time). Returns how many samples it had before"""
+        data = np.asarray(data)
+        if name not in group:
+            group.create_dataset(name, shape=data.shape[:-1] + (0,), maxshape=data.shape[:-1] + (None,), dtype=data.dtype, chunks=_chunks(data.shape[:-1] + (WEIGHTS_H5_CHUNK_LEN,)), compression=compression)
+        dataset = group[name]
+        n = dataset.shape[-1]
+        dataset.resize(n + data.shape[-1], axis=data.ndim-1)
+        dataset[..., n:] = data
+        return n
+
+    def append(self, t, w, weights_orig):
+        """t: float epochs of the resampled samples w ((shelves, plates, len(t))). weights_orig: {plate_id: {'t': float epochs, 'w': values}} raw samples"""
+        if len(t) > 0:
+            if self.t0 is None:
+                self.t0 = float(t[0])
+                self.f_hdf5.attrs['t0'] = self.t0
+            self._append(self.f_hdf5, HDF5_WEIGHT_DATA_NAME, w, self.compression)
+            self.num_samples += len(t)
+        for weight_id, weight_info in weights_orig.items():
+            orig_weight = self.orig_weights_group.require_group(HDF5_WEIGHT_GROUP_NAME.format(weight_id))
+            t_ns = _epoch_to_ns(weight_info['t'])
+            n = self._append(orig_weight, HDF5_WEIGHT_T_NS_NAME, t_ns, self.compression)
+            self._append(orig_weight, HDF5_WEIGHT_DATA_NAME, weight_info['w'], self.compression)
+            self._append(orig_weight, HDF5_WEIGHT_T_INDEX_NAME, t_ns[-n % WEIGHTS_H5_INDEX_STRIDE::WEIGHTS_H5_INDEX_STRIDE])  # (Every WEIGHTS_H5_INDEX_STRIDE-th sample of the whole plate)
+
+    @property
+    def t_end(self):
+        return self.t0 + (self.num_samples-1)/float(self.F_samp)
+
+    def close(self):
+        self.f_hdf5.close()
+
+
+class WeightsH5Reader:
+    """Reads (time windows of) a weights_<t>.h5 file, in either the v1 (t + t_str datasets) or the v2 layout. All times are float epochs"""
+
+    def __init__(self, h5_filename):
+        self.h5_filename = h5_filename
+        self.f_hdf5 = h5py.File(h5_filename, 'r')
+        self.version = int(self.f_hdf5.attrs.get('version', 1))
+        self.shape = self.f_hdf5[HDF5_WEIGHT_DATA_NAME].shape
+        self.num_samples = self.shape[-1]
+
+        if self.version >= 2:
+            self.t0 = float(self.f_hdf5.attrs['t0'])
+            self.F_samp = float(self.f_hdf5.attrs['F_samp'])
+            self._t = None
+        else:  # v1: only parse the first timestamp string, the t dataset has the offset (in s) of every sample wrt it
+            self._t = self.f_hdf5[HDF5_WEIGHT_T_NAME][:]
+            self.t0 = datetime_to_epoch(str_to_datetime(self.f_hdf5[HDF5_WEIGHT_T_NAME + "_str"][0]))
+            self.F_samp = float(self.f_hdf5.attrs['F_samp']) if 'F_samp' in self.f_hdf5.attrs else (len(self._t)-1)/(self._t[-1]-self._t[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f_hdf5.close()
+
+    @property
+    def t_start(self):
+        return self.t0
+
+    @property
+    def t_end(self):
+        return self.get_t(self.num_samples-1, self.num_samples)[0]
+
+    def time_to_index(self, t):
+        """Index of the first resampled sample at or after t"""
+        if t is None:
+            return None
+        if self._t is None:
+            return int(np.clip(np.ceil((t-self.t0)*self.F_samp - WEIGHTS_H5_T_TOLERANCE), 0, self.num_samples))
+        return int(np.searchsorted(self._t, t-self.t0 - WEIGHTS_H5_T_TOLERANCE/self.F_samp))
+
+    def get_t(self, n_a=0, n_b=None):
+        n_b = self.num_samples if n_b is None else n_b
+        if self._t is None:
+            return self.t0 + np.arange(n_a, n_b)/self.F_samp
+        return self.t0 + self._t[n_a:n_b]
+
+    def read(self, t_a=None, t_b=None):
+        """Returns (t, w) for every resampled sample in [t_a, t_b) (None means no limit). Only the necessary chunks of w are read"""
+        n_a = self.time_to_index(t_a) or 0
+        n_b = self.time_to_index(t_b) if t_b is not None else self.num_samples
+        n_b = max(n_a, n_b)
+        return self.get_t(n_a, n_b), self.f_hdf5[HDF5_WEIGHT_DATA_NAME][..., n_a:n_b]
+
+    def get_plate_ids(self):
+        return sorted(int(name.rsplit('_', 1)[1]) for name in self.f_hdf5[HDF5_ORIG_WEIGHT_GROUP_NAME].keys())
+
+    def read_orig(self, plate_id, t_a=None, t_b=None):
+        """Returns (t, w) for every raw sample of a plate in [t_a, t_b) (None means no limit)"""
+        orig_weight = self.f_hdf5[HDF5_ORIG_WEIGHT_GROUP_NAME][HDF5_WEIGHT_GROUP_NAME.format(plate_id)]
+        if self.version >= 2:  # Use the coarse index to only read the chunks that overlap [t_a, t_b)
+            t_index = orig_weight[HDF5_WEIGHT_T_INDEX_NAME][:]
+            i_a = 0 if t_a is None else max(np.searchsorted(t_index, _epoch_to_ns(t_a), side='right')-1, 0) * WEIGHTS_H5_INDEX_STRIDE
+            i_b = None if t_b is None else np.searchsorted(t_index, _epoch_to_ns(t_b), side='left') * WEIGHTS_H5_INDEX_STRIDE
+            t = orig_weight[HDF5_WEIGHT_T_NS_NAME][i_a:i_b] / 1e9
+        else:
+            t_dataset = orig_weight[HDF5_WEIGHT_T_NAME]
+            t0 = t_dataset.attrs['t0'] if 't0' in t_dataset.attrs else datetime_to_epoch(str_to_datetime(orig_weight[HDF5_WEIGHT_T_NAME + "_str"][0]))
+            i_a, i_b = 0, None
+            t = t0 + t_dataset[:]
+        w = orig_weight[HDF5_WEIGHT_DATA_NAME][i_a:i_b]
+
+        in_window = np.ones(len(t), dtype=bool)
+        if t_a is not None: in_window &= (t >= t_a)
+        if t_b is not None: in_window &= (t < t_b)
+        return t[in_window], w[in_window]
+
+
+def migrate_weights_h5(h5_filename, out_filename=None, compression="gzip"):
+    """Converts a v1 weights_<t>.h5 file to the v2 layout (in place, unless out_filename is given)"""
+    with WeightsH5Reader(h5_filename) as reader:
+        if reader.version >= WEIGHTS_H5_VERSION:
+            print("File {} already uses layout v{}, nothing to do!".format(h5_filename, reader.version))
+            return h5_filename
+        if reader.num_samples > 1:  # Make sure the v1 timestamps really are evenly spaced
+            max_error = np.abs(reader._t - np.arange(reader.num_samples)/reader.F_samp - reader._t[0]).max()
+            if max_error > 0.5/reader.F_samp:
+                raise ValueError("Can't migrate {}: resampled timestamps aren't evenly spaced (max error {}s)".format(h5_filename, max_error))
+
+        t0 = reader.t0 + reader._t[0]
+        w = reader.f_hdf5[HDF5_WEIGHT_DATA_NAME][:]
+        weights_orig = {}
+        for plate_id in reader.get_plate_ids():
+            t, w_orig = reader.read_orig(plate_id)
+            weights_orig[plate_id] = {'t': t, 'w': w_orig}
+        attrs = dict((k, v) for k, v in reader.f_hdf5.attrs.items() if k not in ('version', 't0', 'F_samp'))
+        F_samp = reader.F_samp
+
+    out_filename = out_filename or h5_filename
+    save_weights_h5_v2(out_filename + ".tmp", t0, F_samp, w, weights_orig, attrs, compression)
+    os.rename(out_filename + ".tmp", out_filename)  # Only replace the original file once the new one has been fully written
+    print("Migrated '{}' to layout v{} as '{}'".format(h5_filename, WEIGHTS_H5_VERSION, out_filename))
+    return out_filename
+
+
+class WeightsH5Migrator(ExperimentTraverser):
+    def __init__(self, main_folder, start_datetime=datetime.min, end_datetime=datetime.max, compression="gzip"):
+        super(WeightsH5Migrator, self).__init__(main_folder, start_datetime, end_datetime)
+        self.compression = compression
+
+    def process_subfolder(self, f):
+        h5_filename = os.path.join(self.main_folder, f, "weights_{}.h5".format(f))
+        if not os.path.exists(h5_filename):
+            print("File {} doesn't exist, skipping...".format(h5_filename))
+            return
+
+        migrate_weights_h5(h5_filename, compression=self.compression)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", default="Dataset/Evaluation", help="Folder containing the experiment(s) whose weights_<t>.h5 to migrate to the v{} layout".format(WEIGHTS_H5_VERSION))
+    parser.add_argument("-s", "--start-datetime", default="", help="Only migrate experiments collected later than this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument("-e", "--end-datetime", default="", help="Only migrate experiments collected before this datetime (format: {}; empty for no limit)".format(EXPERIMENT_DATETIME_STR_FORMAT))
+    parser.add_argument('-c', "--compression", default="gzip", choices=("gzip", "lzf"), help="Compression filter (NOTE: MATLAB can't read lzf)")
+    args = parser.parse_args()
+
+    t_start = datetime.strptime(args.start_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.start_datetime) > 0 else datetime.min
+    t_end = datetime.strptime(args.end_datetime, EXPERIMENT_DATETIME_STR_FORMAT) if len(args.end_datetime) > 0 else datetime.max
+
+    WeightsH5Migrator(args.folder, t_start, t_end, args.compression).run()